@@ -0,0 +1,8 @@
+import os
+
+# must be set before interviewai.server is imported, so that it doesn't start the threading session manager
+os.environ["SERVER_MODE"] = "asyncio"
+
+from interviewai.async_server import create_asgi_app
+
+application = create_asgi_app()
@@ -33,6 +33,9 @@ class LoggerMixed:
     def debug(self, message, **kwargs):
         self.logger.debug(msg = message, extra={**kwargs})
 
+    def warning(self, message, **kwargs):
+        self.logger.warning(msg = message, extra={**kwargs})
+
     def error(self, message, **kwargs):
         self.logger.error(msg = message, extra={**kwargs})
 ####################
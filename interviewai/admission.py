@@ -0,0 +1,165 @@
+"""
+Admission scheduler for new interview sessions.
+
+Creating a session reads firestore, picks a Deepgram key and builds the chains, which takes seconds. New
+connections are queued by payment tier (ADMIN, then PAID, then FREE, FIFO inside a tier) and started by a
+bounded pool of creator threads, with at most ADMISSION_MAX_STARTUPS session startups running at once.
+A slot is taken before dequeuing, so a paying user arriving during a burst of free users is next in line.
+
+While a session is queued or starting, its PendingSession buffers early audio frames and exposes a future that
+resolves to the session once it runs, so handlers never poll for it.
+"""
+import concurrent.futures
+import itertools
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Callable, Dict, Set
+
+from interviewai import LoggerMixed
+from interviewai.firebase import get_user_payment
+from interviewai.user_manager.credits_manager import UserPaymentStatus
+
+logger = LoggerMixed(__name__)
+
+ADMISSION_WORKERS = int(os.environ.get("ADMISSION_WORKERS", 8))
+ADMISSION_MAX_STARTUPS = int(os.environ.get("ADMISSION_MAX_STARTUPS", 8))
+PENDING_AUDIO_MAX_FRAMES = 500  # early frames kept per starting session, oldest are dropped
+
+TIER_PRIORITY = {
+    UserPaymentStatus.ADMIN: 0,
+    UserPaymentStatus.PAID: 1,
+    UserPaymentStatus.FREE: 2,
+}
+
+
+def get_payment_status(user_id: str) -> UserPaymentStatus:
+    """
+    Payment tier without creating the payment document, unknown users are FREE.
+    """
+    try:
+        status = get_user_payment(user_id).get().get("payment_status")
+        return UserPaymentStatus(status) if status else UserPaymentStatus.FREE
+    except Exception as e:
+        logger.error(f"failed to get payment status, admitting as free: {e}", user_id=user_id)
+        return UserPaymentStatus.FREE
+
+
+class PendingSession:
+    """
+    Readiness of a session being started: `future` resolves to the InterviewSession (or its startup error),
+    frames offered before that are replayed into the session, in order, right before it resolves.
+    """
+
+    def __init__(self, max_frames: int = PENDING_AUDIO_MAX_FRAMES):
+        self.future = concurrent.futures.Future()
+        self.frames = deque(maxlen=max_frames)
+        self.lock = threading.Lock()
+
+    def offer(self, frame) -> bool:
+        """
+        Buffer an audio frame, returns False once the session is ready and frames should go to it directly.
+        """
+        with self.lock:
+            if self.future.done():
+                return False
+            self.frames.append(frame)
+            return True
+
+    def resolve(self, interview_session):
+        with self.lock:
+            while self.frames:
+                interview_session.feed_audio(self.frames.popleft())
+            self.future.set_result(interview_session)
+
+    def fail(self, error: Exception):
+        with self.lock:
+            self.frames.clear()
+            self.future.set_exception(error)
+
+
+class TierStats:
+    def __init__(self):
+        self.queued = 0
+        self.admitted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "avg_wait_ms": int(self.total_wait * 1000 / self.admitted) if self.admitted else 0,
+            "max_wait_ms": int(self.max_wait * 1000),
+        }
+
+
+class SessionAdmissionScheduler:
+    def __init__(
+            self,
+            start_session: Callable[[str], None],
+            workers: int = ADMISSION_WORKERS,
+            max_startups: int = ADMISSION_MAX_STARTUPS,
+    ) -> None:
+        self.start_session = start_session
+        self.workers = workers
+        self.queue = queue.PriorityQueue()  # (priority, seq, user_id, tier, enqueued_at)
+        self.seq = itertools.count()
+        self.startup_slots = threading.BoundedSemaphore(max_startups)
+        self.lock = threading.Lock()
+        self.pending: Set[str] = set()  # queued or starting user ids
+        self.stats_by_tier: Dict[UserPaymentStatus, TierStats] = {tier: TierStats() for tier in TIER_PRIORITY}
+
+    def start(self):
+        for _ in range(self.workers):
+            t = threading.Thread(target=self.run, args=(), daemon=True)
+            t.start()
+
+    def submit(self, user_id: str, tier: UserPaymentStatus = None) -> bool:
+        """
+        Queue a session startup for user_id, returns False if one is already queued or starting.
+        """
+        with self.lock:
+            if user_id in self.pending:
+                return False
+            self.pending.add(user_id)
+        if tier is None:
+            tier = get_payment_status(user_id)
+        with self.lock:
+            self.stats_by_tier[tier].queued += 1
+        self.queue.put((TIER_PRIORITY[tier], next(self.seq), user_id, tier, time.monotonic()))
+        logger.info(f"session startup queued, tier: {tier.value}, queue size: {self.queue.qsize()}",
+                    user_id=user_id)
+        return True
+
+    def run(self):
+        while True:
+            # take a startup slot first so the next dequeue always sees the highest priority waiting
+            self.startup_slots.acquire()
+            try:
+                _, _, user_id, tier, enqueued_at = self.queue.get()
+                wait = time.monotonic() - enqueued_at
+                with self.lock:
+                    stats = self.stats_by_tier[tier]
+                    stats.queued -= 1
+                    stats.admitted += 1
+                    stats.total_wait += wait
+                    stats.max_wait = max(stats.max_wait, wait)
+                logger.info(f"session startup admitted, tier: {tier.value}, queue wait: {wait * 1000:.0f}ms",
+                            user_id=user_id)
+                try:
+                    self.start_session(user_id)
+                except Exception as e:
+                    logger.error(f"failed to start session: {e} \n {traceback.format_exc()}", user_id=user_id)
+                finally:
+                    with self.lock:
+                        self.pending.discard(user_id)
+            finally:
+                self.startup_slots.release()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {tier.value: stats.to_dict() for tier, stats in self.stats_by_tier.items()}
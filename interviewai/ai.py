@@ -1,26 +1,32 @@
+import asyncio
+import concurrent.futures
 import datetime
 import json
-import queue
+import os
 import threading
 import time
 import uuid
+from typing import Callable, List, Optional, Tuple
 
-from dateutil import tz
-from flask_socketio import SocketIO
 from google.api_core.datetime_helpers import DatetimeWithNanoseconds
 from interviewai.user_manager.user_preference import UserSettings
 from langchain.schema import ChatMessage
 
 from interviewai import LoggerMixed
+from interviewai.chains.base_chain import LLM_WAIT_MARGIN
 from interviewai.chains.chain_manager import ChainManager
+from interviewai.chains.context import TurnContextCache
+from interviewai.chains.generation import Generation, GenerationCancelled, Speculation, is_preemptible
+from interviewai.chains.llm_stream import LLM_TOTAL_DEADLINE
+from interviewai.emit_gateway import EmitGateway
+from interviewai.chat_history import CHAT_HISTORY_WRITER, load_chat_history
 from interviewai.firebase import (
-    get_fs_client,
-    insert_chat_history,
+    CachedSessionDocument,
     get_user_preference,
 )
 from interviewai.speech.dg import DGTranscriber
 from interviewai.tools.cost_calculator import GlobalCostCalculator
-from interviewai.tools.data_structure import ChatHistoryQueue
+from interviewai.tools.worker_pool import LLM_WORKER_POOL, SESSION_WORKER_POOL, PoolEvent, SessionTaskQueue
 from interviewai.tools.util import get_interview_room
 from interviewai.transcriber import (
     Role,
@@ -29,8 +35,16 @@ from interviewai.transcriber import (
     TranscribeAssembler,
     Transcript,
 )
+from interviewai.user_manager.credit_meter import CREDIT_METER
 from interviewai.user_manager.credits_manager import CreditsManager, UserPaymentStatus
 
+SESSION_LIMITS = {
+    UserPaymentStatus.PAID: 60 * 60 * 2,  # 2 hours
+    UserPaymentStatus.FREE: 60 * 30,  # 30 minutes
+}  # seconds, no limit for the others (ADMIN)
+SESSION_STOP_TIMEOUT = 10  # seconds stop waits for each pool to finish the running tasks of the session
+CHAT_RESYNC_PAGE_SIZE = int(os.environ.get("CHAT_RESYNC_PAGE_SIZE", 50))  # chat history entries per chat_resync event
+
 
 class InterviewSession:
     """
@@ -48,10 +62,11 @@ class InterviewSession:
     interview_session.chat_bytes(message)
     """
 
-    sio: SocketIO
+    sio: EmitGateway
 
     def __init__(
-            self, user_id: str, interview_session_id: str, sio: SocketIO, user_settings: UserSettings, debug=False
+            self, user_id: str, interview_session_id: str, sio: EmitGateway, user_settings: UserSettings, debug=False,
+            loop: asyncio.AbstractEventLoop = None, on_activated: Callable[["InterviewSession"], None] = None,
     ) -> None:
         self.logger = LoggerMixed(
             __name__,
@@ -62,93 +77,100 @@ class InterviewSession:
         self.user_id = user_id
         self.interview_session_id = interview_session_id
         self.user_settings = user_settings  # user settings
+        # loop DG runs on: server loop in asyncio server mode, the shared DG loop thread in threading mode
+        self.loop = loop
+        # session document (type, programming language, ...), served from memory on hot paths
+        self.session_doc = CachedSessionDocument(user_id, interview_session_id)
 
         # First step initialize the Deepgram
         self.dg: DGTranscriber = None
-        self.transcribe_queue = queue.Queue()  # Deepgram text will be queued in transcribe_queue and further processed by the chat_history_queue
-        self.chat_history_queue = ChatHistoryQueue(user_id,
-                                                   interview_session_id)  # queue on all conversation (interviewer, interviewee, AI) chat history
+        # background work of the session runs as tasks on the shared worker pool, one lane per kind of work
+        self.pool = SESSION_WORKER_POOL
+        # answers (and memory summaries) wait on the LLM, their lanes run on a pool of their own
+        self.llm_pool = LLM_WORKER_POOL
+        # queue on all conversation (interviewer, interviewee, AI) chat history, emitted and persisted on "history"
+        self.chat_history_queue = SessionTaskQueue(self.pool, interview_session_id, "history", self.emit_chat_history)
 
         # Trancsriber assembler: Get the deepgram text from the transcribe queue and put it in the chat history queue then trigger the transcriber changed event
         self.transcriber = (
             TranscribeAssembler(chat_history_queue=self.chat_history_queue, user_settings=self.user_settings,
                                 logger=self.logger))
-        # Responder 
+        # Deepgram text will be queued in transcribe_queue and further processed by the transcriber
+        self.transcribe_queue = SessionTaskQueue(
+            self.pool, interview_session_id, "transcribe", self.transcriber.process_transcript
+        )
+        # contexts of a transcript turn, computed once for the responder and the coach responder
+        self.turn_contexts = TurnContextCache()
+        # Responder, triggered by the changed events of the transcriber
         if self.interview_type not in [InterviewType.MOCK, InterviewType.COACH]:
             self.responder = GPTResponder(self, responder_type=ResponderType.RESPOND_INTERVIEWER)
+            self.transcriber.respond_interviewer_changed_event = PoolEvent(
+                self.llm_pool, interview_session_id, "respond", self.responder.respond, on_set=self.responder.preempt
+            )
         # if mock interview, no need for coach responder
         if self.interview_type not in [InterviewType.GENERAL, InterviewType.CODING]:
             self.coach_responder = CoachResponder(self, responder_type=ResponderType.RESPOND_INTERVIEWEE)
+            self.transcriber.respond_interviewee_changed_event = PoolEvent(
+                self.llm_pool, interview_session_id, "coach", self.coach_responder.respond, on_set=self.coach_responder.preempt
+            )
         # billing and credit manager
         self.cm = CreditsManager(user_id)
         self.credit_consumption = 0
-        # Thread events
+        # set once the session is stopped / once credits are metered (first AI response)
         self.stop_event = threading.Event()
         self.start_event = threading.Event()
-        # Conditionally to stop the credit deductor thread
-        self.condition = threading.Condition()
-        # Threads
-        self.transcribe_thread: threading.Thread
-        if self.interview_type not in [InterviewType.MOCK, InterviewType.COACH]:
-            self.responder_thread: threading.Thread
-        if self.interview_type not in [InterviewType.GENERAL, InterviewType.CODING]:
-            self.coach_responder_thread: threading.Thread
-        self.history_generator: threading.Thread
+        # only without a shared DG loop (standalone use)
         self.audio_transcriber_thread: threading.Thread
-        self.credit_deductor_thread: threading.Thread
         self._ready = False
         # type: google.api_core.datetime_helpers.DatetimeWithNanoseconds
         self.activated_timestamp: DatetimeWithNanoseconds = None
+        # read with activated_timestamp in _load_fs_data, the session limit is derived from both
+        self.payment_status: UserPaymentStatus = None
+        self.on_activated = on_activated
+        # set when the session was restored from a drain snapshot (see restore)
+        self.memory_restored = False
+        # chat history of the session as emitted, entry seq = index. loaded once by _load_fs_data, then appended by
+        # emit_chat_history, reconnecting clients are resynced from it (see resync)
+        self.history: List[dict] = []
+        self.history_loaded = False
+        self.history_lock = threading.Lock()
 
     @property
     def interview_type(self) -> InterviewType:
-        fs = get_fs_client()
-        ref = (
-            fs.collection("users")
-            .document(self.user_id)
-            .collection("sessions")
-            .document(self.interview_session_id)
-        )
-        doc_snapshot = ref.get()
-        if doc_snapshot.exists and "type" in doc_snapshot.to_dict():
-            return InterviewType[doc_snapshot.get("type").upper()]
+        data = self.session_doc.get()
+        if "type" in data:
+            return InterviewType[data["type"].upper()]
         return InterviewType.GENERAL
 
     @property
     def programming_language(self) -> str:
-        fs = get_fs_client()
-        ref = (
-            fs.collection("users")
-            .document(self.user_id)
-            .collection("sessions")
-            .document(self.interview_session_id)
-        )
-        doc_snapshot = ref.get()
-        if doc_snapshot.exists and "programming_language" in doc_snapshot.to_dict():
-            obj = doc_snapshot.get("programming_language")
+        data = self.session_doc.get()
+        if "programming_language" in data:
+            obj = data["programming_language"]
             if "lan" in obj:
                 return obj["lan"]
         return "Python"
 
     @property
-    def long_running(self) -> bool:
-        # if interview session is running over 2 hours.
+    def limit_deadline(self) -> Optional[float]:
+        """
+        Epoch seconds at which the session exceeds the limit of the user's tier, None if it has no limit.
+        """
         if self.activated_timestamp == None:
-            return False
-        now = datetime.datetime.now(tz.tzlocal())
-        memeber_session_limit = 60 * 60 * 2  # 2 hours
-        non_member_session_limit = 60 * 30  # 30 minutes
-        #testing = 60  # 1 minutes
-        if self.cm.payment_status == UserPaymentStatus.PAID:
-            long_running = (now - self.activated_timestamp).total_seconds() > memeber_session_limit
-        elif self.cm.payment_status == UserPaymentStatus.FREE:
-            long_running = (now - self.activated_timestamp).total_seconds() > non_member_session_limit
-        else:
-            long_running = False
+            return None
+        limit = SESSION_LIMITS.get(self.payment_status)
+        if limit is None:
+            return None
+        return self.activated_timestamp.timestamp() + limit
 
+    @property
+    def long_running(self) -> bool:
+        # if interview session is running over its tier's limit (2 hours for members, 30 minutes otherwise).
+        deadline = self.limit_deadline
+        long_running = deadline is not None and time.time() > deadline
         if long_running:
             self.logger.debug(
-                f"Long running interview session detected. Activated timestamp: {self.activated_timestamp}. Now: {now}",
+                f"Long running interview session detected. Activated timestamp: {self.activated_timestamp}.",
                 user_id=self.user_id,
                 interview_session_id=self.interview_session_id,
             )
@@ -180,9 +202,7 @@ class InterviewSession:
             self.logger.info(f"paused: {value}")
 
     def load_fs_data(self):
-        t = threading.Thread(target=self._load_fs_data)
-        t.daemon = True
-        t.start()
+        self.pool.submit(self.interview_session_id, "load_fs", self._load_fs_data)
 
     def _load_fs_data(self):
         """
@@ -190,72 +210,126 @@ class InterviewSession:
         Recover persisted data including:
         * chat history
         """
-        fs = get_fs_client()
-        ref = (
-            fs.collection("users")
-            .document(self.user_id)
-            .collection("sessions")
-            .document(self.interview_session_id)
-            .get()
-        )
-        self.activated_timestamp = ref.get("activated_timestamp")
+        # explicit read, the listener may not have delivered the latest requests yet
+        data = self.session_doc.refresh()
+        self.activated_timestamp = data.get("activated_timestamp")
+        self.payment_status = self.cm.payment_status
+        if self.on_activated:
+            self.on_activated(self)
         GlobalCostCalculator.store_timestamp(self.user_id, self.interview_session_id)
-        data = ref.get("requests")
-        transcripts = []
-        for transcript in data:
-            json_object = json.loads(transcript)
-
-            transcripts.append(
-                json.loads(
+        # under the lock, entries emitted while loading are either in the writer's pending or appended after
+        with self.history_lock:
+            transcripts = []
+            for transcript in load_chat_history(self.user_id, self.interview_session_id, data):
+                json_object = json.loads(transcript)
+                role = Role[json_object["role"].upper()]
+                entry = json.loads(
                     Transcript(
-                        role=Role[json_object["role"].upper()],
+                        role=role,
                         transcript=json_object["transcript"],
                         timestamp=json_object["timestamp"],
                         request_id=json_object["request_id"],
                     ).json()
                 )
-            )
+                entry["seq"] = len(transcripts)
+                transcripts.append(entry)
 
-            if self.transcriber.memory:
-                role = Role[json_object["role"].upper()]
-                if role != Role.AI and role != Role.AI_COACH:
-                    self.transcriber.memory.chat_memory.add_message(
-                        ChatMessage(role=role.value, content=json_object["transcript"])
-                    )
+                if self.transcriber.memory and not self.memory_restored:
+                    if role != Role.AI and role != Role.AI_COACH:
+                        self.transcriber.add_message(
+                            ChatMessage(role=role.value, content=json_object["transcript"])
+                        )
+            self.history = transcripts
+            self.history_loaded = True
         self.sio.emit(
             "chat_persisted",
             transcripts,
             room=get_interview_room(self.user_id),
         )
-        # memory buffer related logic
-        if self.transcriber.memory:
-            curr_buffer_length = (
-                self.transcriber.memory.llm.get_num_tokens_from_messages(self.transcriber.memory.chat_memory.messages))
+        # memory buffer related logic, a memory restored from a snapshot is already pruned and summarized
+        if self.transcriber.memory and not self.memory_restored:
+            curr_buffer_length = self.transcriber.memory_tokens
             self.logger.info(f"conversation buffer token before pruning: {curr_buffer_length}")
 
             if curr_buffer_length > self.transcriber.token_limit:
                 self.logger.info(
                     f"Exceeding token limit {self.transcriber.token_limit}, throwing away old messages before send to llm")
-                discarded = 0
-                while curr_buffer_length > self.transcriber.token_limit:
-                    self.transcriber.memory.chat_memory.pop(0)
-                    curr_buffer_length = (
-                        self.transcriber.memory.llm.get_num_tokens_from_messages(
-                            self.transcriber.memory.chat_memory.messages
-                        )
-                    )
-                    discarded += 1
+                discarded = len(self.transcriber.trim_memory(self.transcriber.token_limit))
                 self.logger.info(f"Discarded {discarded} messages")
-            self.transcriber.memory.prune()
+            self.transcriber.prune_memory()
             self.logger.info(f"Memory pruned: {self.transcriber.memory.moving_summary_buffer}")
 
+    def resync(self, client_id: str, last_seq: Optional[int] = None, last_request_id: Optional[str] = None):
+        """
+        Bring a client reconnecting to the running session up to date, after the initial load if it's still running.
+        """
+        self.pool.submit(self.interview_session_id, "load_fs", self._resync, client_id, last_seq, last_request_id)
+
+    def _resync(self, client_id: str, last_seq: Optional[int], last_request_id: Optional[str]):
+        """
+        Send a reconnecting client the chat history entries it missed, from memory: no firestore read of the history
+        and no rebuild of the conversation memory, the session already holds both.
+        A client naming the last entry it has (seq, or request_id) gets the tail after it in chat_resync pages,
+        the others (or an unknown entry) get the whole history in one chat_persisted, like on a fresh load.
+        """
+        if not self.history_loaded:
+            # initial load failed, load it now
+            self._load_fs_data()
+            return
+        # cached document, kept current by its listener
+        activated_timestamp = self.session_doc.get().get("activated_timestamp")
+        if activated_timestamp != self.activated_timestamp:
+            self.activated_timestamp = activated_timestamp
+            if self.on_activated:
+                self.on_activated(self)
+        with self.history_lock:
+            start = self._resume_index(last_seq, last_request_id)
+            entries = self.history[start:] if start is not None else list(self.history)
+            total = len(self.history)
+        if start is None:
+            self.sio.emit("chat_persisted", entries, to=client_id)
+            self.logger.info(f"full chat history resync of client {client_id}: {len(entries)} entries")
+            return
+        # at least one page, an up to date client learns it missed nothing
+        offsets = range(0, max(len(entries), 1), CHAT_RESYNC_PAGE_SIZE)
+        for i in offsets:
+            self.sio.emit(
+                "chat_resync",
+                {
+                    "from_seq": start + i,
+                    "entries": entries[i:i + CHAT_RESYNC_PAGE_SIZE],
+                    "total": total,
+                    "last": i == offsets[-1],
+                },
+                to=client_id,
+            )
+        self.logger.info(f"delta chat history resync of client {client_id}: {len(entries)} entries from seq {start}")
+
+    def _resume_index(self, last_seq: Optional[int], last_request_id: Optional[str]) -> Optional[int]:
+        # caller holds history_lock. index of the first entry the client is missing, None when unknown
+        if isinstance(last_seq, int) and -1 <= last_seq < len(self.history):
+            return last_seq + 1
+        if last_request_id:
+            # AI answers share the request_id of their question: resend from its first entry on, the client
+            # dedupes by seq, an entry it may not have is never skipped
+            for i, entry in enumerate(self.history):
+                if entry.get("request_id") == last_request_id:
+                    return i + 1
+        return None
+
     def set_dg(self, dg: DGTranscriber):
         self.dg = dg
-        self.transcribe_queue = dg.sentence_splitter.transcribe_queue
+        dg.sentence_splitter.transcribe_queue = self.transcribe_queue
+        if self.user_settings.speculative_answers and hasattr(self, "responder"):
+            dg.sentence_splitter.speculate = self.responder.speculate
 
     def keep_asr_alive(self, init_queue=True):
         if self.dg.running == False:
             if self.dg != None:
+                if self.loop is not None:
+                    # DG sender runs as a task on the shared loop (server loop or shared DG loop thread)
+                    self.dg.run_dg_on_loop(self.loop, init_queue)
+                    return
                 self.audio_transcriber_thread = threading.Thread(
                     target=self.dg.run_dg, args=(init_queue,)
                 )
@@ -265,35 +339,11 @@ class InterviewSession:
                 raise Exception("DGTranscriber not set")
 
     def run(self):
-        # start all threads
-        self.transcribe_thread = threading.Thread(
-            target=self.transcriber.process_streamed_transcripts,
-            args=(
-                self.transcribe_queue,
-                self.stop_event,
-            ),
+        # nothing to start, the work of the session is submitted to the shared worker pool as it comes
+        self.logger.info(
+            f"interview session running on the shared worker pools ({self.pool.workers} workers, "
+            f"{self.llm_pool.workers} for answers)"
         )
-        self.transcribe_thread.daemon = True
-        self.transcribe_thread.start()
-        # Notice the comma after self.stop_event in each instance, making it a single-element tuple:
-        if self.interview_type not in [InterviewType.MOCK, InterviewType.COACH]:
-            self.responder_thread = threading.Thread(target=self.responder.respond_to_transcriber,
-                                                     args=(self.stop_event,))
-            self.responder_thread.daemon = True
-            self.responder_thread.start()
-        if self.interview_type not in [InterviewType.GENERAL, InterviewType.CODING]:
-            self.coach_responder_thread = threading.Thread(target=self.coach_responder.respond_to_transcriber,
-                                                           args=(self.stop_event,))
-            self.coach_responder_thread.daemon = True
-            self.coach_responder_thread.start()
-        self.history_generator = threading.Thread(target=self.chat_history_generator, args=(self.stop_event,))
-        self.history_generator.daemon = True
-        self.history_generator.start()
-
-        self.credit_deductor_thread = threading.Thread(target=self.credit_deductor,
-                                                       args=(self.start_event, self.stop_event, self.condition))
-        self.credit_deductor_thread.daemon = True
-        self.credit_deductor_thread.start()
 
     def chat(self, message):
         self.transcribe_queue.put(
@@ -312,100 +362,211 @@ class InterviewSession:
             role = Role(channel["role"])
             input_data = channel["bytes"]
             if role == Role.INTERVIEWEE:
-                self.dg.audio_queue_mic.put_nowait(input_data)
+                self.dg.feed_audio(input_data, self.dg.audio_queue_mic)
             elif role == Role.INTERVIEWER:
-                self.dg.audio_queue_speaker.put_nowait(input_data)
+                self.dg.feed_audio(input_data, self.dg.audio_queue_speaker)
 
     def chat_bytes_dual_channel(self, message):
-        # if it is in InterviewType.MOCK
-        if self.dg and self.dg.running and self.interview_type != InterviewType.MOCK:
-            self.dg.dual_channel_queue.put_nowait(message["bytes"])
+        self.feed_audio(message["bytes"])
+
+    def feed_audio(self, frame):
+        """
+        Hand a dual channel PCM frame (bytes or memoryview) to DG. Used by the socket.io event and by the
+        binary audio endpoint (interviewai/speech/audio_ingest.py).
+        """
+        # if it is in InterviewType.MOCK. dg.is_dual_channel is derived from the interview type when DG is created,
+        # use it instead of self.interview_type so the audio path never hits firestore.
+        # while DG is (re)connecting frames wait in its bounded buffer, only a terminated DG drops them
+        if self.dg and not self.dg.terminated and self.dg.is_dual_channel:
+            self.dg.feed_audio(frame)
         else:
             self.logger.debug(
-                f"DGTranscriber not set or not running. DG: {self.dg}. Running State: {self.dg.running if self.dg else False}"
+                f"DGTranscriber not set or terminated. DG: {self.dg}. Running State: {self.dg.running if self.dg else False}"
             )
 
-    def chat_history_generator(self, stop_event: threading.Event):
+    def next_question(self):
         """
-        Chat response generator thread, will emit AI, interviewer and interviewee.
+        Send next question to the interviewer, incase user press next question before dg complete
+        transcript. The temp sentence contains all the transcript before sending it to AI. Then after
+        we send the message to AI, we reset the temp sentence.
         """
-        while not stop_event.is_set():
-            empty_count = 0
-            try:
-                chat_history: Transcript = self.chat_history_queue.get_nowait()
-                self.sio.emit(
-                    "chat_history",
-                    json.loads(chat_history.json()),
-                    room=get_interview_room(self.user_id),
-                )
-                insert_chat_history(
-                    self.user_id, self.interview_session_id, chat_history
+        if self.dg is None:
+            self.logger.debug(f"DG is not ready for user {self.user_id}")
+            return
+        if self.transcriber:
+            transcript = Transcript(
+                role=Role.INTERVIEWEE,
+                transcript=self.dg.sentence_splitter.interviewee_temp_sentence,
+                timestamp=datetime.datetime.now(),
+                request_id=uuid.uuid4().hex,
+            )
+            self.transcriber.transcript_data[Role.INTERVIEWEE].insert(0, transcript)
+            self.dg.sentence_splitter.reset_temp_sentences(Role.INTERVIEWEE)
+        self.transcriber.respond_interviewee_changed_event.set()
+
+    def solve(self, message):
+        """
+        Create coding solution based on the current interview session's context
+        {
+            context: {
+                "image": "base64 encoded image",
+                "selected_text": "selected text",
+            }
+        }
+        """
+        chain = self.responder.chain
+        self.cm.deduct_credit(InterviewType.ONE_TIME_IMAGE)
+        self.credit_consumption += self.cm.cost_map[InterviewType.ONE_TIME_IMAGE]
+        self.start_metering()
+        if "context" in message:
+            if "image" in message["context"]:
+                base64_image = message["context"]["image"]
+                response = chain.predict_image(base64_image, self.sio)
+                self.transcriber.save_conversation(Role.IMAGE_CONTEXT, response)
+                self.transcriber.chat_history_queue.put(
+                    Transcript(
+                        role=Role.AI,
+                        transcript=response,
+                        timestamp=datetime.datetime.now(),
+                        request_id=uuid.uuid4().hex,
+                    )
                 )
-            except queue.Empty:
-                empty_count += 1  # Increment the count when the queue is empty
-                sleep_time = min(
-                    1.0, empty_count * 0.01
-                )  # Increase the sleep time up to a maximum of 1 second
-                time.sleep(sleep_time)
-                continue
-        self.logger.info("chat_history_generator thread ended...")
-
-    # Main credit deductor function
-    def credit_deductor(self, start_event: threading.Event, stop_event: threading.Event,
-                        condition: threading.Condition):
-        """
-        Main Deductor thread, will deduct credit if notificed by the condition. 
-        condition.wait will wait for 60 secs and constantly check if notified.
-        """
-        self.logger.info("Credit deductor thread started...")
-        while not stop_event.is_set():
-            if start_event.is_set():
-                with condition:
-                    notified = condition.wait(timeout=60)  # Waits up to 60 seconds for a notification
-                if notified:
-                    break
-                self.logger.info("deducting credit...")
-                # if credit is low, emit a signal to the frontend and force an early stop
-                # Frontend will end the session in 5 seconds and it still didn't stop the backend will end it
-                # Don't use self.stop() here, it will casue problem because frontend will keep sending chat audio bytes
-                if not self.cm.deduct_credit(self.interview_type):
-                    self.sio.emit("force_termination", room=get_interview_room(self.user_id))
-                    time.sleep(60)
-                    self.stop_event.set()
-                else:
-                    self.credit_consumption += self.cm.cost_map[self.interview_type]
-        self.logger.info("Credit deductor thread ended...")
+
+    def emit_chat_history(self, chat_history: Transcript):
+        """
+        Emit AI, interviewer and interviewee chat history, runs in order on the session's "history" lane.
+        """
+        entry = json.loads(chat_history.json())
+        with self.history_lock:
+            if self.history_loaded:
+                entry["seq"] = len(self.history)
+                self.history.append(entry)
+            # write-behind, persisted in batches by the chat history writer
+            CHAT_HISTORY_WRITER.append(self.user_id, self.interview_session_id, chat_history)
+        self.sio.emit(
+            "chat_history",
+            entry,
+            room=get_interview_room(self.user_id),
+        )
+
+    def start_metering(self):
+        """
+        Credits are deducted every minute from the first AI response on, by the process-wide credit meter.
+        """
+        if self.start_event.is_set():
+            return
+        self.start_event.set()
+        CREDIT_METER.add(self)
+
+    def on_credit_charged(self, cost: int):
+        self.credit_consumption += cost
+
+    def on_out_of_credit(self):
+        # if credit is low, emit a signal to the frontend and force an early stop
+        # Frontend will end the session in 5 seconds and it still didn't stop the backend will end it
+        # Don't use self.stop() here, it will casue problem because frontend will keep sending chat audio bytes
+        self.sio.emit("force_termination", room=get_interview_room(self.user_id))
+        self.pool.submit_after(60, self.interview_session_id, "credit", self.stop_event.set)
 
     def stop_credit_deductor(self):
         """
-        stop the credit deductor thread
+        stop charging the session (until the next AI response)
+        """
+        CREDIT_METER.remove(self.interview_session_id)
+        self.start_event.clear()
+
+    def snapshot(self) -> dict:
+        """
+        Compact state of the session for a drain, restored by another worker with restore.
+        Credits are tracked by stop(), the credit consumption is not carried over.
+        """
+        GlobalCostCalculator.update_session_cost(self.user_id, self.interview_session_id)
+        memory = self.transcriber.memory
+        return {
+            "user_id": self.user_id,
+            "interview_session_id": self.interview_session_id,
+            "paused": self.transcriber.paused,
+            "transcript_data": {
+                role.value: [json.loads(transcript.json()) for transcript in transcripts]
+                for role, transcripts in self.transcriber.transcript_data.items()
+            },
+            "memory": {
+                "moving_summary_buffer": memory.moving_summary_buffer,
+                "messages": [
+                    {"role": getattr(message, "role", message.type), "content": message.content}
+                    for message in memory.chat_memory.messages
+                ],
+            } if memory else None,
+            "cost": GlobalCostCalculator.get_session_info(self.user_id, self.interview_session_id),
+            "chains": {
+                name: getattr(self, name).chain_type
+                for name in ("responder", "coach_responder")
+                if hasattr(self, name)
+            },
+        }
+
+    def restore(self, snapshot: dict):
         """
-        with self.condition:
-            self.condition.notify()
+        Restore the in-memory state saved by snapshot (on another worker) before the session runs.
+        """
+        self.transcriber.paused = snapshot["paused"]
+        for role, transcripts in snapshot["transcript_data"].items():
+            self.transcriber.transcript_data[Role(role)] = [Transcript(**transcript) for transcript in transcripts]
+        memory = snapshot["memory"]
+        if memory and self.transcriber.memory:
+            self.transcriber.memory.moving_summary_buffer = memory["moving_summary_buffer"]
+            for message in memory["messages"]:
+                self.transcriber.add_message(ChatMessage(role=message["role"], content=message["content"]))
+            self.memory_restored = True
+        if snapshot["cost"]:
+            GlobalCostCalculator.restore_session_cost(self.user_id, self.interview_session_id, snapshot["cost"])
+        for name, chain_type in snapshot["chains"].items():
+            responder = getattr(self, name, None)
+            if responder is not None and responder.chain_type != chain_type:
+                responder.update_chain(chain_type)
+        self.logger.info(f"interview session restored from snapshot of worker {snapshot.get('worker_id')}")
 
     def stop(self):
         self.logger.debug(
-            f"Stopping all threads... Current self ref: {self}",
+            f"Stopping all tasks... Current self ref: {self}",
             user_id=self.user_id,
             interview_session_id=self.interview_session_id,
         )
         # Track total credit consumption remeber to put negative sign
         self.cm.track_transaction(amount=-self.credit_consumption, transaction_type=self.interview_type.value)
-        # stop all threads
+        # stop all work of the session
         self.stop_event.set()
+        self.stop_credit_deductor()
         # TODO stop logic is wrong, rewrite
         if self.dg:
             self.dg.set_terminated(True)
-        self.transcribe_thread.join()
-        self.credit_deductor_thread.join()
-        if self.interview_type not in [InterviewType.MOCK, InterviewType.COACH]:
-            self.responder_thread.join()
-        if self.interview_type not in [InterviewType.GENERAL, InterviewType.CODING]:
-            self.coach_responder_thread.join()
-        self.history_generator.join()
+        for name in ("responder", "coach_responder"):
+            responder = getattr(self, name, None)
+            if responder is not None:
+                responder.discard_speculation()
+                # in-flight answers end now instead of at their deadline
+                generation = responder.generation
+                if generation is not None:
+                    generation.cancel()
+        # pending work is dropped, except the chat history still to emit and persist. running tasks finish, waited for
+        # a bounded time: a stuck task doesn't hold the caller (end_session, the drain)
+        self.pool.cancel(self.interview_session_id, keep=("history",))
+        self.llm_pool.cancel(self.interview_session_id)
+        for pool in (self.llm_pool, self.pool):
+            if not pool.wait_idle(self.interview_session_id, timeout=SESSION_STOP_TIMEOUT):
+                self.logger.error(
+                    f"tasks of the session still running on the {pool.name} pool after {SESSION_STOP_TIMEOUT}s",
+                    user_id=self.user_id,
+                    interview_session_id=self.interview_session_id,
+                )
+        CHAT_HISTORY_WRITER.close(self.user_id, self.interview_session_id)
+        self.session_doc.close()
+        self.logger.info(
+            f"turn contexts: {self.turn_contexts.misses} computed, {self.turn_contexts.hits} shared between responders"
+        )
         # no need to join DG thread. async io would do CPU damage.
         self.logger.debug(
-            f"All threads stopped. Current self ref: {self}",
+            f"All tasks stopped. Current self ref: {self}",
             user_id=self.user_id,
             interview_session_id=self.interview_session_id,
         )
@@ -417,9 +578,16 @@ class GPTResponder:
         self.sio = interview_session.sio
         self.transcriber = interview_session.transcriber
         self.response_interval = 2  # pause in between each transcript + LLM api call
+        self.next_response_at = 0.0
+        # in-flight answer, cancelled by a newer question when the chain type is preemptible
+        self.generation: Optional[Generation] = None
+        # answer started on the interim transcript of a question (speculative answers), see speculate
+        self.speculation: Optional[Speculation] = None
+        self.speculation_lock = threading.Lock()
         self.cm = ChainManager(self.sio, self.logger)
         self.credit_manager = CreditsManager(self.logger.user_id)
         self.interview_session = interview_session
+        self.responder_type = responder_type
         # TODO: Caesar refactor this to use the user_settings
         self.system_responder_chain = self.interview_session.user_settings.system_responder_chain
         self.user_defined_chain = self.interview_session.user_settings.user_responder_chain
@@ -443,6 +611,10 @@ class GPTResponder:
         self.chain_type = chain_type
         self.chain = self.cm.new_chain(chain_type, transcribe_assembler=self.transcriber,
                                        user_settings=self.interview_session.user_settings)
+        self.chain.turn_contexts = self.interview_session.turn_contexts
+        # answers to the interviewer's questions recur across interviews, the coach's depend on the interviewee
+        if self.responder_type == ResponderType.RESPOND_INTERVIEWER:
+            self.chain.answer_scope = (self.logger.user_id, chain_type)
 
         self.logger.info(f"Updating AI Responder chain to {chain_type}")
         GlobalCostCalculator.update_chain_type(
@@ -455,141 +627,234 @@ class GPTResponder:
         """
 
         def _prune():
-            curr_buffer_length = (
-                self.transcriber.memory.llm.get_num_tokens_from_messages(
-                    self.transcriber.memory.chat_memory.messages
-                )
-            )
+            curr_buffer_length = self.transcriber.memory_tokens
             if curr_buffer_length > self.transcriber.memory.max_token_limit:
                 self.logger.debug(
                     f"conversation buffer token before pruning: {curr_buffer_length}, max_token_limit: {self.transcriber.memory.max_token_limit}"
                 )
-            # this call utilize `chain.predict` which might be unstable and slow
-            self.transcriber.memory.prune()
+            self.transcriber.prune_memory()
             if (
                     len(self.transcriber.memory.moving_summary_buffer)
                     > self.transcriber.memory.max_token_limit
             ):
-                self.transcriber.memory.clear()
+                self.transcriber.clear_memory()
                 self.logger.debug(
                     f"force clear memory buffer due to exceeding max_token_limit, limit: {self.transcriber.memory.max_token_limit}"
                 )
 
-        # run it in non-blocking way
-        t = threading.Thread(target=_prune)
-        t.daemon = True
-        t.start()
-
-    def respond_to_transcriber(self, stop_event: threading.Event):
-        while not stop_event.is_set():
-            if self.transcriber.respond_interviewer_changed_event.is_set():
-                # if the start event is not set, set it once
-                if not self.interview_session.start_event.is_set():
-                    self.interview_session.start_event.set()
-                self.sio.emit(
-                    "busy_status", True, room=get_interview_room(self.logger.user_id)
-                )
-                # transcripte updated, so we should generate new transribed block conversation context.
-                start_time = time.time()
-                self.transcriber.respond_interviewer_changed_event.clear()
-                question, request_id = self.cm.gen_question(
-                    self.chain_type, transcribe_assembler=self.transcriber
-                )
-                self.logger.info(
-                    f"[Question Input]\n {question}",
-                    user_id=self.logger.user_id,
-                    interview_session_id=self.logger.interview_session_id,
-                )
-                # call LLM for inference
-                # response = generate_response_from_transcript(transcript_string)
-                query = f"Current question from {Role.INTERVIEWER.value}: {question}"
-                response = self.chain.run(query)
+        # run it in non-blocking way, one prune at a time per session
+        self.interview_session.llm_pool.submit(self.interview_session.interview_session_id, "prune", _prune)
 
-                self.transcriber.save_conversation(Role.AI, response)
-                self.prune()
+    def preempt(self):
+        """
+        A newer question is coming (its event was just set): cancel the in-flight answer, respond runs next.
+        """
+        generation = self.generation
+        if generation is not None and not generation.cancelled:
+            generation.cancel()
+            self.logger.info(f"in-flight answer of {self.chain_type} cancelled by a newer question")
 
-                # self.logger.debug(f"[AI Response]\n {response}", user_id=self.logger.user_id, interview_session_id=self.logger.interview_session_id)
-                # AI Response
-                self.transcriber.chat_history_queue.put(
-                    Transcript(
-                        role=Role.AI,
-                        transcript=response,
-                        timestamp=datetime.datetime.now(),
-                        request_id=request_id,
-                    )
-                )
-                end_time = time.time()  # Measure end time
-                execution_time = (
-                        end_time - start_time
-                )  # Calculate the time it took to execute the function
-                self.sio.emit(
-                    "busy_status", False, room=get_interview_room(self.logger.user_id)
+    def generate(self, query: str, turn: Tuple[str, str] = None) -> Tuple[str, bool]:
+        """
+        Run the chain on query, returns the answer and whether it was cancelled by a newer question (the answer is
+        then what was streamed until the cancel). turn: (request_id, transcript) answered.
+        """
+        try:
+            return self.chain.run(query, generation=self.generation, turn=turn), False
+        except GenerationCancelled as e:
+            return e.partial, True
+        finally:
+            self.generation = None
+
+    def speculate(self, text: str):
+        """
+        Called by the sentence splitter (DG thread) when the interviewer sentence so far looks like a question:
+        answer it in a hidden generation on the session's "speculate" lane, respond commits or discards it.
+        A speculation on a different text replaces the running one.
+        """
+        session = self.interview_session
+        if session.stop_event.is_set() or self.transcriber.paused:
+            return
+        with self.speculation_lock:
+            current = self.speculation
+            if current is not None and current.matches(text):
+                return
+            speculation = self.speculation = Speculation(text)
+        if current is not None:
+            current.discard()
+        session.llm_pool.submit(session.interview_session_id, "speculate", self._run_speculation, speculation)
+
+    def _run_speculation(self, speculation: Speculation):
+        if speculation.generation.cancelled:
+            speculation.future.set_result(("", True))
+            return
+        self.logger.info(f"[Speculative Question Input]\n {speculation.text}")
+        query = f"Current question from {Role.INTERVIEWER.value}: {speculation.text}"
+        try:
+            speculation.future.set_result((self.chain.run(query, generation=speculation.generation), False))
+        except GenerationCancelled as e:
+            speculation.future.set_result((e.partial, True))
+        except Exception as e:
+            speculation.future.set_exception(e)
+
+    def take_speculation(self, question: str) -> Optional[Speculation]:
+        """
+        The speculation to commit for the final question, a speculation on another text is discarded.
+        """
+        with self.speculation_lock:
+            speculation, self.speculation = self.speculation, None
+        if speculation is None:
+            return None
+        if speculation.matches(question):
+            self.logger.info("speculative answer committed")
+            return speculation
+        speculation.discard()
+        self.logger.info(f"speculative answer discarded, it was started on: {speculation.text}")
+        return None
+
+    def discard_speculation(self):
+        with self.speculation_lock:
+            speculation, self.speculation = self.speculation, None
+        if speculation is not None:
+            speculation.discard()
+
+    def answer(self, question: str, query: str, request_id: str) -> Tuple[str, bool]:
+        """
+        generate, or the speculative answer of the question when one was started on its interim transcript.
+        A speculation that doesn't end within the deadline of an answer (e.g. still queued behind busy workers) is
+        discarded and the question answered again.
+        """
+        speculation = self.take_speculation(question)
+        if speculation is None:
+            return self.generate(query, turn=(request_id, question))
+        pending = self.generation
+        if pending is not None:
+            # a newer question cancels the committed speculation instead (including one that came in meanwhile)
+            self.generation = speculation.generation
+            if pending.cancelled:
+                speculation.generation.cancel()
+        self.chain.reveal_streams(speculation.generation)
+        try:
+            return speculation.future.result(timeout=LLM_TOTAL_DEADLINE + LLM_WAIT_MARGIN)
+        except concurrent.futures.TimeoutError:
+            speculation.discard()
+            self.logger.error("speculative answer timed out, answering again")
+            self.generation = Generation() if pending is not None else None
+            return self.generate(query, turn=(request_id, question))
+        except Exception as e:
+            self.logger.error(f"speculative answer failed, answering again: {e}")
+            self.generation = Generation() if pending is not None else None
+            return self.generate(query, turn=(request_id, question))
+        finally:
+            self.generation = None
+
+    def _throttled(self, event: PoolEvent) -> bool:
+        # keep response_interval between two responses, the event stays set and the response is retried later
+        remaining = self.next_response_at - time.time()
+        if remaining > 0:
+            event.pool.submit_after(remaining, event.session, event.lane, self.respond)
+            return True
+        return False
+
+    def respond(self):
+        """
+        Runs on the session's "respond" lane when the transcriber sets respond_interviewer_changed_event.
+        """
+        event = self.transcriber.respond_interviewer_changed_event
+        if self.interview_session.stop_event.is_set() or self._throttled(event):
+            return
+        self.interview_session.start_metering()
+        self.sio.emit(
+            "busy_status", True, room=get_interview_room(self.logger.user_id)
+        )
+        # transcripte updated, so we should generate new transribed block conversation context.
+        start_time = time.time()
+        # before clearing the event, a question setting it from now on cancels this answer
+        self.generation = Generation() if is_preemptible(self.chain_type) else None
+        event.clear()
+        question, request_id = self.cm.gen_question(
+            self.chain_type, transcribe_assembler=self.transcriber
+        )
+        self.logger.info(
+            f"[Question Input]\n {question}",
+            user_id=self.logger.user_id,
+            interview_session_id=self.logger.interview_session_id,
+        )
+        # call LLM for inference
+        # response = generate_response_from_transcript(transcript_string)
+        query = f"Current question from {Role.INTERVIEWER.value}: {question}"
+        response, cancelled = self.answer(question, query, request_id)
+
+        if not cancelled:
+            self.transcriber.save_conversation(Role.AI, response)
+            self.prune()
+
+        # self.logger.debug(f"[AI Response]\n {response}", user_id=self.logger.user_id, interview_session_id=self.logger.interview_session_id)
+        # AI Response, a cancelled one is kept in the chat history as far as it was streamed
+        if not cancelled or response:
+            self.transcriber.chat_history_queue.put(
+                Transcript(
+                    role=Role.AI,
+                    transcript=response,
+                    timestamp=datetime.datetime.now(),
+                    request_id=request_id,
                 )
+            )
+        self.sio.emit(
+            "busy_status", False, room=get_interview_room(self.logger.user_id)
+        )
 
-                if response != "":
-                    self.response = response
-
-                remaining_time = self.response_interval - execution_time
-                if remaining_time > 0:
-                    time.sleep(remaining_time)
-            else:
-                time.sleep(0.1)
-        # check if the start event is set, if so trigger the stop_credit_deductor and set the notification condition
-        if self.interview_session.start_event.is_set():
-            self.interview_session.stop_credit_deductor()
-        self.logger.info("GPTResponder thread ended...")
+        if cancelled:
+            # the newer question is answered right away
+            return
+        if response != "":
+            self.response = response
+        self.next_response_at = start_time + self.response_interval
 
 
 class CoachResponder(GPTResponder):
     def __init__(self, interview_session: InterviewSession, responder_type: ResponderType):
         super().__init__(interview_session, responder_type)
 
-    def respond_to_transcriber(self, stop_event: threading.Event):
-        while not stop_event.is_set():
-            if self.transcriber.respond_interviewee_changed_event.is_set():
-                # if the start event is not set, set it once
-                if not self.interview_session.start_event.is_set():
-                    self.interview_session.start_event.set()
-                self.sio.emit(
-                    "coach_busy_status",
-                    True,
-                    room=get_interview_room(self.logger.user_id),
-                )
-                start_time = time.time()
-                self.transcriber.respond_interviewee_changed_event.clear()
-                question, request_id = self.cm.gen_question(
-                    self.chain_type, transcribe_assembler=self.transcriber
-                )
-                self.logger.info(f"[Question Input MockInterview]\n {question}")
-                query = f"Current response from {Role.INTERVIEWEE.value}: {question}"
-
-                response = self.chain.run(query)
-                self.logger.debug(f"[AI Response MockInterview]\n {response}")
-                transcript = Transcript(
-                    role=Role.AI_COACH,
-                    transcript=response,
-                    timestamp=datetime.datetime.now(),
-                    request_id=request_id,
-                )
-                self.transcriber.chat_history_queue.put(transcript)
-                end_time = time.time()  # Measure end time
-                execution_time = end_time - start_time
-                self.sio.emit(
-                    "coach_busy_status",
-                    False,
-                    room=get_interview_room(self.logger.user_id),
-                )
-
-                remaining_time = self.response_interval - execution_time
-                if remaining_time > 0:
-                    time.sleep(remaining_time)
-            else:
-                time.sleep(0.1)
-        # check if the start event is set, if so trigger the stop_credit_deductor and set the notification condition
-        if self.interview_session.start_event.is_set():
-            self.interview_session.stop_credit_deductor()
-        self.logger.info("AICoachResponder thread ended...")
-
+    def respond(self):
+        """
+        Runs on the session's "coach" lane when the transcriber sets respond_interviewee_changed_event.
+        """
+        event = self.transcriber.respond_interviewee_changed_event
+        if self.interview_session.stop_event.is_set() or self._throttled(event):
+            return
+        self.interview_session.start_metering()
+        self.sio.emit(
+            "coach_busy_status",
+            True,
+            room=get_interview_room(self.logger.user_id),
+        )
+        start_time = time.time()
+        self.generation = Generation() if is_preemptible(self.chain_type) else None
+        event.clear()
+        question, request_id = self.cm.gen_question(
+            self.chain_type, transcribe_assembler=self.transcriber
+        )
+        self.logger.info(f"[Question Input MockInterview]\n {question}")
+        query = f"Current response from {Role.INTERVIEWEE.value}: {question}"
+
+        response, cancelled = self.generate(query, turn=(request_id, question))
+        self.logger.debug(f"[AI Response MockInterview]\n {response}")
+        if not cancelled or response:
+            transcript = Transcript(
+                role=Role.AI_COACH,
+                transcript=response,
+                timestamp=datetime.datetime.now(),
+                request_id=request_id,
+            )
+            self.transcriber.chat_history_queue.put(transcript)
+        self.sio.emit(
+            "coach_busy_status",
+            False,
+            room=get_interview_room(self.logger.user_id),
+        )
+        if not cancelled:
+            self.next_response_at = start_time + self.response_interval
 
 if __name__ == "__main__":
     GPTResponder.run()
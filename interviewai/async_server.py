@@ -0,0 +1,224 @@
+"""
+asyncio server mode of the autopilot websocket server.
+
+Same events as interviewai/server.py, but served by python-socketio's AsyncServer on an ASGI server
+instead of flask-socketio with async_mode="threading". Handlers are coroutines running on one event loop,
+the Deepgram sender of every session runs as a task on that loop (see DGTranscriber.run_dg_on_loop), and
+blocking work (firestore, chain building, LLM calls) is pushed to worker threads with asyncio.to_thread.
+The flask app (webhooks, payment, REST) is mounted as the fallback WSGI app.
+
+Run:
+uvicorn asgi:application --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import inspect
+import traceback
+
+import socketio
+from asgiref.wsgi import WsgiToAsgi
+from engineio.payload import Payload
+from socketio.exceptions import ConnectionRefusedError
+
+from interviewai import LoggerMixed
+from interviewai import server as wsgi_server
+from interviewai.auth import verify_jwt
+from interviewai.chains.chain_manager import CHAIN_MAP
+from interviewai.cluster import SessionOwnedElsewhere, WorkerDraining, get_client_manager
+from interviewai.session import InterviewSessionManager
+from interviewai.speech.audio_ingest import AudioIngestASGIApp
+from interviewai.speech.dg import DG_WARM_POOL
+
+logger = LoggerMixed(__name__)
+# https://github.com/miguelgrinberg/python-engineio/issues/142
+Payload.max_decode_packets = 50
+ROOM_JOIN_TIMEOUT = 5  # seconds
+SESSION_READY_TIMEOUT = 30  # seconds, covers the admission queue wait
+
+
+class AsyncSocketIOBridge:
+    """
+    Thread-safe facade over socketio.AsyncServer.
+    Session code (responders, transcriber, chain callbacks) calls emit synchronously from worker threads,
+    the same way it calls flask_socketio.SocketIO.emit in threading mode. Calls are scheduled on the server loop.
+    """
+
+    def __init__(self, server: socketio.AsyncServer):
+        self.server = server
+        self.loop: asyncio.AbstractEventLoop = None
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        if self.loop is None:
+            self.loop = loop
+
+    def _in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _submit(self, coro):
+        if self.loop is None:
+            coro.close()
+            logger.error("AsyncSocketIOBridge is not bound to an event loop yet, dropping call")
+            return None
+        if self._in_loop():
+            return self.loop.create_task(coro)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def emit(self, event, data=None, **kwargs):
+        # fire and forget, never wait here: emit is called from the loop thread as well
+        self._submit(self.server.emit(event, data, **kwargs))
+
+    def enter_room(self, sid, room):
+        async def _enter_room():
+            result = self.server.enter_room(sid, room)
+            if inspect.isawaitable(result):
+                await result
+
+        future = self._submit(_enter_room())
+        if isinstance(future, asyncio.Future) or future is None:
+            return
+        # called from a worker thread: wait so that emits to the room right after joining reach this client
+        future.result(timeout=ROOM_JOIN_TIMEOUT)
+
+    def rooms(self, sid):
+        return self.server.rooms(sid)
+
+
+sio = socketio.AsyncServer(
+    async_mode="asgi",
+    ping_timeout=120,
+    cors_allowed_origins="*",
+    client_manager=get_client_manager(async_mode=True),
+)
+bridge = AsyncSocketIOBridge(sio)
+im = InterviewSessionManager.new(bridge)
+# REST routes in interviewai/server.py share the same session manager
+wsgi_server.im = im
+
+
+def bind_loop():
+    loop = asyncio.get_running_loop()
+    bridge.bind(loop)
+    im.loop = loop
+    DG_WARM_POOL.start(loop)
+
+
+async def drain():
+    # uvicorn shutdown (SIGTERM), snapshot live sessions so users resume them on another worker
+    await asyncio.to_thread(im.drain)
+
+
+async def get_interview_session(sid):
+    # a session still starting is awaited on its readiness future, no worker thread is parked
+    future = im.session_ready_future(sid)
+    if future is not None:
+        return await asyncio.wait_for(asyncio.wrap_future(future), SESSION_READY_TIMEOUT)
+    return im.get_interview_session_by_client(sid)
+
+
+@sio.event
+async def connect(sid, environ, auth):
+    bind_loop()
+    try:
+        connection = verify_jwt(auth["session"])  # verify clerk jwt token
+        logger.info(
+            f"socket client id: {sid}, user id: {connection['sub']}",
+            user_id=connection["sub"],
+        )
+        # firestore reads and session lookups, keep them off the loop
+        # last chat history entry the client has, when reconnecting: only the missing tail is sent back
+        await asyncio.to_thread(
+            im.add_new_connection, connection, sid,
+            last_seq=auth.get("last_seq"), last_request_id=auth.get("last_request_id"),
+        )
+        im.gateway.emit("chain_types", list(CHAIN_MAP.keys()), to=sid)
+    except SessionOwnedElsewhere as error:
+        raise ConnectionRefusedError(str(error), {"worker_id": error.worker_id})
+    except WorkerDraining as error:
+        raise ConnectionRefusedError(str(error), {"draining": True})
+    except Exception as error:
+        logger.info(f"Not authorized client id:{sid}! {error}")
+        logger.error(traceback.format_exc())
+        raise ConnectionRefusedError(f"Connection Refused! {error}")
+
+
+@sio.event
+async def disconnect(sid):
+    try:
+        if sid in im.clients:
+            user = im.remove_client(sid)
+            logger.info(f"Client disconnected {sid}, user id: {user}", user_id=user)
+    except Exception:
+        logger.error(f"Failed to disconnect client {sid}! \n {traceback.format_exc()}")
+
+
+@sio.event
+async def chat(sid, message):
+    interview_session = await get_interview_session(sid)
+    interview_session.chat(message)
+
+
+@sio.event
+async def chat_bytes(sid, message):
+    interview_session = await get_interview_session(sid)
+    interview_session.chat_bytes(message)
+
+
+@sio.event
+async def chat_dual_channel(sid, message):
+    try:
+        # frames of a session still starting are buffered and replayed once it is ready,
+        # if user has no interview session, return silently to save resources
+        im.feed_audio_by_client(sid, message["bytes"])
+    except Exception as error:
+        logger.debug(f"chat_dual_channel error: {error}, {traceback.format_exc()}")
+
+
+@sio.event
+async def end_session(sid, message):
+    await asyncio.to_thread(im.end_session_by_client, sid)
+
+
+@sio.event
+async def paused(sid, message):
+    logger.info(f"Paused: {message} client_id: {sid}")
+    im.pause_resume_by_client(sid, message)
+
+
+@sio.event
+async def update_chain(sid, message):
+    chain_type = message["chain_type"]["id"]
+    if chain_type not in CHAIN_MAP:
+        logger.error(
+            f"Invalid chain type! {message}. Supported types: {list(CHAIN_MAP.keys())}"
+        )
+    interview_session = await get_interview_session(sid)
+    await asyncio.to_thread(interview_session.responder.update_chain, chain_type)
+
+
+@sio.event
+async def next_question(sid):
+    interview_session = await get_interview_session(sid)
+    interview_session.next_question()
+
+
+@sio.event
+async def solve(sid, message):
+    interview_session = await get_interview_session(sid)
+    try:
+        await asyncio.to_thread(interview_session.solve, message)
+    except:
+        logger.error(f"Failed to solve! {traceback.format_exc()}")
+
+
+def create_asgi_app():
+    flask_app = wsgi_server.create_app()
+    app = socketio.ASGIApp(
+        sio,
+        other_asgi_app=WsgiToAsgi(flask_app),
+        on_startup=bind_loop,
+        on_shutdown=drain,
+    )
+    # binary audio websocket, served before socket.io sees the request
+    return AudioIngestASGIApp(app, im)
@@ -0,0 +1,197 @@
+"""
+Semantic cache of answers to recurring interview questions.
+
+"Tell me about yourself", "why this company", ... come up in most interviews of a user and were answered from
+scratch every time. Answers are cached by the embedding of the question, within a scope of:
+
+* the user and the chain type (prompt)
+* a fingerprint of what else shapes the answer: goal (GoalContext), last minute details, answer structure, language
+* the version of the user's materials, `materials_version` of the user document, incremented when a material is indexed
+  or deleted. Every worker reads it (at most ANSWER_CACHE_VERSION_REFRESH seconds old), answers based on replaced
+  materials stop being served everywhere
+
+A question whose embedding is within ANSWER_CACHE_SIMILARITY (cosine) of a cached one of the same scope gets the
+cached answer, streamed through the normal chat_token path. Entries expire after ANSWER_CACHE_TTL, the least recently
+used ones are evicted past ANSWER_CACHE_SIZE.
+
+The lookup costs an embedding request, it runs in lookup_async while the chain builds the context prompt. Disabled by
+default (ANSWER_CACHE_ENABLED=1 to enable).
+
+Questions depending on the conversation ("can you elaborate on that?") are not cached, see cacheable.
+"""
+import concurrent.futures
+import hashlib
+import os
+import string
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from interviewai import LoggerMixed
+from interviewai.firebase import firestore, get_user_info_ref
+
+logger = LoggerMixed(__name__)
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "0") == "1"
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 5000))  # answers, every user
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", 60 * 60 * 24 * 7))  # seconds
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", 0.95))  # cosine
+# seconds a materials version read from firestore is used before reading it again
+ANSWER_CACHE_VERSION_REFRESH = float(os.environ.get("ANSWER_CACHE_VERSION_REFRESH", 30))
+ANSWER_CACHE_LOOKUP_WORKERS = 8
+ANSWER_CACHE_MIN_WORDS = 4
+# a question with one of these refers to the conversation, its answer can't be reused
+CONTEXT_DEPENDENT_WORDS = {"that", "this", "it", "those", "these", "elaborate", "more", "else", "again", "above"}
+
+
+def fingerprint(*parts) -> str:
+    return hashlib.sha1("\x1f".join(str(part) for part in parts).encode()).hexdigest()[:16]
+
+
+def cacheable(question: str) -> bool:
+    words = question.lower().translate(str.maketrans("", "", string.punctuation)).split()
+    return len(words) >= ANSWER_CACHE_MIN_WORDS and not CONTEXT_DEPENDENT_WORDS.intersection(words)
+
+
+class CachedAnswer:
+    def __init__(self, scope: str, embedding: np.ndarray, question: str, answer: str, latency: float) -> None:
+        self.scope = scope
+        self.embedding = embedding
+        self.question = question
+        self.answer = answer
+        self.latency = latency  # seconds the LLM took to answer
+        self.created_at = time.time()
+
+
+class SemanticAnswerCache:
+    def __init__(
+            self,
+            size: int = ANSWER_CACHE_SIZE,
+            ttl: float = ANSWER_CACHE_TTL,
+            similarity: float = ANSWER_CACHE_SIMILARITY,
+    ) -> None:
+        self.size = size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.entries: OrderedDict[int, CachedAnswer] = OrderedDict()  # LRU order, most recently used last
+        self.scopes: Dict[str, List[int]] = {}  # scope -> entry ids
+        self.materials_versions: Dict[str, Tuple[int, float]] = {}  # user_id -> (version of the materials, read at)
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.embeddings = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=ANSWER_CACHE_LOOKUP_WORKERS, thread_name_prefix="answer-cache"
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.latency_saved = 0.0
+
+    def embed(self, question: str) -> np.ndarray:
+        if self.embeddings is None:
+            from langchain_openai.embeddings import OpenAIEmbeddings
+            self.embeddings = OpenAIEmbeddings()
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def materials_version(self, user_id: str) -> int:
+        now = time.monotonic()
+        with self.lock:
+            cached = self.materials_versions.get(user_id)
+        if cached is not None and now - cached[1] < ANSWER_CACHE_VERSION_REFRESH:
+            return cached[0]
+        data = get_user_info_ref(user_id).get().to_dict() or {}
+        version = data.get("materials_version", 0)
+        with self.lock:
+            self.materials_versions[user_id] = (version, now)
+        return version
+
+    def scope(self, user_id: str, chain_type: str, context_fingerprint: str) -> str:
+        return f"{user_id}:{chain_type}:{context_fingerprint}:{self.materials_version(user_id)}"
+
+    def invalidate(self, user_id: str):
+        """
+        The materials of the user changed, their answers are not served anymore by any worker (and age out).
+        """
+        get_user_info_ref(user_id).set({"materials_version": firestore.Increment(1)}, merge=True)
+        with self.lock:
+            self.materials_versions.pop(user_id, None)
+
+    def lookup(
+            self, question: str, user_id: str, chain_type: str, context_fingerprint: str,
+    ) -> Tuple[str, np.ndarray, Optional[CachedAnswer]]:
+        """
+        (scope, embedding, cached answer or None) of a question, the scope and embedding are kept to put its answer.
+        """
+        embedding = self.embed(question)
+        scope = self.scope(user_id, chain_type, context_fingerprint)
+        return scope, embedding, self.get(scope, embedding)
+
+    def lookup_async(self, question: str, user_id: str, chain_type: str, context_fingerprint: str):
+        return self.executor.submit(self.lookup, question, user_id, chain_type, context_fingerprint)
+
+    def get(self, scope: str, embedding: np.ndarray) -> Optional[CachedAnswer]:
+        now = time.time()
+        with self.lock:
+            ids = self.scopes.get(scope, [])
+            best, best_score = None, self.similarity
+            for entry_id in list(ids):
+                entry = self.entries.get(entry_id)
+                if entry is None:
+                    ids.remove(entry_id)
+                    continue
+                if now - entry.created_at > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                score = float(np.dot(entry.embedding, embedding))
+                if score >= best_score:
+                    best, best_score = entry_id, score
+            if best is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best)
+            self.hits += 1
+            return self.entries[best]
+
+    def record_saved(self, seconds: float):
+        # answer latency of the LLM minus the lookup (embedding) latency of a hit
+        with self.lock:
+            self.latency_saved += max(seconds, 0.0)
+
+    def put(self, scope: str, embedding: np.ndarray, question: str, answer: str, latency: float):
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = CachedAnswer(scope, embedding, question, answer, latency)
+            self.scopes.setdefault(scope, []).append(entry_id)
+            while len(self.entries) > self.size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, entry_id: int):
+        # caller holds the lock
+        entry = self.entries.pop(entry_id)
+        ids = self.scopes.get(entry.scope)
+        if ids is not None:
+            if entry_id in ids:
+                ids.remove(entry_id)
+            if not ids:
+                del self.scopes[entry.scope]
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "latency_saved_s": round(self.latency_saved, 1),
+                "evictions": self.evictions,
+            }
+
+
+ANSWER_CACHE = SemanticAnswerCache()
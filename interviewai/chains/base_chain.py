@@ -1,17 +1,21 @@
 import base64
+import os
+import time
 from interviewai.chains.context import MemoryContext
 from interviewai.config.config import get_config
 from langchain_core.language_models.base import BaseLanguageModel
 from interviewai import LoggerMixed
 from interviewai.user_manager.user_preference import UserSettings
-from typing import List
+from typing import List, Tuple
 import asyncio
-from interviewai.chains.context import Context
+from interviewai.chains.context import Context, TurnContextCache
 from interviewai.prompt.prompt import (
     DEFAULT_PROMPT,
 )
 from langchain_openai import ChatOpenAI
-from tenacity import retry, stop_after_attempt, stop_after_delay, before_log, after_log
+from tenacity import (
+    retry, retry_if_not_exception_type, stop_after_attempt, stop_after_delay, before_log, after_log,
+)
 from openai import OpenAI
 import logging
 import concurrent.futures
@@ -19,10 +23,20 @@ import base64
 from PIL import Image
 import io
 from interviewai.tools.data_structure import InterviewType, ModelType
+from interviewai.chains.answer_cache import ANSWER_CACHE, ANSWER_CACHE_ENABLED, cacheable, fingerprint
+from interviewai.chains.generation import (
+    HEDGE_STREAM, PRIMARY_STREAM, Generation, GenerationCancelled, set_current_generation, set_current_stream,
+)
 from interviewai.chains.interview_callback import InterviewCallback
+from interviewai.chains.llm_pool import LLM_CLIENT_POOL
+from interviewai.chains.llm_stream import (
+    LLM_FIRST_TOKEN_DEADLINE, LLM_STREAM_RUNNER, LLM_TOTAL_DEADLINE, LLMDeadlineExceeded,
+)
+from interviewai.chains.token_usage import TOKEN_USAGE_METER
 from langchain_core.messages import HumanMessage
 
-LLM_PREDICT_LATENCY_BUDGET = 60 * 2  # 2 minutes
+LLM_TIMEOUT_ANSWER = "Waiting AI timed out. Please try again later."
+LLM_WAIT_MARGIN = 5  # seconds past the total deadline before giving up on a task the loop didn't get to end
 
 logger = LoggerMixed(__name__)
 logger_default = logging.getLogger(__name__)
@@ -35,6 +49,13 @@ class InterviewChain:
     """
 
     memory: MemoryContext = None
+    # shared by the chains of a session, see TurnContextCache
+    turn_contexts: TurnContextCache = None
+    # (user_id, chain_type) answers of which are cached (see answer_cache.py), None to not cache them
+    answer_scope: Tuple[str, str] = None
+    # LLM a late answer is hedged with (see astream), None to not hedge
+    hedge_llm: BaseLanguageModel = None
+    hedge_cost_callback: callable = None
 
     def __init__(
             self,
@@ -58,69 +79,230 @@ class InterviewChain:
         if self.memory is not None:
             logging.info(f"Memory Context is set to {self.memory.name}")
 
-    def context_prompt(self, query) -> str:
+    def context_prompt(self, query, turn: Tuple[str, str] = None) -> str:
+        """
+        turn: (request_id, transcript) answered, its contexts are computed on the transcript once for every chain of
+        the session (see TurnContextCache)
+        """
+        if turn is not None and self.turn_contexts is not None:
+            request_id, transcript = turn
+
+            def context_prompt(context: Context) -> str:
+                return self.turn_contexts.prompt(request_id, context, transcript)
+        else:
+            def context_prompt(context: Context) -> str:
+                return context.prompt(query)
         # Create a ThreadPoolExecutor
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # Use list comprehension to create a list of futures
-            futures = [executor.submit(context.prompt, query) for context in self.contexts]
+            futures = [executor.submit(context_prompt, context) for context in self.contexts]
         prompts = [future.result() for future in concurrent.futures.as_completed(futures)]
         return "\n".join(prompts)
 
-    def prompt(self, query) -> str:
+    def prompt(self, query, turn: Tuple[str, str] = None) -> str:
         """
         Main prompt to combine all of the contexts together with user question.
         """
         return f"""
         -- START CONTEXT --
         You are given the following contexts that would help you to contextualize your question:
-        {self.context_prompt(query)}
+        {self.context_prompt(query, turn)}
         -- END CONTEXT --
         """
 
+    def run(self, query, generation: Generation = None, turn: Tuple[str, str] = None) -> str:
+        """
+        With a generation, the answer is streamed cancellably: GenerationCancelled is raised as soon as it's cancelled.
+        turn: (request_id, transcript) answered, its contexts are shared with the other chains of the session.
+        """
+        if generation is not None and generation.cancelled:
+            raise GenerationCancelled()
+        # without a generation of the caller, the answer can't be cancelled but its deadlines hold
+        generation = generation or Generation()
+        started = time.monotonic()
+        cache_scope, embedding, lookup = None, None, None
+        if turn is not None and self.answer_scope is not None and ANSWER_CACHE_ENABLED and cacheable(turn[1]):
+            # embedding request of the lookup runs while the contexts are built
+            lookup = ANSWER_CACHE.lookup_async(turn[1], *self.answer_scope, self.context_fingerprint())
+        prompted_query = f"""
+        {self.prompt(query, turn)}
+        {query}
+        {self.instruction_prompt}
+        Your language output should be in: {self.language}
+        """
+        if lookup is not None:
+            try:
+                cache_scope, embedding, cached = lookup.result()
+            except Exception as e:
+                self.logger.error(f"answer cache lookup failed: {e}")
+                cache_scope, cached = None, None
+            if cached is not None:
+                self.logger.info(f"answer cache hit, cached for: {cached.question}")
+                self.stream_cached(cached.answer, generation)
+                ANSWER_CACHE.record_saved(cached.latency - (time.monotonic() - started))
+                return cached.answer
+        # billed by the stream tasks, see consume
+        extracted_result = self.cancellable_predict(prompted_query, generation)
+        if cache_scope is not None and extracted_result and extracted_result != LLM_TIMEOUT_ANSWER:
+            ANSWER_CACHE.put(cache_scope, embedding, turn[1], extracted_result, time.monotonic() - started)
+
+        return extracted_result
+
+    def context_fingerprint(self) -> str:
+        return fingerprint(
+            self.instruction_prompt, self.language, *(f"{context.name}={context.fingerprint()}" for context in self.contexts)
+        )
+
+    def stream_cached(self, answer: str, generation: Generation = None):
+        """
+        Stream a cached answer through the callbacks, like a generation of the LLM (hidden or cancelled included).
+        """
+        set_current_generation(generation)
+        try:
+            for callback in self.llm.callbacks or []:
+                if isinstance(callback, InterviewCallback):
+                    callback.on_llm_new_token(answer)
+                    callback.on_llm_end(None)
+        finally:
+            set_current_generation(None)
+
     @retry(
         reraise=True,
         stop=(stop_after_delay(10) | stop_after_attempt(3)),
+        retry=retry_if_not_exception_type(GenerationCancelled),
         before=before_log(logger_default, logging.INFO),
         after=after_log(logger_default, logging.INFO),
     )
-    def run(self, query) -> str:
-        prompted_query = f"""
-        {self.prompt(query)}
-        {query}
-        {self.instruction_prompt}
-        Your language output should be in: {self.language}
+    def cancellable_predict(self, query, generation: Generation) -> str:
         """
-        prompt_tokens = self.llm.get_num_tokens(prompted_query)
-
-        result = self.safe_predict(prompted_query)
-        # Returned resule is langchain_core.messages.ai.AIMessage
-        extracted_result = result.content
-        result_tokens = self.llm.get_num_tokens(extracted_result)
-        if self.cost_callback:
-            self.cost_callback(prompt_tokens, result_tokens)
+        Retried on its own, the prompt built by run is reused by every attempt.
+        Stream the answer as a task of the LLM stream runner and wait until it's done or cancelled.
+        Cancelling the generation cancels the task, the HTTP request is aborted (before the first token included) and
+        the tokens received until then are billed. Past a deadline (first token, total) the answer streamed so far is
+        returned, LLM_TIMEOUT_ANSWER when there's none.
+        """
+        generation.reset()
+        future = LLM_STREAM_RUNNER.submit(self.astream(query, generation))
+        generation.add_cancel_callback(future.cancel)
+        if not generation.wait(timeout=LLM_TOTAL_DEADLINE + LLM_WAIT_MARGIN):
+            generation.cancel()
+            self.end_streams(generation)
+            logging.error(f"LLM stream task not ended past its deadline for user {self.logger.user_id}")
+            return LLM_TIMEOUT_ANSWER
+        if not generation.done:
+            # cancelled, the task ends in the background
+            self.end_streams(generation)
+            raise GenerationCancelled(generation.partial)
+        try:
+            # raises the error of the stream, retried by run
+            future.result()
+        except concurrent.futures.CancelledError:
+            self.end_streams(generation)
+            raise GenerationCancelled(generation.partial)
+        except LLMDeadlineExceeded as e:
+            self.end_streams(generation)
+            logging.error(f"LLM deadline exceeded, {e}, early stopping for user {self.logger.user_id}")
+            return generation.partial or LLM_TIMEOUT_ANSWER
+        if generation.cancelled:
+            # cancelled after the last chunk, the answer is complete but its end marker may have been held back
+            self.end_streams(generation)
+        return generation.partial
 
-        return extracted_result
+    def stream_model(self, stream: int) -> str:
+        # latencies are kept per model, an Azure deployment apart from the OpenAI model of the same name
+        if stream != HEDGE_STREAM:
+            return self.llm.model_name
+        deployment = getattr(self.hedge_llm, "deployment_name", None)
+        return f"azure:{deployment}" if deployment else self.hedge_llm.model_name
 
-    def safe_predict(self, query) -> str:
+    async def astream(self, query, generation: Generation):
         """
-        Predict with LLM with a timeout budget. 
-        Sometimes downstream services would hang and we want to prevent that.
-        No caching is needed. If the timeout budget is exceeded simply return ""
-        Use this to replace self.llm.predict
-        TODO: later we could also modify this to make our AI engine async and support multiple QAs at same time.
+        Runs on the loop of the LLM stream runner, the stream callbacks find the generation in the task's context.
+        Without a first token past the hedge delay of the model (see LLMStreamRunner.hedge_delay), the same prompt is
+        sent to hedge_llm: the first stream to get a token streams the answer, the other is cancelled.
         """
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            # TODO: sometimes it would hang here. Need to figure out why.
-            try:
-                # Try to get the result within the timeout
-                future = executor.submit(self.llm.invoke, query)
-                result = future.result(timeout=LLM_PREDICT_LATENCY_BUDGET)
-                return result
-            except concurrent.futures.TimeoutError:
-                # If the function call didn't complete in time, return the cached result
-                logging.error(
-                    f"Timeout budget {LLM_PREDICT_LATENCY_BUDGET}s exceed for `self.llm.predict`, early stopping for user {self.logger.user_id}")
-                return "Waiting AI timed out. Please try again later."
+        set_current_generation(generation)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        phase, deadline = "first token", min(LLM_FIRST_TOKEN_DEADLINE, LLM_TOTAL_DEADLINE)
+        first_token = loop.create_future()  # stream that got the first token
+        streams = {PRIMARY_STREAM: asyncio.create_task(self.consume(PRIMARY_STREAM, query, generation, first_token))}
+        stream_started = {PRIMARY_STREAM: started}
+        hedge_delay = LLM_STREAM_RUNNER.hedge_delay(self.llm.model_name) if self.hedge_llm is not None else None
+        try:
+            async with asyncio.timeout(deadline) as timeout:
+                while not first_token.done():
+                    running = [task for task in streams.values() if not task.done()]
+                    if not running:
+                        break
+                    hedging = hedge_delay is not None and HEDGE_STREAM not in streams
+                    wait = max(started + hedge_delay - loop.time(), 0) if hedging else None
+                    await asyncio.wait(running + [first_token], timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                    if hedging and not first_token.done() and loop.time() >= started + hedge_delay:
+                        streams[HEDGE_STREAM] = asyncio.create_task(
+                            self.consume(HEDGE_STREAM, query, generation, first_token)
+                        )
+                        stream_started[HEDGE_STREAM] = loop.time()
+                        LLM_STREAM_RUNNER.record_hedge()
+                # every stream ended without a token: the error of the primary one, or an empty answer
+                winner = first_token.result() if first_token.done() else PRIMARY_STREAM
+                if first_token.done():
+                    # latency of the model that answered, since its own request
+                    LLM_STREAM_RUNNER.record_first_token(
+                        loop.time() - stream_started[winner], self.stream_model(winner), hedge_won=winner == HEDGE_STREAM
+                    )
+                    phase, deadline = "answer", LLM_TOTAL_DEADLINE
+                    timeout.reschedule(started + LLM_TOTAL_DEADLINE)
+                    for stream, task in streams.items():
+                        if stream != winner:
+                            task.cancel()
+                await streams[winner]
+        except TimeoutError:
+            raise LLMDeadlineExceeded(phase, deadline)
+        finally:
+            # closes the HTTP streams of a cancelled or late generation
+            for task in streams.values():
+                task.cancel()
+            await asyncio.gather(*streams.values(), return_exceptions=True)
+            generation.finish()
+
+    async def consume(self, stream: int, query, generation: Generation, first_token: asyncio.Future):
+        # one stream of the generation. what it got (prompt only for a losing one) is billed once its tokens are
+        # counted in the background. failed requests are not billed
+        set_current_stream(stream)
+        llm, cost_callback = (self.hedge_llm, self.hedge_cost_callback) if stream == HEDGE_STREAM \
+            else (self.llm, self.cost_callback)
+        won, failed = False, False
+        chunks = llm.astream(query)
+        try:
+            async for chunk in chunks:
+                if not won:
+                    with generation.condition:
+                        won = generation.claim(stream)
+                    if not won:
+                        return
+                    if not first_token.done():
+                        first_token.set_result(stream)
+                generation.chunks.append(chunk.content)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            await chunks.aclose()
+            if cost_callback and not failed:
+                TOKEN_USAGE_METER.bill(llm, cost_callback, query, generation.partial if won else "")
+
+    def end_streams(self, generation: Generation):
+        for callback in self.llm.callbacks or []:
+            if isinstance(callback, InterviewCallback):
+                callback.on_generation_cancelled(generation)
+
+    def reveal_streams(self, generation: Generation):
+        for callback in self.llm.callbacks or []:
+            if isinstance(callback, InterviewCallback):
+                callback.on_generation_revealed(generation)
+        with generation.condition:
+            generation.hidden = False
 
     def predict_image(self, image_base64, socketio) -> str:
         if not self.validate_and_prepare_image(image_base64):
@@ -132,6 +314,7 @@ class InterviewChain:
             openai_api_key=OPENAI_API_KEY,
             callbacks=[InterviewCallback(socketio, self.logger, 'chat_token')],
             verbose=False,
+            http_client=LLM_CLIENT_POOL.acquire(),
             )    
         result = model.invoke(
                                 [
@@ -1,4 +1,5 @@
-from typing import Union, List
+import os
+from typing import Union, List, Optional, Tuple
 from interviewai.user_manager.user_preference import UserSettings
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.llms.base import BaseLLM
@@ -11,11 +12,21 @@ from interviewai.prompt.prompt import (
     CONSISE_PROMPT_001,
 )
 from interviewai.chains.interview_callback import InterviewCallback
+from interviewai.chains.llm_pool import LLM_CLIENT_POOL
+from interviewai.chains.llm_stream import LLM_STREAM_RUNNER
 from interviewai.tools.cost_calculator import GlobalCostCalculator
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from interviewai.chains.base_chain import InterviewChain
-from langchain_openai import ChatOpenAI
-from interviewai.tools.data_structure import InterviewType
+from langchain_openai import AzureChatOpenAI, ChatOpenAI
+from interviewai.tools.data_structure import InterviewType, ModelType
+
+# LLM late answers are hedged with (see InterviewChain.astream): "azure" for the Azure deployment of the same model,
+# a model name (e.g. the primary model on another client), "" (default) to not hedge
+LLM_HEDGE_TARGET = os.environ.get("LLM_HEDGE_TARGET", "")
+AZURE_DEPLOYMENTS = {
+    ModelType.OPENAI_GPT_35_TURBO.value: ModelType.AZURE_GPT_35_TURBO.value,
+    ModelType.OPENAI_GPT_4_TURBO.value: ModelType.AZURE_GPT_4_TURBO.value,
+}
 
 
 def default_callbacks(socketio, logger: LoggerMixed, stream_topic="chat_token"):
@@ -103,9 +114,48 @@ class ChainFactory:
             openai_api_key=get_config("OPENAI_API_KEY"),
             callbacks=model_callbacks,
             verbose=False,
+            http_client=LLM_CLIENT_POOL.acquire(),
+            # answers are streamed on the LLM stream runner's loop, connections shared by every session
+            http_async_client=LLM_STREAM_RUNNER.client,
         )
         return self.llm
 
+    def hedge_llm(self, model: str, callbacks: List[BaseCallbackHandler]) -> Tuple[Optional[ChatOpenAI], str]:
+        """
+        LLM the answers of model are hedged with and the model it's billed as, (None, model) when not hedged.
+        Streams to the same callbacks, only the tokens of the stream winning the race are emitted.
+        """
+        if not LLM_HEDGE_TARGET:
+            return None, model
+        if LLM_HEDGE_TARGET != "azure":
+            llm = ChatOpenAI(
+                streaming=True,
+                model=LLM_HEDGE_TARGET,
+                openai_api_key=get_config("OPENAI_API_KEY"),
+                callbacks=callbacks,
+                verbose=False,
+                http_client=LLM_CLIENT_POOL.acquire(),
+                http_async_client=LLM_STREAM_RUNNER.client,
+            )
+            return llm, LLM_HEDGE_TARGET
+        endpoint = get_config("AZURE_OPENAI_ENDPOINT")
+        if model not in AZURE_DEPLOYMENTS or not endpoint:
+            self.logger.info(f"no Azure deployment of {model}, answers not hedged")
+            return None, model
+        llm = AzureChatOpenAI(
+            streaming=True,
+            azure_deployment=AZURE_DEPLOYMENTS[model],
+            azure_endpoint=endpoint,
+            api_key=get_config("AZURE_OPENAI_API_KEY"),
+            api_version=get_config("AZURE_OPENAI_API_VERSION", "2024-02-01"),
+            callbacks=callbacks,
+            verbose=False,
+            http_client=LLM_CLIENT_POOL.acquire(),
+            http_async_client=LLM_STREAM_RUNNER.client,
+        )
+        # same price as the OpenAI model
+        return llm, model
+
     def build(
             self,
             model: str,
@@ -124,4 +174,7 @@ class ChainFactory:
             logger=self.logger,
             user_settings=self.user_settings,
         )
+        ic.hedge_llm, hedge_model = self.hedge_llm(model, llm.callbacks)
+        if ic.hedge_llm is not None:
+            ic.hedge_cost_callback = cost_callback(self.logger, hedge_model)
         return ic
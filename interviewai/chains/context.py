@@ -2,7 +2,8 @@ from contextvars import ContextVar
 from functools import wraps
 import logging
 import threading
-from typing import List, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional
 from abc import ABC, abstractmethod
 from enum import Enum
 import uuid
@@ -24,6 +25,7 @@ from interviewai.transcriber import TranscribeAssembler
 
 # tracer = get_tracer()
 CONTEXT_LATENCY_BUDGET = 0.5  # 0.5s
+TURN_CONTEXT_TURNS = 8  # recent transcript turns kept by a TurnContextCache
 
 logger = LoggerMixed(__name__)
 
@@ -124,6 +126,13 @@ class Context(ABC):
         """
         raise NotImplementedError
 
+    def fingerprint(self) -> str:
+        """
+        What the context contributes to an answer besides the question, for the answer cache.
+        Empty for contexts depending on the question or the conversation.
+        """
+        return ""
+
     def prompt(self, query) -> str:
         return f"""
         Context {self.name} -- {self.description}:
@@ -133,6 +142,45 @@ class Context(ABC):
         """
 
 
+class TurnContextCache:
+    """
+    Context prompts of the recent transcript turns of a session, by request_id. The chains of a session (copilot and
+    coach responders) answering the same turn compute each context (materials search, goal, memory summary) once,
+    the other chain waits for it and gets the same prompt.
+    """
+
+    def __init__(self, turns: int = TURN_CONTEXT_TURNS) -> None:
+        self.turns = turns
+        self.snapshots: OrderedDict[str, Dict[str, concurrent.futures.Future]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def prompt(self, request_id: str, context: Context, query) -> str:
+        with self.lock:
+            snapshot = self.snapshots.get(request_id)
+            if snapshot is None:
+                snapshot = self.snapshots[request_id] = {}
+                while len(self.snapshots) > self.turns:
+                    self.snapshots.popitem(last=False)
+            future = snapshot.get(context.name)
+            owner = future is None
+            if owner:
+                future = snapshot[context.name] = concurrent.futures.Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if owner:
+            try:
+                future.set_result(context.prompt(query))
+            except Exception as e:
+                # not kept, the next chain computes it again
+                with self.lock:
+                    snapshot.pop(context.name, None)
+                future.set_exception(e)
+        return future.result()
+
+
 class MemoryMode(Enum):
     CONVERSATION_BUFFER = "conversation_buffer"  # keep k most recent conversations
     SUMMARIZATION = "summarization"
@@ -158,6 +206,9 @@ class GoalContext(Context):
         goal_context = f"Company: {self.extracted_data['company']}\n\nPosition: {self.extracted_data['position']}\n\nJob Description: {self.extracted_data['job_description']}\n\nCompany Detail: {self.extracted_data['company_detail']}\n"
         return goal_context
 
+    def fingerprint(self) -> str:
+        return str(sorted(self.extracted_data.items()))
+
     def extract_goal(self) -> dict:
         selected_fields = {
             "company",
@@ -340,6 +391,9 @@ class AnswerStructureContext(Context):
         self.name = "AnswerStructureContext"
         self.description = "Use the following method for behavioral interview questions only when it fits the scenario you're discussing, ensuring your response is both structured and impactful"
 
+    def fingerprint(self) -> str:
+        return str(self.mode)
+
     def context(self, query) -> str:
         if self.mode == FirebaseAnswerStructure.STAR:
             return ('STAR Method:\n'
@@ -364,5 +418,8 @@ class LastMinuteContext(Context):
         self.description = "Last minute details for this interview."
         self.last_minute_details = last_minute_details
 
+    def fingerprint(self) -> str:
+        return self.last_minute_details
+
     def context(self, query) -> str:
         return self.last_minute_details
@@ -0,0 +1,148 @@
+"""
+Cancellable LLM generations.
+
+A responder answering a question used to block on the whole generation, a follow-up question waited for the stale
+answer to finish streaming (and both were billed). A Generation is the handle of one streamed answer: cancel() (from
+the thread that sees the newer question) wakes the responder right away, cancels the task streaming it (which aborts
+the HTTP request, see llm_stream.py), and tokens arriving after the cancel are dropped instead of being emitted.
+
+Whether a chain type's generations are cancelled by a newer question is set with LLM_PREEMPT_CHAINS.
+
+A hedged generation (see InterviewChain.astream) is raced by two streams, the first one to get a token claims it, the
+tokens of the other are dropped.
+
+A hidden generation (speculative answer, see Speculation) holds its tokens back instead of emitting them, until it's
+revealed (committed) or cancelled (discarded, nothing was emitted).
+"""
+import concurrent.futures
+import contextvars
+import difflib
+import os
+import string
+import threading
+from typing import Callable, List, Optional
+
+# chain types whose in-flight generation is cancelled by a newer question: comma separated, "*" for every chain type
+LLM_PREEMPT_CHAINS = os.environ.get("LLM_PREEMPT_CHAINS", "*")
+# minimum similarity of the interim question a speculative answer was started on and the final one to commit it
+SPECULATION_SIMILARITY = float(os.environ.get("SPECULATION_SIMILARITY", 0.9))
+
+PRIMARY_STREAM, HEDGE_STREAM = 0, 1
+
+# generation streamed by the current thread / asyncio task, for the stream callbacks
+_current_generation: contextvars.ContextVar = contextvars.ContextVar("generation", default=None)
+# stream of a hedged generation run by the current asyncio task
+_current_stream: contextvars.ContextVar = contextvars.ContextVar("stream", default=PRIMARY_STREAM)
+
+
+def is_preemptible(chain_type: str) -> bool:
+    chain_types = {name.strip() for name in LLM_PREEMPT_CHAINS.split(",") if name.strip()}
+    return "*" in chain_types or chain_type in chain_types
+
+
+class GenerationCancelled(Exception):
+    def __init__(self, partial: str = "") -> None:
+        super().__init__("generation cancelled by a newer question")
+        self.partial = partial  # answer streamed before the cancel
+
+
+class Generation:
+    def __init__(self, hidden: bool = False) -> None:
+        # emitting a token and cancelling hold it, no token of a cancelled generation gets out after its end marker
+        self.condition = threading.Condition()
+        self.cancelled = False
+        self.done = False
+        self.ended = False  # end marker of the stream emitted
+        self.chunks = []
+        self.hidden = hidden
+        self.held = []  # tokens of a hidden generation, emitted when it's revealed
+        self.end_held = False  # the stream of the hidden generation ended
+        self.on_cancel: List[Callable[[], None]] = []  # e.g. cancel the task streaming it
+        self.winner: Optional[int] = None  # stream streaming it, see claim
+
+    def reset(self):
+        # a retried attempt streams the answer again
+        with self.condition:
+            self.done = False
+            self.ended = False
+            self.chunks = []
+            self.held = []
+            self.end_held = False
+            self.on_cancel = []
+            self.winner = None
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            callbacks, self.on_cancel = self.on_cancel, []
+            self.condition.notify_all()
+        for callback in callbacks:
+            callback()
+
+    def add_cancel_callback(self, callback: Callable[[], None]):
+        with self.condition:
+            if not self.cancelled:
+                self.on_cancel.append(callback)
+                return
+        callback()
+
+    def claim(self, stream: int) -> bool:
+        # caller holds the condition. the first stream to get a token streams the generation
+        if self.winner is None:
+            self.winner = stream
+        return self.winner == stream
+
+    def finish(self):
+        with self.condition:
+            self.done = True
+            self.condition.notify_all()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Wait until the generation is done or cancelled, False on timeout.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.done or self.cancelled, timeout=timeout)
+
+    @property
+    def partial(self) -> str:
+        return "".join(self.chunks)
+
+
+def set_current_generation(generation: Optional[Generation]):
+    # stream callbacks run in the context (task or thread) consuming the stream, they find their generation here
+    _current_generation.set(generation)
+
+
+def current_generation() -> Optional[Generation]:
+    return _current_generation.get()
+
+
+def set_current_stream(stream: int):
+    _current_stream.set(stream)
+
+
+def current_stream() -> int:
+    return _current_stream.get()
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().translate(str.maketrans("", "", string.punctuation)).split())
+
+
+class Speculation:
+    """
+    Answer generated on an interim transcript of a question, in a hidden generation. The final transcript commits it
+    (the held tokens are emitted and the answer goes on streaming) when it matches the interim text, or discards it.
+    """
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.generation = Generation(hidden=True)
+        self.future = concurrent.futures.Future()  # (answer, cancelled)
+
+    def matches(self, text: str, threshold: float = SPECULATION_SIMILARITY) -> bool:
+        return difflib.SequenceMatcher(None, normalize(self.text), normalize(text)).ratio() >= threshold
+
+    def discard(self):
+        self.generation.cancel()
@@ -1,9 +1,11 @@
 import datetime
 import logging
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish, LLMResult
+from interviewai.chains.generation import Generation, current_generation, current_stream
+from interviewai.emit_gateway import EmitGateway
 from interviewai.tools.util import get_interview_room
 from interviewai import LoggerMixed
 
@@ -11,7 +13,10 @@ from interviewai import LoggerMixed
 class InterviewCallback(BaseCallbackHandler):
     """Callback handler for streaming. Only works with LLMs that support streaming."""
 
-    def __init__(self, socket, logger: LoggerMixed, stream_topic="chat_token") -> None:
+    # called on the stream's loop directly, not through an executor, tokens stay in order and in the task's context
+    run_inline = True
+
+    def __init__(self, socket: EmitGateway, logger: LoggerMixed, stream_topic="chat_token") -> None:
         self.logger = logger
         self.socket = socket
         self.stream_topic = stream_topic
@@ -25,20 +30,68 @@ class InterviewCallback(BaseCallbackHandler):
 
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         """Run on new LLM token. Only available when streaming is enabled."""
-        if self.socket is not None:
-            self.socket.emit(
-                self.stream_topic,
-                {"token": token, "end": False},
-                room=get_interview_room(self.logger.user_id),
-            )
+        if self.socket is None:
+            return
+        generation = current_generation()
+        if generation is None:
+            # coalesced per room and topic by the EmitGateway
+            self.socket.emit_token(self.stream_topic, token, get_interview_room(self.logger.user_id))
+            return
+        with generation.condition:
+            if generation.cancelled or not generation.claim(current_stream()):
+                # cancelled, or the other stream of a hedged generation got its first token earlier
+                return
+            if generation.hidden:
+                generation.held.append(token)
+                return
+            self.socket.emit_token(self.stream_topic, token, get_interview_room(self.logger.user_id))
 
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
-        if self.socket is not None:
-            self.socket.emit(
-                self.stream_topic,
-                {"token": "", "end": True},
-                room=get_interview_room(self.logger.user_id),
-            )
+        generation = current_generation()
+        if generation is not None and generation.cancelled:
+            # ended by on_generation_cancelled
+            return
+        if generation is not None and generation.winner not in (None, current_stream()):
+            # losing stream of a hedged generation
+            return
+        self._end_stream(generation)
+
+    def on_generation_cancelled(self, generation: Generation) -> None:
+        """Run when the streamed generation is cancelled (newer question, timeout), the stream is closed behind it."""
+        self._end_stream(generation)
+
+    def _end_stream(self, generation: Optional[Generation]) -> None:
+        if self.socket is None:
+            return
+        if generation is None:
+            # flushes the buffered tokens before the end marker
+            self.socket.end_stream(self.stream_topic, get_interview_room(self.logger.user_id))
+            return
+        with generation.condition:
+            if generation.ended:
+                return
+            if generation.hidden:
+                # sent with the held tokens if the generation is revealed
+                generation.end_held = True
+                return
+            generation.ended = True
+            self.socket.end_stream(self.stream_topic, get_interview_room(self.logger.user_id))
+
+    def on_generation_revealed(self, generation: Generation) -> None:
+        """Run when a hidden (speculative) generation is committed: emit what it held back, stream the rest."""
+        with generation.condition:
+            if not generation.hidden:
+                return
+            generation.hidden = False
+            if generation.cancelled or self.socket is None:
+                return
+            room = get_interview_room(self.logger.user_id)
+            if generation.held:
+                self.socket.emit_token(self.stream_topic, "".join(generation.held), room)
+                generation.held = []
+            if generation.end_held:
+                generation.ended = True
+                self.socket.end_stream(self.stream_topic, room)
 
     def on_llm_error(
             self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
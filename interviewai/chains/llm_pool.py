@@ -0,0 +1,132 @@
+"""
+Pre-connected HTTP clients for the OpenAI API.
+
+Every ChatOpenAI used to build its own httpx client, so the first LLM call of a session paid for DNS, TCP and
+TLS. Sessions now take a client from this pool (memory summaries, materials, images), each client keeps its connections
+alive and a background thread re-warms the idle ones before the keepalive expires. The async client answers are
+streamed with (LLM_STREAM_RUNNER.client, see llm_stream.py) is kept warm the same way, on the runner's loop.
+
+Hits are counted per request: a request is a hit when its client was used (or warmed) within the keepalive.
+"""
+import asyncio
+import itertools
+import os
+import threading
+import time
+import traceback
+from typing import Dict, List
+
+import httpx
+
+from interviewai import LoggerMixed
+from interviewai.chains.llm_stream import LLM_STREAM_RUNNER
+from interviewai.config.config import get_config
+
+logger = LoggerMixed(__name__)
+
+LLM_POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", 2))
+LLM_KEEPALIVE = 120  # seconds an idle connection is kept
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+WARM_URL = f"{OPENAI_BASE_URL}/models"
+STREAM_CLIENT = -1  # index of the async client of LLM_STREAM_RUNNER in used_at
+
+
+class LLMClientPool:
+    def __init__(self, size: int = LLM_POOL_SIZE, keepalive: int = LLM_KEEPALIVE) -> None:
+        self.keepalive = keepalive
+        self.clients: List[httpx.Client] = [
+            httpx.Client(
+                timeout=httpx.Timeout(600.0, connect=5.0),
+                limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100, keepalive_expiry=keepalive),
+                event_hooks={"request": [self.request_hook(i)]},
+            )
+            for i in range(max(size, 1))
+        ]
+        self.stream_client = LLM_STREAM_RUNNER.client
+        self.stream_client.event_hooks = {"request": [self.on_stream_request]}
+        # client index (STREAM_CLIENT for the async one) -> monotonic time of its last request
+        self.used_at: Dict[int, float] = {i: 0.0 for i in range(len(self.clients))}
+        self.used_at[STREAM_CLIENT] = 0.0
+        self.index = itertools.count()
+        self.lock = threading.Lock()
+        self.started = False
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        LLM_STREAM_RUNNER.start()
+        t = threading.Thread(target=self.keep_warm, args=(), daemon=True)
+        t.start()
+
+    def record(self, i: int, request: httpx.Request):
+        now = time.monotonic()
+        with self.lock:
+            if request.url != WARM_URL:
+                if now - self.used_at[i] < self.keepalive:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            self.used_at[i] = now
+
+    def request_hook(self, i: int):
+        def hook(request: httpx.Request):
+            self.record(i, request)
+
+        return hook
+
+    async def on_stream_request(self, request: httpx.Request):
+        self.record(STREAM_CLIENT, request)
+
+    def idle(self, i: int) -> bool:
+        with self.lock:
+            return time.monotonic() - self.used_at[i] >= self.keepalive / 2
+
+    def warm(self, i: int):
+        # cheapest authenticated call, opens (or reuses) the TLS connection of the client
+        self.clients[i].get(WARM_URL, headers=self.headers())
+
+    async def warm_stream_client(self):
+        await self.stream_client.get(WARM_URL, headers=self.headers())
+
+    @staticmethod
+    def headers() -> dict:
+        return {"Authorization": f"Bearer {get_config('OPENAI_API_KEY')}"}
+
+    def keep_warm(self):
+        while True:
+            for i in range(len(self.clients)):
+                if not self.idle(i):
+                    continue
+                try:
+                    self.warm(i)
+                except Exception as e:
+                    logger.error(f"failed to warm LLM client {i}: {e} \n {traceback.format_exc()}")
+            if self.idle(STREAM_CLIENT):
+                try:
+                    # the async client is used from the runner's loop only
+                    asyncio.run_coroutine_threadsafe(self.warm_stream_client(), LLM_STREAM_RUNNER.loop).result(
+                        timeout=30
+                    )
+                except Exception as e:
+                    logger.error(f"failed to warm the LLM stream client: {e} \n {traceback.format_exc()}")
+            time.sleep(self.keepalive / 4)
+
+    def acquire(self) -> httpx.Client:
+        return self.clients[next(self.index) % len(self.clients)]
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 3) if requests else 0,
+                "clients": len(self.clients),
+            }
+
+
+LLM_CLIENT_POOL = LLMClientPool()
@@ -0,0 +1,142 @@
+"""
+Async streaming of LLM answers with enforced deadlines.
+
+Answers used to be generated in a thread blocking on the OpenAI stream (safe_predict waited with a timeout that
+didn't unblock the caller: leaving its ThreadPoolExecutor joined the hung request). Streams now run as tasks on one
+event loop thread, sharing one httpx.AsyncClient (connection pool) across every session:
+
+* LLM_FIRST_TOKEN_DEADLINE bounds the time to the first token, LLM_TOTAL_DEADLINE the whole answer. Past a deadline
+  the task is cancelled, which aborts the HTTP request.
+* cancelling the concurrent future returned by submit (Generation.cancel, see generation.py) cancels the task the
+  same way, before the first token included.
+* answers are hedged: without a first token past the LLM_HEDGE_PERCENTILE of the recent first token latencies of the
+  model, the same prompt is sent to the hedge LLM (see ChainFactory.hedge_llm) and the first stream to get a token
+  wins, the other is cancelled. No hedging before LLM_HEDGE_MIN_SAMPLES latencies of the model are known.
+"""
+import asyncio
+import concurrent.futures
+import os
+import threading
+from collections import deque
+from typing import Coroutine, Deque, Dict, Optional
+
+import httpx
+
+from interviewai import LoggerMixed
+
+logger = LoggerMixed(__name__)
+
+LLM_FIRST_TOKEN_DEADLINE = float(os.environ.get("LLM_FIRST_TOKEN_DEADLINE", 20))  # seconds
+LLM_TOTAL_DEADLINE = float(os.environ.get("LLM_TOTAL_DEADLINE", 60 * 2))  # seconds
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 1000))
+LLM_KEEPALIVE = 120  # seconds an idle connection is kept
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", 95))
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_LATENCY_WINDOW = 200  # first token latencies kept per model
+
+
+class LLMDeadlineExceeded(Exception):
+    def __init__(self, phase: str, deadline: float) -> None:
+        super().__init__(f"no {phase} within {deadline}s")
+        self.phase = phase  # "first token" or "answer"
+
+
+class LLMStreamRunner:
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        # used from the loop thread only
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(LLM_TOTAL_DEADLINE, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=100, keepalive_expiry=LLM_KEEPALIVE
+            ),
+        )
+        self.lock = threading.Lock()
+        self.started = False
+        self.active = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.first_token_timeouts = 0
+        self.total_timeouts = 0
+        self.first_tokens = 0
+        self.first_token_seconds = 0.0
+        self.latencies: Dict[str, Deque[float]] = {}  # model -> recent first token latencies
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        t = threading.Thread(target=self.loop.run_forever, args=(), daemon=True, name="llm-stream-loop")
+        t.start()
+
+    def submit(self, coroutine: Coroutine) -> concurrent.futures.Future:
+        if not self.started:
+            self.start()
+        return asyncio.run_coroutine_threadsafe(self.track(coroutine), self.loop)
+
+    async def track(self, coroutine: Coroutine):
+        with self.lock:
+            self.active += 1
+        try:
+            result = await coroutine
+        except asyncio.CancelledError:
+            with self.lock:
+                self.cancelled += 1
+            raise
+        except LLMDeadlineExceeded as e:
+            with self.lock:
+                if e.phase == "first token":
+                    self.first_token_timeouts += 1
+                else:
+                    self.total_timeouts += 1
+            raise
+        else:
+            with self.lock:
+                self.completed += 1
+            return result
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def record_first_token(self, seconds: float, model: str = None, hedge_won: bool = False):
+        # seconds since the request to the model, a hedge winning included
+        with self.lock:
+            self.first_tokens += 1
+            self.first_token_seconds += seconds
+            if model is not None:
+                self.latencies.setdefault(model, deque(maxlen=LLM_LATENCY_WINDOW)).append(seconds)
+            if hedge_won:
+                self.hedge_wins += 1
+
+    def record_hedge(self):
+        with self.lock:
+            self.hedged += 1
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        """
+        Seconds without a first token from model before hedging, None while too few latencies are known.
+        """
+        with self.lock:
+            latencies = sorted(self.latencies.get(model, ()))
+        if len(latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[min(int(len(latencies) * LLM_HEDGE_PERCENTILE / 100), len(latencies) - 1)]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "active": self.active,
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "first_token_timeouts": self.first_token_timeouts,
+                "total_timeouts": self.total_timeouts,
+                "avg_first_token_ms": int(self.first_token_seconds * 1000 / self.first_tokens) if self.first_tokens else 0,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+            }
+
+
+LLM_STREAM_RUNNER = LLMStreamRunner()
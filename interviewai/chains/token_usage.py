@@ -0,0 +1,69 @@
+"""
+Token accounting of the answers, off the request path.
+
+InterviewChain.run used to count the tokens of the whole prompt before calling the LLM and of the whole answer after,
+two tiktoken passes on the request path only to feed the cost callback. The streams now hand what they sent and got
+(the answer streamed so far when cut short by a cancel or a deadline) to one background thread, which counts the tokens
+before calling the cost callback.
+
+The provider can report the usage at the end of the stream (stream_options.include_usage), the pinned langchain-openai
+doesn't surface it, so the tokens are always counted here.
+"""
+import queue
+import threading
+import traceback
+from typing import Callable
+
+from interviewai import LoggerMixed
+
+logger = LoggerMixed(__name__)
+
+
+class TokenUsageMeter:
+    def __init__(self) -> None:
+        self.queue: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = False
+        self.counted = 0  # answers the tokens of which were counted
+        self.failed = 0
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        t = threading.Thread(target=self.run, args=(), daemon=True, name="token-usage")
+        t.start()
+
+    def bill(self, llm, cost_callback: Callable[[int, int], None], prompt: str, result: str):
+        """
+        Bill an answer to cost_callback once its tokens are counted.
+        """
+        if not self.started:
+            self.start()
+        self.queue.put((llm, cost_callback, prompt, result))
+
+    def run(self):
+        while True:
+            llm, cost_callback, prompt, result = self.queue.get()
+            try:
+                prompt_tokens = llm.get_num_tokens(prompt)
+                result_tokens = llm.get_num_tokens(result) if result else 0
+                cost_callback(prompt_tokens, result_tokens)
+                with self.lock:
+                    self.counted += 1
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                logger.error(f"failed to bill an answer: {e} \n {traceback.format_exc()}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "pending": self.queue.qsize(),
+                "counted": self.counted,
+                "failed": self.failed,
+            }
+
+
+TOKEN_USAGE_METER = TokenUsageMeter()
@@ -0,0 +1,255 @@
+"""
+Write-behind persistence of the chat history.
+
+Transcripts used to be written one by one with an ArrayUnion on the `requests` array of the session document,
+each write rewriting a document growing towards the 1 MB limit. They are now buffered per session and flushed in
+batched commits (every CHAT_HISTORY_FLUSH_INTERVAL seconds, or as soon as CHAT_HISTORY_BATCH_SIZE transcripts are
+buffered) as append-only, sequence numbered segments:
+
+users/{user_id}/sessions/{interview_session_id}/history/{seq:08d}  {"seq": 3, "requests": [<Transcript json>, ...]}
+
+Sessions written before still have their `requests` array, load_chat_history migrates it to segment 0 on read.
+
+Segments are created, never overwritten: a worker flushing a session that moved to another worker meanwhile (reconnect,
+drain) can't reuse a seq the other one wrote, its commit fails and is retried with the seq read again.
+"""
+import os
+import threading
+import time
+import traceback
+from typing import Dict, List, Tuple
+
+from google.api_core.exceptions import AlreadyExists
+
+from interviewai import LoggerMixed
+from interviewai.firebase import firestore, get_fs_client
+from interviewai.tools.data_structure import Transcript
+
+logger = LoggerMixed(__name__)
+
+CHAT_HISTORY_FLUSH_INTERVAL = float(os.environ.get("CHAT_HISTORY_FLUSH_INTERVAL", 2))  # seconds
+CHAT_HISTORY_BATCH_SIZE = int(os.environ.get("CHAT_HISTORY_BATCH_SIZE", 20))  # transcripts, flush right away
+SEGMENT_MAX_REQUESTS = 100  # transcripts per segment document
+FIRESTORE_BATCH_LIMIT = 500  # writes per batched commit
+SEGMENT_COLLISION_RETRIES = 3  # flush attempts when a segment seq was taken by another worker
+
+SessionKey = Tuple[str, str]  # (user_id, interview_session_id)
+
+
+def get_history_ref(user_id, interview_session_id):
+    fs = get_fs_client()
+    return (
+        fs.collection("users")
+        .document(user_id)
+        .collection("sessions")
+        .document(interview_session_id)
+        .collection("history")
+    )
+
+
+def segment_id(seq: int) -> str:
+    # zero padded so the document ids sort like the sequence numbers
+    return f"{seq:08d}"
+
+
+def migrate_chat_history(user_id, interview_session_id, requests: List[str]) -> int:
+    """
+    Move the legacy `requests` array of a session document to segment 0, return the next sequence number.
+    """
+    fs = get_fs_client()
+    history = get_history_ref(user_id, interview_session_id)
+    batch = fs.batch()
+    for i in range(0, len(requests), SEGMENT_MAX_REQUESTS):
+        seq = i // SEGMENT_MAX_REQUESTS
+        batch.set(history.document(segment_id(seq)), {"seq": seq, "requests": requests[i:i + SEGMENT_MAX_REQUESTS]})
+    batch.update(history.parent, {"requests": firestore.DELETE_FIELD})
+    batch.commit()
+    logger.info(f"migrated {len(requests)} chat history entries to segments", user_id=user_id,
+                interview_session_id=interview_session_id)
+    return (len(requests) + SEGMENT_MAX_REQUESTS - 1) // SEGMENT_MAX_REQUESTS
+
+
+def load_chat_history(user_id, interview_session_id, session_data: dict) -> List[str]:
+    """
+    Chat history of a session in order (Transcript json strings): the persisted segments, then the transcripts
+    still buffered by the writer. session_data is the session document, its legacy `requests` array is migrated.
+    """
+    requests = []
+    legacy = session_data.get("requests") or []
+    # no flush in between: an entry committed after the segments were read would be in neither list
+    with CHAT_HISTORY_WRITER.flush_lock:
+        segments = get_history_ref(user_id, interview_session_id).order_by("seq").stream()
+        for segment in segments:
+            requests.extend(segment.get("requests"))
+        pending = CHAT_HISTORY_WRITER.pending(user_id, interview_session_id)
+    if legacy and not requests:
+        next_seq = migrate_chat_history(user_id, interview_session_id, legacy)
+        CHAT_HISTORY_WRITER.set_next_seq((user_id, interview_session_id), next_seq)
+        requests = list(legacy)
+    return requests + pending
+
+
+class ChatHistoryWriter:
+    """
+    One background thread flushing the buffered transcripts of every session of the worker.
+    """
+
+    def __init__(
+            self,
+            flush_interval: float = CHAT_HISTORY_FLUSH_INTERVAL,
+            batch_size: int = CHAT_HISTORY_BATCH_SIZE,
+    ) -> None:
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.buffers: Dict[SessionKey, List[str]] = {}
+        self.dirty_since: Dict[SessionKey, float] = {}  # session -> monotonic time of its oldest unflushed entry
+        self.next_seq: Dict[SessionKey, int] = {}
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()  # one flush at a time, sequence numbers are assigned in it
+        self.started = False
+        self.flushes = 0
+        self.segments = 0
+
+    def start(self):
+        with self.condition:
+            if self.started:
+                return
+            self.started = True
+        t = threading.Thread(target=self.run, args=(), daemon=True)
+        t.start()
+
+    def append(self, user_id: str, interview_session_id: str, transcript: Transcript):
+        key = (user_id, interview_session_id)
+        with self.condition:
+            buffer = self.buffers.setdefault(key, [])
+            buffer.append(transcript.json())
+            self.dirty_since.setdefault(key, time.monotonic())
+            if len(buffer) == 1 or len(buffer) >= self.batch_size:
+                # new deadline or batch full
+                self.condition.notify()
+
+    def pending(self, user_id: str, interview_session_id: str) -> List[str]:
+        with self.condition:
+            return list(self.buffers.get((user_id, interview_session_id), ()))
+
+    def set_next_seq(self, key: SessionKey, seq: int):
+        with self.flush_lock:
+            self.next_seq[key] = max(self.next_seq.get(key, 0), seq)
+
+    def _next_seq(self, key: SessionKey) -> int:
+        if key not in self.next_seq:
+            last = list(get_history_ref(*key).order_by("seq", direction=firestore.Query.DESCENDING).limit(1).stream())
+            self.next_seq[key] = last[0].get("seq") + 1 if last else 0
+        return self.next_seq[key]
+
+    def flush(self, keys: List[SessionKey] = None):
+        """
+        Write the buffered transcripts of keys (every session by default) as new segments, in batched commits.
+        Entries stay in the buffer (and in pending) until their commit succeeded, a failed one is retried.
+        """
+        for attempt in range(SEGMENT_COLLISION_RETRIES):
+            try:
+                self._flush(keys)
+                return
+            except AlreadyExists as e:
+                if attempt == SEGMENT_COLLISION_RETRIES - 1:
+                    raise
+                logger.info(f"chat history segment written by another worker, retrying with the next seq: {e}")
+
+    def _flush(self, keys: List[SessionKey] = None):
+        with self.flush_lock:
+            with self.condition:
+                keys = [key for key in (keys if keys is not None else list(self.buffers)) if self.buffers.get(key)]
+                taken = {key: list(self.buffers[key]) for key in keys}
+            writes: List[Tuple[SessionKey, int, List[str]]] = []
+            for key, requests in taken.items():
+                seq = self._next_seq(key)
+                for i in range(0, len(requests), SEGMENT_MAX_REQUESTS):
+                    writes.append((key, seq, requests[i:i + SEGMENT_MAX_REQUESTS]))
+                    seq += 1
+            fs = get_fs_client()
+            for i in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+                chunk = writes[i:i + FIRESTORE_BATCH_LIMIT]
+                batch = fs.batch()
+                for key, seq, requests in chunk:
+                    batch.create(get_history_ref(*key).document(segment_id(seq)), {"seq": seq, "requests": requests})
+                try:
+                    batch.commit()
+                except AlreadyExists:
+                    # the seq of a session is stale, read again on the next attempt. the batch wrote nothing
+                    for key, _, _ in chunk:
+                        self.next_seq.pop(key, None)
+                    raise
+                with self.condition:
+                    for key, seq, requests in chunk:
+                        self.next_seq[key] = seq + 1
+                        buffer = self.buffers.get(key, [])
+                        del buffer[:len(requests)]
+                        if buffer:
+                            self.dirty_since[key] = time.monotonic()
+                        else:
+                            self.buffers.pop(key, None)
+                            self.dirty_since.pop(key, None)
+                self.flushes += 1
+                self.segments += len(chunk)
+
+    def close(self, user_id: str, interview_session_id: str):
+        """
+        Flush a session that is ending and forget it. A failed flush doesn't fail the session's stop, its entries stay
+        buffered and the background thread retries them.
+        """
+        key = (user_id, interview_session_id)
+        try:
+            self.flush([key])
+        except Exception as e:
+            logger.error(f"failed to flush the chat history of an ending session, retried in the background: {e}",
+                         user_id=user_id, interview_session_id=interview_session_id)
+            with self.condition:
+                if key in self.dirty_since:
+                    self.dirty_since[key] = time.monotonic()
+                    self.condition.notify()
+            return
+        with self.flush_lock:
+            self.next_seq.pop(key, None)
+
+    def _due(self) -> Tuple[List[SessionKey], float]:
+        # sessions to flush now, and seconds until the next one is due (None: nothing buffered)
+        now = time.monotonic()
+        due, wait = [], None
+        for key, since in self.dirty_since.items():
+            remaining = since + self.flush_interval - now
+            if remaining <= 0 or len(self.buffers.get(key, ())) >= self.batch_size:
+                due.append(key)
+            else:
+                wait = remaining if wait is None else min(wait, remaining)
+        return due, wait
+
+    def run(self):
+        while True:
+            with self.condition:
+                due, wait = self._due()
+                while not due:
+                    # no wakeups while nothing is buffered
+                    self.condition.wait(timeout=wait)
+                    due, wait = self._due()
+            try:
+                self.flush(due)
+            except Exception as e:
+                logger.error(f"failed to flush chat history: {e} \n {traceback.format_exc()}")
+                # the entries stay buffered, retry them after an interval
+                with self.condition:
+                    for key in due:
+                        if key in self.dirty_since:
+                            self.dirty_since[key] = time.monotonic()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "buffered": sum(len(buffer) for buffer in self.buffers.values()),
+                "sessions": len(self.buffers),
+                "flushes": self.flushes,
+                "segments": self.segments,
+            }
+
+
+CHAT_HISTORY_WRITER = ChatHistoryWriter()
@@ -0,0 +1,137 @@
+"""
+socket client <-> user registry of the session manager.
+
+Both directions are indexed and kept up to date on every add/remove, so lookups are O(1) instead of rebuilding
+user -> clients from client -> user on each access. Writes are serialized per user with striped locks: socket.io
+handler threads of different users don't contend, connect/disconnect of the same user can't interleave.
+
+Benchmark (10k connect/disconnect events against the old scan based map):
+python -m interviewai.client_registry
+"""
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+LOCK_STRIPES = 64
+
+
+class ClientRegistry:
+    def __init__(self, stripes: int = LOCK_STRIPES):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._client_to_user: Dict[str, str] = {}  # socket_id -> user_id
+        self._user_to_clients: Dict[str, Set[str]] = {}  # user_id -> socket_ids
+
+    def _lock(self, user_id: str) -> threading.Lock:
+        return self._locks[hash(user_id) % len(self._locks)]
+
+    def add(self, client_id: str, user_id: str) -> None:
+        previous = self._client_to_user.get(client_id)
+        if previous is not None and previous != user_id:
+            self.remove(client_id)
+        with self._lock(user_id):
+            self._client_to_user[client_id] = user_id
+            self._user_to_clients.setdefault(user_id, set()).add(client_id)
+
+    def remove(self, client_id: str) -> Tuple[Optional[str], bool]:
+        """
+        Returns (user_id, whether the user still has other clients). user_id is None for an unknown client.
+        """
+        user_id = self._client_to_user.get(client_id)
+        if user_id is None:
+            return None, False
+        with self._lock(user_id):
+            if self._client_to_user.get(client_id) != user_id:
+                # removed (or moved) by another thread in between
+                return None, False
+            del self._client_to_user[client_id]
+            clients = self._user_to_clients[user_id]
+            clients.discard(client_id)
+            if not clients:
+                del self._user_to_clients[user_id]
+                return user_id, False
+            return user_id, True
+
+    def user_of(self, client_id: str) -> Optional[str]:
+        return self._client_to_user.get(client_id)
+
+    def clients_of(self, user_id: str) -> List[str]:
+        with self._lock(user_id):
+            return list(self._user_to_clients.get(user_id, ()))
+
+    def has_clients(self, user_id: str) -> bool:
+        return user_id in self._user_to_clients
+
+    def users(self) -> List[str]:
+        return list(self._user_to_clients)
+
+    def __contains__(self, client_id: str) -> bool:
+        return client_id in self._client_to_user
+
+    def __len__(self) -> int:
+        return len(self._client_to_user)
+
+    def __repr__(self) -> str:
+        return f"ClientRegistry({dict(self._client_to_user)})"
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    EVENTS = 10_000
+    USERS = 2_000
+
+    def scan_user_to_clients(client_to_user: Dict[str, str]) -> Dict[str, List[str]]:
+        # what InterviewSessionManager.user_to_clients did on every call
+        result = {}
+        for client, user in client_to_user.items():
+            result.setdefault(user, []).append(client)
+        return result
+
+    random.seed(0)
+    # connect every client first, then disconnect them in random order (a disconnect storm)
+    clients = [(f"sid-{i}", f"user-{random.randrange(USERS)}") for i in range(EVENTS // 2)]
+    disconnects = random.sample(clients, len(clients))
+
+    start = time.perf_counter()
+    legacy: Dict[str, str] = {}
+    for client_id, user_id in clients:
+        legacy[client_id] = user_id
+        user_id in scan_user_to_clients(legacy)  # add_new_connection -> check_any_clients
+    for client_id, user_id in disconnects:
+        del legacy[client_id]
+        scan_user_to_clients(legacy).get(user_id)  # remove_client -> check_any_clients
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    registry = ClientRegistry()
+    for client_id, user_id in clients:
+        registry.add(client_id, user_id)
+        registry.has_clients(user_id)
+    for client_id, _ in disconnects:
+        registry.remove(client_id)
+    registry_time = time.perf_counter() - start
+    assert len(registry) == 0 and not registry.users()
+
+    # same storm from 8 threads, the indexes have to end up empty and consistent
+    registry = ClientRegistry()
+    chunks = [clients[i::8] for i in range(8)]
+
+    def connect_disconnect(chunk):
+        for client_id, user_id in chunk:
+            registry.add(client_id, user_id)
+        for client_id, _ in chunk:
+            registry.remove(client_id)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=connect_disconnect, args=(chunk,)) for chunk in chunks]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    threaded_time = time.perf_counter() - start
+    assert len(registry) == 0 and not registry.users()
+
+    print(f"{EVENTS} connect/disconnect events, {USERS} users")
+    print(f"scan based map:        {legacy_time * 1000:9.1f}ms")
+    print(f"ClientRegistry:        {registry_time * 1000:9.1f}ms ({legacy_time / registry_time:.0f}x)")
+    print(f"ClientRegistry 8 thr:  {threaded_time * 1000:9.1f}ms")
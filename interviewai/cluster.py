@@ -0,0 +1,267 @@
+"""
+Scale-out support: several server workers (processes or pods) behind one load balancer.
+
+* Session registry: which worker owns which user_id. A user's InterviewSession only lives on its owner worker,
+  a connection that lands on another worker is refused with the owner's worker_id so the client can reconnect
+  with `?worker_id=<owner>` and the load balancer can route it (e.g. nginx `hash $arg_worker_id`).
+* Message queue: a pub/sub client manager for socket.io, so `sio.emit(room=...)` from any worker reaches
+  clients connected to every other worker.
+
+Both are configured with environment variables and default to the single worker behaviour:
+SOCKETIO_MESSAGE_QUEUE=redis://host:6379/0   (or memory:// for the in-process stand-in)
+SESSION_REGISTRY_URL=redis://host:6379/0     (defaults to SOCKETIO_MESSAGE_QUEUE)
+WORKER_ID=api-0                              (defaults to hostname-pid)
+"""
+import asyncio
+import os
+import queue
+import socket
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+import socketio
+
+from interviewai import LoggerMixed
+
+logger = LoggerMixed(__name__)
+
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+SESSION_REGISTRY_URL = os.environ.get("SESSION_REGISTRY_URL", SOCKETIO_MESSAGE_QUEUE)
+SESSION_OWNER_TTL = 30  # seconds, owner has to refresh its claims within this window
+
+
+class SessionOwnedElsewhere(Exception):
+    def __init__(self, user_id: str, worker_id: str):
+        self.user_id = user_id
+        self.worker_id = worker_id
+        super().__init__(f"interview session of {user_id} is owned by worker {worker_id}")
+
+
+class WorkerDraining(Exception):
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        super().__init__(f"worker {worker_id} is draining, reconnect to another worker")
+
+
+class SessionRegistry:
+    """
+    user_id -> worker_id ownership with a TTL.
+    claim returns the current owner, which is WORKER_ID if this worker got (or already had) the claim.
+    """
+
+    def __init__(self, ttl: int = SESSION_OWNER_TTL):
+        self.ttl = ttl
+
+    def claim(self, user_id: str) -> str:
+        raise NotImplementedError
+
+    def owner(self, user_id: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def refresh(self, user_id: str) -> bool:
+        raise NotImplementedError
+
+    def release(self, user_id: str) -> None:
+        raise NotImplementedError
+
+
+class InMemorySessionRegistry(SessionRegistry):
+    """
+    Process local registry. Default for a single worker, and a stand-in for the redis registry in tests
+    (pass different worker_id to simulate several workers sharing it).
+    """
+
+    def __init__(self, ttl: int = SESSION_OWNER_TTL, worker_id: str = WORKER_ID):
+        super().__init__(ttl)
+        self.worker_id = worker_id
+        self.owners: Dict[str, Tuple[str, float]] = {}  # user_id -> (worker_id, expires_at)
+        self.lock = threading.Lock()
+
+    def _live_owner(self, user_id: str) -> Optional[str]:
+        if user_id not in self.owners:
+            return None
+        worker_id, expires_at = self.owners[user_id]
+        if expires_at < time.monotonic():
+            del self.owners[user_id]
+            return None
+        return worker_id
+
+    def claim(self, user_id: str) -> str:
+        with self.lock:
+            owner = self._live_owner(user_id)
+            if owner is None or owner == self.worker_id:
+                self.owners[user_id] = (self.worker_id, time.monotonic() + self.ttl)
+                return self.worker_id
+            return owner
+
+    def owner(self, user_id: str) -> Optional[str]:
+        with self.lock:
+            return self._live_owner(user_id)
+
+    def refresh(self, user_id: str) -> bool:
+        with self.lock:
+            if self._live_owner(user_id) != self.worker_id:
+                return False
+            self.owners[user_id] = (self.worker_id, time.monotonic() + self.ttl)
+            return True
+
+    def release(self, user_id: str) -> None:
+        with self.lock:
+            if self._live_owner(user_id) == self.worker_id:
+                del self.owners[user_id]
+
+
+# only touch the key if we still own it
+_REFRESH_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) else return 0 end
+"""
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end
+"""
+
+
+class RedisSessionRegistry(SessionRegistry):
+    """
+    Shared registry for several workers / pods.
+    """
+
+    def __init__(self, url: str, ttl: int = SESSION_OWNER_TTL, worker_id: str = WORKER_ID):
+        import redis
+
+        super().__init__(ttl)
+        self.worker_id = worker_id
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self._refresh = self.redis.register_script(_REFRESH_SCRIPT)
+        self._release = self.redis.register_script(_RELEASE_SCRIPT)
+
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"interviewai:session_owner:{user_id}"
+
+    def claim(self, user_id: str) -> str:
+        key = self._key(user_id)
+        for _ in range(2):
+            if self.redis.set(key, self.worker_id, nx=True, ex=self.ttl):
+                return self.worker_id
+            owner = self.redis.get(key)
+            if owner == self.worker_id:
+                self.refresh(user_id)
+                return owner
+            if owner is not None:
+                return owner
+            # key expired between SET NX and GET, try again
+        return self.redis.get(key) or self.worker_id
+
+    def owner(self, user_id: str) -> Optional[str]:
+        return self.redis.get(self._key(user_id))
+
+    def refresh(self, user_id: str) -> bool:
+        return bool(self._refresh(keys=[self._key(user_id)], args=[self.worker_id, self.ttl]))
+
+    def release(self, user_id: str) -> None:
+        self._release(keys=[self._key(user_id)], args=[self.worker_id])
+
+
+def get_session_registry() -> SessionRegistry:
+    if SESSION_REGISTRY_URL and SESSION_REGISTRY_URL.startswith(("redis://", "rediss://")):
+        logger.info(f"worker {WORKER_ID} using redis session registry")
+        return RedisSessionRegistry(SESSION_REGISTRY_URL)
+    return InMemorySessionRegistry()
+
+
+##########################
+### socket.io pub/sub ###
+##########################
+class InMemoryBus:
+    """
+    Fan-out of published messages to every subscriber of a channel, inside one process.
+    """
+
+    def __init__(self):
+        self.subscribers = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def subscribe(self, channel: str, subscriber):
+        with self.lock:
+            self.subscribers[channel].append(subscriber)
+
+    def publish(self, channel: str, data: dict):
+        with self.lock:
+            subscribers = list(self.subscribers[channel])
+        for subscriber in subscribers:
+            subscriber(data)
+
+
+memory_bus = InMemoryBus()
+
+
+class InMemoryManager(socketio.PubSubManager):
+    """
+    Redis-compatible stand-in for socketio.RedisManager. Several servers in the same process
+    sharing a bus behave like several workers sharing a redis channel.
+    """
+    name = "memory"
+
+    def __init__(self, channel="socketio", write_only=False, logger=None, bus: InMemoryBus = memory_bus):
+        self.bus = bus
+        self.inbox = queue.Queue()
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def initialize(self):
+        if not self.write_only:
+            self.bus.subscribe(self.channel, self.inbox.put)
+        super().initialize()
+
+    def _publish(self, data):
+        self.bus.publish(self.channel, data)
+
+    def _listen(self):
+        while True:
+            yield self.inbox.get()
+
+
+class AsyncInMemoryManager(socketio.AsyncPubSubManager):
+    """
+    asyncio version of InMemoryManager for the asyncio server mode.
+    """
+    name = "asyncmemory"
+
+    def __init__(self, channel="socketio", write_only=False, logger=None, bus: InMemoryBus = memory_bus):
+        self.bus = bus
+        self.inbox: asyncio.Queue = None
+        self.loop: asyncio.AbstractEventLoop = None
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _deliver(self, data):
+        if self.inbox is not None:
+            self.loop.call_soon_threadsafe(self.inbox.put_nowait, data)
+
+    async def _publish(self, data):
+        self.bus.publish(self.channel, data)
+
+    async def _listen(self):
+        self.loop = asyncio.get_running_loop()
+        self.inbox = asyncio.Queue()
+        self.bus.subscribe(self.channel, self._deliver)
+        while True:
+            yield await self.inbox.get()
+
+
+def get_client_manager(async_mode: bool = False):
+    """
+    socket.io client manager for SOCKETIO_MESSAGE_QUEUE, None means the default process local manager.
+    """
+    url = SOCKETIO_MESSAGE_QUEUE
+    if not url:
+        return None
+    logger.info(f"worker {WORKER_ID} using socket.io message queue {url.split('://')[0]}")
+    if url.startswith("memory://"):
+        return AsyncInMemoryManager() if async_mode else InMemoryManager()
+    if url.startswith(("redis://", "rediss://")):
+        return socketio.AsyncRedisManager(url) if async_mode else socketio.RedisManager(url)
+    if async_mode:
+        return socketio.AsyncAioPikaManager(url)
+    return socketio.KombuManager(url)
@@ -3,6 +3,7 @@ import logging
 import fitz
 import traceback
 from typing import List
+from interviewai.chains.answer_cache import ANSWER_CACHE
 from interviewai.db.index import UserIndexHelper, InterviewNamespace, index
 from interviewai.firebase import get_fs_client
 from datetime import datetime
@@ -48,6 +49,8 @@ def index_user_material(user_id, filename, file_id):
         "index_ids": index_ids,
         "indexed_at": datetime.now(),
     })
+    # cached answers were based on the previous materials
+    ANSWER_CACHE.invalidate(user_id)
 
     return True
 
@@ -63,6 +66,7 @@ def delete_material_index(user_id, file_id):
             return False
         ref.update({"index_ids": fstore.DELETE_FIELD, "is_archived": True})
         index.delete(ids=index_ids, namespace=NAMESPACE.value)
+        ANSWER_CACHE.invalidate(user_id)
         logging.info(f"Successfully deleted index from user{user_id} file {file_id}")
         return True
     except Exception as e:
@@ -0,0 +1,152 @@
+"""
+Outbound gateway for every socket.io emit of the interview sessions.
+
+* LLM tokens are coalesced per (room, stream topic) for EMIT_TOKEN_WINDOW_MS and sent as one chat_token /
+  coach_token event, the buffer is flushed right away when the stream ends. Clients already concatenate tokens.
+* One dispatcher thread sends the queued events by lane: tokens, control (busy/ready status), transcripts, history.
+* Every emit must name a room or a sid, nothing is broadcast to all connected clients.
+* Events and payload bytes sent are counted per event name, see stats() (exposed on /health).
+"""
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import defaultdict
+from enum import IntEnum
+from typing import Dict, List, Optional, Tuple
+
+from interviewai import LoggerMixed
+
+logger = LoggerMixed(__name__)
+
+EMIT_TOKEN_WINDOW_MS = int(os.environ.get("EMIT_TOKEN_WINDOW_MS", 30))
+
+
+class Lane(IntEnum):
+    TOKEN = 0
+    CONTROL = 1
+    TRANSCRIPT = 2
+    HISTORY = 3
+
+
+EVENT_LANES = {
+    "chat_token": Lane.TOKEN,
+    "coach_token": Lane.TOKEN,
+    "streaming_interviewer": Lane.TRANSCRIPT,
+    "streaming_interviewee": Lane.TRANSCRIPT,
+    "chat_history": Lane.HISTORY,
+    "chat_persisted": Lane.HISTORY,
+    "chat_resync": Lane.HISTORY,
+}
+
+
+class EmitGateway:
+    """
+    Drop-in for the SocketIO / AsyncSocketIOBridge `emit` used by session code, plus emit_token / end_stream
+    for streamed LLM output. Calls never block on the network, the dispatcher thread does the sending.
+    """
+
+    def __init__(self, sio, token_window_ms: int = EMIT_TOKEN_WINDOW_MS):
+        self.sio = sio
+        self.token_window = token_window_ms / 1000
+        # (lane, seq, event, data, target), event None only wakes the dispatcher up
+        self.outbox = queue.PriorityQueue()
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.token_buffers: Dict[Tuple[str, str], List[str]] = {}  # (room, topic) -> tokens
+        self.flush_at: Dict[Tuple[str, str], float] = {}  # (room, topic) -> monotonic deadline
+        self.counters = defaultdict(lambda: [0, 0])  # event -> [events, bytes]
+
+    def start(self):
+        t = threading.Thread(target=self.dispatch, args=(), daemon=True)
+        t.start()
+
+    @staticmethod
+    def _target(room: Optional[str], to: Optional[str]) -> dict:
+        if to is not None:
+            return {"to": to}
+        if room is not None:
+            return {"room": room}
+        raise ValueError("emit needs a room or a sid, refusing to broadcast to every client")
+
+    def _put(self, lane: Lane, event: Optional[str], data=None, target: dict = None):
+        self.outbox.put((lane, next(self.seq), event, data, target))
+
+    def emit(self, event: str, data=None, room: str = None, to: str = None, lane: Lane = None):
+        target = self._target(room, to)
+        self._put(EVENT_LANES.get(event, Lane.CONTROL) if lane is None else lane, event, data, target)
+
+    def emit_token(self, topic: str, token: str, room: str):
+        if self.token_window <= 0:
+            self._put(Lane.TOKEN, topic, {"token": token, "end": False}, {"room": room})
+            return
+        key = (room, topic)
+        with self.lock:
+            if key in self.token_buffers:
+                self.token_buffers[key].append(token)
+                return
+            self.token_buffers[key] = [token]
+            self.flush_at[key] = time.monotonic() + self.token_window
+        # new deadline, the dispatcher may be blocked without a timeout
+        self._put(Lane.TOKEN, None)
+
+    def end_stream(self, topic: str, room: str):
+        with self.lock:
+            self._flush_tokens((room, topic))
+            self._put(Lane.TOKEN, topic, {"token": "", "end": True}, {"room": room})
+
+    def _flush_tokens(self, key: Tuple[str, str]):
+        # caller holds self.lock, so a flush and the end marker of the same stream keep their order
+        tokens = self.token_buffers.pop(key, None)
+        self.flush_at.pop(key, None)
+        if tokens:
+            room, topic = key
+            self._put(Lane.TOKEN, topic, {"token": "".join(tokens), "end": False}, {"room": room})
+
+    def _flush_due(self) -> Optional[float]:
+        """
+        Flush the token buffers whose window elapsed, returns seconds until the next deadline.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for key in [key for key, deadline in self.flush_at.items() if deadline <= now]:
+                self._flush_tokens(key)
+            if not self.flush_at:
+                return None
+            return max(min(self.flush_at.values()) - now, 0)
+
+    def _send(self, event: str, data, target: dict):
+        try:
+            self.sio.emit(event, data, **target)
+        except Exception as e:
+            logger.error(f"failed to emit {event}: {e} \n {traceback.format_exc()}")
+            return
+        counter = self.counters[event]
+        counter[0] += 1
+        if isinstance(data, (bytes, str)):
+            counter[1] += len(data)
+        elif data is not None:
+            counter[1] += len(json.dumps(data, default=str))
+
+    def dispatch(self):
+        timeout = None
+        while True:
+            try:
+                _, _, event, data, target = self.outbox.get(timeout=timeout)
+            except queue.Empty:
+                event = None
+            timeout = self._flush_due()
+            if event is not None:
+                self._send(event, data, target)
+
+    def stats(self) -> dict:
+        events = {event: {"events": count, "bytes": size} for event, (count, size) in list(self.counters.items())}
+        return {
+            "events": sum(e["events"] for e in events.values()),
+            "bytes": sum(e["bytes"] for e in events.values()),
+            "queued": self.outbox.qsize(),
+            "by_event": events,
+        }
@@ -10,3 +10,11 @@ def get_env():
     except Exception as e:
         print(e)
         return "dev"
+
+
+def get_server_mode():
+    """
+    "threading": flask-socketio with threads (gunicorn, application.py)
+    "asyncio": python-socketio AsyncServer on an ASGI server (uvicorn, asgi.py)
+    """
+    return os.environ.get("SERVER_MODE", "threading")
@@ -1,4 +1,5 @@
 import json
+import threading
 
 import firebase_admin
 from firebase_admin import credentials, firestore
@@ -65,17 +66,6 @@ def get_goal_dict(goal_id, user_id):
     return ref.get().to_dict()
 
 
-def insert_chat_history(user_id, interview_session_id, chat_history):
-    fs = get_fs_client()
-    ref = (
-        fs.collection("users")
-        .document(user_id)
-        .collection("sessions")
-        .document(interview_session_id)
-    )
-    ref.update({"requests": firestore.ArrayUnion([chat_history.json()])})
-
-
 def create_interview_session(user_id, interview_session_id):
     fs = get_fs_client()
     ref = (
@@ -84,7 +74,8 @@ def create_interview_session(user_id, interview_session_id):
         .collection("sessions")
         .document(interview_session_id)
     )
-    ref.set({"active": True, "requests": [], "created_by_backend": True})
+    # chat history is stored in the history subcollection (see interviewai/chat_history.py)
+    ref.set({"active": True, "created_by_backend": True})
 
 
 def archive_session(user_id, interview_session_id):
@@ -98,6 +89,52 @@ def archive_session(user_id, interview_session_id):
     ref.update({"archived": True, "active": False})
 
 
+class CachedSessionDocument:
+    """
+    In-memory view of users/{user_id}/sessions/{interview_session_id}.
+    Loaded once, then kept fresh by a firestore on_snapshot listener so reads never go to the network.
+    """
+
+    def __init__(self, user_id, interview_session_id):
+        fs = get_fs_client()
+        self.ref = (
+            fs.collection("users")
+            .document(user_id)
+            .collection("sessions")
+            .document(interview_session_id)
+        )
+        self.data: dict = None
+        self.lock = threading.Lock()
+        self.watch = None
+
+    def _on_snapshot(self, doc_snapshots, changes, read_time):
+        for doc_snapshot in doc_snapshots:
+            self._set(doc_snapshot)
+
+    def _set(self, doc_snapshot: DocumentSnapshot):
+        self.data = doc_snapshot.to_dict() if doc_snapshot.exists else {}
+
+    def get(self) -> dict:
+        if self.data is None:
+            with self.lock:
+                if self.data is None:
+                    self.refresh()
+                    self.watch = self.ref.on_snapshot(self._on_snapshot)
+        return self.data
+
+    def refresh(self) -> dict:
+        """
+        Read the document from firestore now, e.g. when a client (re)connects.
+        """
+        self._set(self.ref.get())
+        return self.data
+
+    def close(self):
+        if self.watch is not None:
+            self.watch.unsubscribe()
+            self.watch = None
+
+
 # Prefrences
 def get_user_preference(user_id):
     fs = get_fs_client()
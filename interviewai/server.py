@@ -12,10 +12,8 @@ Output:
 Method: History
 Input: session_id
 """
-import datetime
 import logging
 import traceback
-import uuid
 
 import socketio
 import stripe
@@ -27,15 +25,24 @@ from flask_socketio import ConnectionRefusedError, SocketIO
 from interviewai import LoggerMixed
 from interviewai.ai import InterviewSession
 from interviewai.auth import verify_jwt
-from interviewai.chains.base_chain import InterviewChain
+from interviewai.cluster import SessionOwnedElsewhere, WorkerDraining, get_client_manager
 from interviewai.chains.chain_manager import CHAIN_MAP
 from interviewai.config.config import get_config
 from interviewai.db.index_material import index_user_material, delete_material_index
+from interviewai.env import get_server_mode
 from interviewai.firebase import get_user_payment
 from interviewai.session import InterviewSessionManager
-from interviewai.transcriber import Role, Transcript
+from interviewai.speech.dg import DG_WARM_POOL
+from interviewai.chains.llm_pool import LLM_CLIENT_POOL
+from interviewai.chains.answer_cache import ANSWER_CACHE
+from interviewai.chains.llm_stream import LLM_STREAM_RUNNER
+from interviewai.chains.token_usage import TOKEN_USAGE_METER
+from interviewai.chat_history import CHAT_HISTORY_WRITER
+from interviewai.tools.worker_pool import LLM_WORKER_POOL, SESSION_WORKER_POOL
+from interviewai.user_manager.credit_meter import CREDIT_METER
+from interviewai.speech import audio_ingest
 from interviewai.user_manager.clerkapi import get_user_by_id
-from interviewai.user_manager.credits_manager import CreditsManager, InterviewType
+from interviewai.user_manager.credits_manager import CreditsManager
 from interviewai.user_manager.mail import LoopsManager, LoopsUserGroup, LoopsEventName
 from interviewai.user_manager.payment import get_subscriptions, new_checkout_session, get_customer_userid, \
     price_id_from_checkout_complete, get_all_subscriptions
@@ -60,11 +67,17 @@ socketio = SocketIO(
     async_mode="threading",
     ping_timeout=120,
     cors_allowed_origins="*",
+    # pub/sub message queue so emits reach clients connected to other workers
+    client_manager=get_client_manager(),
     # logger=True,
     # engineio_logger=True,
 )
 
-im = InterviewSessionManager.new(socketio)
+# in asyncio server mode (interviewai/async_server.py) the session manager is created there
+im = InterviewSessionManager.new(socketio) if get_server_mode() == "threading" else None
+if im is not None:
+    # snapshot live sessions on SIGTERM, users resume them on another worker
+    im.install_drain_handler()
 loops = LoopsManager()
 stripe_webhook_secret = get_config("STRIPE_WEBHOOK_SECRET")
 clerk_webhook_secret = get_config("CLERK_WEBHOOK_SECRET")
@@ -77,7 +90,21 @@ def index():
 
 @app.route('/health')
 def health():
-    return jsonify({"status": "ok"}), 200
+    if im is None:
+        return jsonify({"status": "ok"}), 200
+    return jsonify({
+        "status": "ok",
+        "emit": im.gateway.stats(),
+        "admission": im.admission.stats(),
+        "warm_pool": {"dg": DG_WARM_POOL.stats(), "llm": LLM_CLIENT_POOL.stats()},
+        "chat_history": CHAT_HISTORY_WRITER.stats(),
+        "session_workers": SESSION_WORKER_POOL.stats(),
+        "llm_workers": LLM_WORKER_POOL.stats(),
+        "credit_meter": CREDIT_METER.stats(),
+        "answer_cache": ANSWER_CACHE.stats(),
+        "llm_streams": LLM_STREAM_RUNNER.stats(),
+        "token_usage": TOKEN_USAGE_METER.stats(),
+    }), 200
 
 
 # TODO: Add clerk webhook to send the email
@@ -329,6 +356,12 @@ def chain_types():
     return list(CHAIN_MAP.keys())
 
 
+@app.route(audio_ingest.AUDIO_INGEST_PATH, websocket=True)
+def audio_stream():
+    # binary PCM frames, see interviewai/speech/audio_ingest.py. asyncio mode serves this path in front of the app
+    return audio_ingest.serve_threading(request.environ, im)
+
+
 @app.route("/end_session", methods=["GET"])
 @clerk_jwt_required
 def end_session_restapi(auth):
@@ -353,8 +386,18 @@ def connect(auth):
             f"socket client id: {client_id}, user id: {connection['sub']}",
             user_id=connection["sub"],
         )
-        im.add_new_connection(connection, client_id)
-        im.socketio.emit("chain_types", list(CHAIN_MAP.keys()))
+        # last chat history entry the client has, when reconnecting: only the missing tail is sent back
+        im.add_new_connection(
+            connection, client_id, last_seq=auth.get("last_seq"), last_request_id=auth.get("last_request_id")
+        )
+        # only to the connecting client, not every connected client
+        im.gateway.emit("chain_types", list(CHAIN_MAP.keys()), to=client_id)
+    except SessionOwnedElsewhere as error:
+        # client should reconnect to the owner worker, e.g. with ?worker_id=<owner>
+        raise ConnectionRefusedError(str(error), {"worker_id": error.worker_id})
+    except WorkerDraining as error:
+        # client should reconnect, the load balancer routes it to a live worker
+        raise ConnectionRefusedError(str(error), {"draining": True})
     except Exception as error:
         logger.info(f"Not authorized client id:{request.sid}! {error}")
         logger.error(traceback.format_exc())
@@ -364,7 +407,7 @@ def connect(auth):
 @socketio.event
 def disconnect():
     try:
-        if request.sid in im.client_to_user:
+        if request.sid in im.clients:
             user = im.remove_client(request.sid)
             logger.info(
                 f"Client disconnected {request.sid}, user id: {user}", user_id=user
@@ -388,8 +431,8 @@ def chat(message):
     interview_session = im.get_interview_session_by_client(request.sid)
     interview_session.chat(message)
     # tracking
-    if request.sid in im.client_to_user:
-        user = im.client_to_user[request.sid]
+    if request.sid in im.clients:
+        user = im.clients.user_of(request.sid)
 
 
 @socketio.event
@@ -416,13 +459,10 @@ def chat_bytes(message):
 @socketio.event
 def chat_dual_channel(message):
     try:
-        if not im.has_interview_session(request.sid):
-            # if user has no interview session, return silently to save resources
-            # dont spam log because it would floot gcp cloud log and overflow RAM.
-            return
-        interview_session = im.get_interview_session_by_client_with_timeout(request.sid)
-        # TODO: if interview_session.ready:
-        interview_session.chat_bytes_dual_channel(message)
+        # never blocks: frames of a session still starting are buffered and replayed once it is ready.
+        # if user has no interview session, return silently to save resources
+        # dont spam log because it would floot gcp cloud log and overflow RAM.
+        im.feed_audio_by_client(request.sid, message["bytes"])
     except Exception as error:
         logger.debug(f"chat_dual_channel error: {error}, {traceback.format_exc()}")
 
@@ -449,8 +489,8 @@ def paused(message):
     logger.info(f"Paused: {message} client_id: {client_id}")
     im.pause_resume_by_client(client_id, message)
     # tracking
-    if client_id in im.client_to_user:
-        user = im.client_to_user[client_id]
+    if client_id in im.clients:
+        user = im.clients.user_of(client_id)
 
 
 @socketio.event
@@ -475,23 +515,10 @@ def update_chain(message):
 def next_question():
     """
     Send next question to the interviewer, incase user press next question before dg complete
-    transcript. The temp sentence contains all the transcript before sending it to AI. Then after
-    we send the message to AI, we reset the temp sentence.
+    transcript. See InterviewSession.next_question
     """
     interview_session: InterviewSession = im.get_interview_session_by_client(request.sid)
-    if interview_session.dg is None:
-        logger.debug(f"DG is not ready for user {interview_session.user_id}")
-        return
-    if interview_session.transcriber:
-        transcript = Transcript(
-            role=Role.INTERVIEWEE,
-            transcript=interview_session.dg.sentence_splitter.interviewee_temp_sentence,
-            timestamp=datetime.datetime.now(),
-            request_id=uuid.uuid4().hex,
-        )
-        interview_session.transcriber.transcript_data[Role.INTERVIEWEE].insert(0, transcript)
-        interview_session.dg.sentence_splitter.reset_temp_sentences(Role.INTERVIEWEE)
-    interview_session.transcriber.respond_interviewee_changed_event.set()
+    interview_session.next_question()
 
 
 @socketio.event
@@ -506,26 +533,8 @@ def solve(message):
     }
     """
     interview_session = im.get_interview_session_by_client(request.sid)
-    chain: InterviewChain = interview_session.responder.chain
     try:
-        interview_session.cm.deduct_credit(InterviewType.ONE_TIME_IMAGE)
-        interview_session.credit_consumption += interview_session.cm.cost_map[InterviewType.ONE_TIME_IMAGE]
-        # Check if the credit deductor start event is set
-        if interview_session.start_event.is_set() == False:
-            interview_session.start_event.set()
-        if "context" in message:
-            if "image" in message["context"]:
-                base64_image = message["context"]["image"]
-                response = chain.predict_image(base64_image, interview_session.sio)
-                interview_session.transcriber.save_conversation(Role.IMAGE_CONTEXT, response)
-                interview_session.transcriber.chat_history_queue.put(
-                    Transcript(
-                        role=Role.AI,
-                        transcript=response,
-                        timestamp=datetime.datetime.now(),
-                        request_id=uuid.uuid4().hex,
-                    )
-                )
+        interview_session.solve(message)
     except:
         logger.error(f"Failed to solve! {traceback.format_exc()}")
 
@@ -1,23 +1,41 @@
-import queue
+import asyncio
+import concurrent.futures
+import signal
 import threading
 import time
-import datetime
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from flask_socketio import SocketIO, join_room, rooms
 import traceback
 
 from interviewai import LoggerMixed
+from interviewai.admission import PendingSession, SessionAdmissionScheduler
 from interviewai.ai import InterviewSession
+from interviewai.client_registry import ClientRegistry
+from interviewai.cluster import (
+    WORKER_ID,
+    SESSION_OWNER_TTL,
+    SessionOwnedElsewhere,
+    WorkerDraining,
+    get_session_registry,
+)
 from interviewai.tools.util import get_interview_room
+from interviewai.emit_gateway import EmitGateway
 from interviewai.firebase import get_active_interview_id, get_fs_client, archive_session, get_active_interview
-from interviewai.speech.dg import DGTranscriber
+from interviewai.chains.llm_pool import LLM_CLIENT_POOL
+from interviewai.chat_history import CHAT_HISTORY_WRITER
+from interviewai.speech.dg import DG_WARM_POOL, DGTranscriber
 from interviewai.tools.cost_calculator import GlobalCostCalculator
+from interviewai.snapshot import decode_snapshot, encode_snapshot, get_snapshot_store
+from interviewai.tools.deadline_scheduler import DeadlineScheduler
+from interviewai.tools.worker_pool import LLM_WORKER_POOL, SESSION_WORKER_POOL
 from interviewai.user_manager.mail import LoopsManager
 from interviewai.tools.data_structure import InterviewType
 from interviewai.user_manager.user_preference import UserSettings
 
 logger = LoggerMixed(__name__)
+LONG_RUNNING_GRACE_PERIOD = 30  # seconds between force_termination and ending the session server side
+DRAIN_TIMEOUT = 25  # seconds, stays under the default 30s SIGTERM -> SIGKILL grace of k8s / gunicorn
 
 loops = LoopsManager()
 
@@ -32,27 +50,32 @@ class InterviewSessionManager:
     """
     socketio: SocketIO
 
-    def __init__(self, socketio):
+    def __init__(self, socketio, loop: asyncio.AbstractEventLoop = None):
         self.socketio = socketio
+        # every emit of the sessions goes through the gateway (token coalescing, lanes, counters)
+        self.gateway = EmitGateway(socketio)
+        # server event loop in asyncio server mode (the shared DG loop thread in threading mode),
+        # sessions schedule their async work on it
+        self.loop = loop
         self.interview_sessions: Dict[
             str, InterviewSession
         ] = {}  # user_id -> InterviewSession
-        self.client_to_user: Dict[str, str] = {}  # socket_id -> user_id
-        self.new_connection_event = threading.Event()
-        self.connection_queue = queue.Queue()  # session connection
-
-    @property
-    def user_to_clients(self) -> Dict[str, List[str]]:
-        result = {}
-        for client, user in self.client_to_user.items():
-            if user not in result:
-                result[user] = []
-            result[user].append(client)
-        return result
+        self.clients = ClientRegistry()  # socket_id <-> user_id
+        # new sessions are started by tier (ADMIN > PAID > FREE) with a cap on concurrent startups
+        self.admission = SessionAdmissionScheduler(self.new_connection)
+        self.pending_sessions: Dict[str, PendingSession] = {}  # user_id -> readiness of a session being started
+        self.deadlines = DeadlineScheduler()  # user_id -> expiry of the session's tier limit
+        # user_id -> worker_id ownership shared by all workers in scale-out mode (see interviewai/cluster.py)
+        self.session_registry = get_session_registry()
+        # sessions of a draining worker are snapshotted here and restored by the worker the user reconnects to
+        self.snapshots = get_snapshot_store()
+        self.draining = False
 
     def _put_connection(self, connection):
-        self.connection_queue.put(connection)
-        self.new_connection_event.set()
+        user_id = connection["sub"]
+        # setdefault: a reconnect while queued keeps waiting on the same readiness
+        self.pending_sessions.setdefault(user_id, PendingSession())
+        self.admission.submit(user_id)
 
     # ensure duplicate connections are not created
     def ensure_user_firebase_consistency(self, user_id: str):
@@ -99,9 +122,38 @@ class InterviewSessionManager:
             interview_session_id=active_session_id,
         )
 
-    def add_new_connection(self, connection, client_id):
+    def join_room(self, client_id: str, user_id: str):
+        if isinstance(self.socketio, SocketIO):
+            join_room(get_interview_room(user_id), client_id)
+        else:
+            # AsyncSocketIOBridge in asyncio server mode
+            self.socketio.enter_room(client_id, get_interview_room(user_id))
+
+    def client_rooms(self, client_id: str) -> List[str]:
+        if isinstance(self.socketio, SocketIO):
+            return rooms(sid=client_id)
+        return self.socketio.rooms(client_id)
+
+    def add_new_connection(self, connection, client_id, last_seq: Optional[int] = None, last_request_id: str = None):
+        """
+        last_seq / last_request_id: last chat history entry the client has, a client reconnecting to the running
+        session only gets the entries after it (see InterviewSession.resync).
+        """
+        if self.draining:
+            raise WorkerDraining(WORKER_ID)
+        # sticky routing: a user's session lives on one worker only
+        owner = self.session_registry.claim(connection["sub"])
+        if owner != WORKER_ID:
+            logger.info(f"user {connection['sub']} is owned by worker {owner}, refusing client {client_id}",
+                        user_id=connection["sub"])
+            raise SessionOwnedElsewhere(connection["sub"], owner)
+        if connection["sub"] not in self.interview_sessions:
+            # frames of the client arriving before its connection is queued are buffered for the session
+            self.pending_sessions.setdefault(connection["sub"], PendingSession())
+        # track client id to user id mapping, before the connection is queued: its events and frames find the user
+        self.clients.add(client_id, connection["sub"])
         try:
-            join_room(get_interview_room(connection["sub"]), client_id)
+            self.join_room(client_id, connection["sub"])
         except Exception as e:
             logger.error(
                 f"failed to join room {get_interview_room(connection['sub'])}: {e}",
@@ -141,104 +193,132 @@ class InterviewSessionManager:
                 logger.info(f"DG is terminated, respawn the session")
                 interview_session.dg.set_terminated(False)
                 interview_session.keep_asr_alive()
-            interview_session.load_fs_data()
+            interview_session.resync(client_id, last_seq=last_seq, last_request_id=last_request_id)
             interview_session.ready = True
         else:
             self._put_connection(connection)
-        # track client id to user id mapping
-        self.client_to_user[client_id] = connection["sub"]
-        client_rooms = rooms(sid=client_id)
+        client_rooms = self.client_rooms(client_id)
         logger.info(
             f"rooms for client_id {client_id}: {client_rooms}",
             user_id=connection["sub"],
         )
         logger.debug(
-            f"client_to_user map:\n {self.client_to_user}",
+            f"client registry:\n {self.clients}",
             user_id=connection["sub"],
         )
 
     def new_connection(self, user_id: str):
+        if user_id in self.interview_sessions:
+            logger.info(f"new_connection skipped. interview session exists for {user_id}", user_id=user_id,
+                        interview_session_id=self.interview_sessions[user_id].interview_session_id)
+            self._resolve_pending(user_id, self.interview_sessions[user_id])
+            return
         logger.info(f"create a new connection for {user_id}", user_id=user_id)
-        interview_session = self.create_interview_session(user_id)
-        logger.info(f"interview session created in memory", user_id=user_id)
-        self.run_interview_session(interview_session)
+        try:
+            interview_session = self.create_interview_session(user_id)
+            logger.info(f"interview session created in memory", user_id=user_id)
+            self.run_interview_session(interview_session)
+        except Exception as e:
+            pending = self.pending_sessions.pop(user_id, None)
+            if pending:
+                pending.fail(e)
+            if not self.clients.has_clients(user_id):
+                # kept by remove_client while the session was being started
+                self.session_registry.release(user_id)
+            raise
+        # replays the audio received while the session was starting
+        self._resolve_pending(user_id, interview_session)
         logger.info(
             f"interview session {interview_session.interview_session_id} running",
             user_id=user_id,
             interview_session_id=interview_session.interview_session_id,
         )
 
-    def _process_new_connection(self, user_id):
-        # Retrieve the auth from the queue
-        if user_id in self.interview_sessions:
-            logger.info(f"process_new_connection failed. interview session exists for {user_id}", user_id=user_id,
-                        interview_session_id=self.interview_sessions[user_id].interview_session_id)
-        logger.info(f"processing connection for {user_id}", user_id=user_id)
-        try:
-            new_connection_async = True
-            logger.info(f"processing new connection for {user_id}", user_id=user_id)
-            if new_connection_async:
-                logger.info("new connection async", user_id=user_id)
-                t = threading.Thread(
-                    target=self.new_connection, args=(user_id,), daemon=True
-                )
-                t.start()
-            else:
-                self.new_connection(user_id)
-        except Exception as e:
-
-            logger.error(f"failed to process new connection: {e} \n {traceback.format_exc()}", user_id=user_id)
-
-    def process_new_connection(self):
-        # FIFO would cause user wait if connection_queue is long
-        # TODO: use a priority queue to prioritize the connection
-        while True:
-            start_time = datetime.datetime.now()
-            # Block until the event is set
-            self.new_connection_event.wait()
-            after_wait_time = datetime.datetime.now()
-            # Reset the event
-            self.new_connection_event.clear()
-            clear_time = datetime.datetime.now()
-            connection = self.connection_queue.get()
-            user_id = connection["sub"]
-            self._process_new_connection(user_id)
+    def _resolve_pending(self, user_id: str, interview_session: InterviewSession):
+        # resolved before it's forgotten: frames fed meanwhile are buffered by it (replayed in order) until it is,
+        # then go to the session after the replay
+        pending = self.pending_sessions.get(user_id)
+        if pending is None:
+            return
+        pending.resolve(interview_session)
+        if self.pending_sessions.get(user_id) is pending:
+            del self.pending_sessions[user_id]
 
     @staticmethod
-    def new(sio):
-        im = InterviewSessionManager(sio)
-        # new connection handling thread
-        t = threading.Thread(target=im.process_new_connection, args=())
-        t.daemon = True
-        t.start()
+    def new(sio, loop: asyncio.AbstractEventLoop = None):
+        if loop is None and isinstance(sio, SocketIO):
+            # DG of every session runs on one shared loop thread instead of a thread (and loop) per session,
+            # pooled DG sockets are bound to that loop too
+            loop = asyncio.new_event_loop()
+            t_dg = threading.Thread(target=loop.run_forever, args=(), daemon=True)
+            t_dg.start()
+        im = InterviewSessionManager(sio, loop=loop)
+        im.gateway.start()
+        LLM_CLIENT_POOL.start()
+        SESSION_WORKER_POOL.start()
+        LLM_WORKER_POOL.start()
+        CHAT_HISTORY_WRITER.start()
+        if loop is not None:
+            DG_WARM_POOL.start(loop)
+        # new connection handling threads
+        im.admission.start()
         # long running connection handling thread
-        t_clean = threading.Thread(target=im.clean_long_running_connection, args=())
-        t_clean.daemon = True
-        t_clean.start()
+        im.deadlines.start()
+        # keep the session ownership claims of this worker alive
+        t_owner = threading.Thread(target=im.refresh_session_ownership, args=())
+        t_owner.daemon = True
+        t_owner.start()
         return im
-    
-    def clean_long_running_connection(self):
-        logger.debug(f"cleaning long running connection thread started")
+
+    def refresh_session_ownership(self):
         while True:
             try:
-                to_end: Dict[str, InterviewSession] = {}
-                for user_id, interview_session in self.interview_sessions.items():
-                    if interview_session.long_running:
-                        to_end[user_id] = interview_session
-                to_end_id_map = {user_id: interview_session.interview_session_id for user_id, interview_session in to_end.items()}
-                logger.info(f"long running connection: {to_end_id_map}")
-                # another for loop to avoid RuntimeError: dictionary changed size during iteration
-                
-                for user_id, interview_session in to_end.items():
-                    logger.info(f"cleaning long running connection for {user_id}", user_id=user_id, interview_session_id=interview_session.interview_session_id)
-                    interview_session.sio.emit("force_termination", room=get_interview_room(user_id))
-                    time.sleep(30)
-                    # if somehow frontend didn't shutdown session properly check if the user is still in long running connection
-                    if user_id in self.interview_sessions:
-                        self.end_session(user_id)
+                owned_users = (
+                    set(self.interview_sessions.keys()) | set(self.pending_sessions.keys()) | set(self.clients.users())
+                )
+                for user_id in owned_users:
+                    if not self.session_registry.refresh(user_id):
+                        logger.error(f"worker {WORKER_ID} lost session ownership", user_id=user_id)
             except Exception as e:
-                logger.debug(f"failed to clean long running connection: {e} \n {traceback.format_exc()}")
-            time.sleep(60)  # run every 1 min
+                logger.debug(f"failed to refresh session ownership: {e} \n {traceback.format_exc()}")
+            time.sleep(SESSION_OWNER_TTL / 3)
+    
+    def schedule_session_limit(self, interview_session: InterviewSession):
+        """
+        (Re)arm the deadline of the session's tier limit, called whenever its activated timestamp is loaded.
+        """
+        deadline = interview_session.limit_deadline
+        if deadline is None:
+            self.deadlines.cancel(interview_session.user_id)
+            return
+        self.deadlines.schedule(
+            interview_session.user_id, deadline, self.terminate_long_running, interview_session
+        )
+
+    def terminate_long_running(self, interview_session: InterviewSession):
+        user_id = interview_session.user_id
+        if self.interview_sessions.get(user_id) is not interview_session:
+            return
+        logger.info(f"cleaning long running connection for {user_id}", user_id=user_id,
+                    interview_session_id=interview_session.interview_session_id)
+        interview_session.sio.emit("force_termination", room=get_interview_room(user_id))
+        # grace period for the frontend to end the session itself
+        self.deadlines.schedule(
+            user_id, time.time() + LONG_RUNNING_GRACE_PERIOD, self.end_long_running, interview_session
+        )
+
+    def end_long_running(self, interview_session: InterviewSession):
+        # runs on the deadline scheduler: ending the session waits on its tasks and firestore, queue it on the session
+        # workers so the other expiries and grace periods fire on time
+        SESSION_WORKER_POOL.submit(
+            interview_session.interview_session_id, "end", self._end_long_running, interview_session
+        )
+
+    def _end_long_running(self, interview_session: InterviewSession):
+        user_id = interview_session.user_id
+        # if somehow frontend didn't shutdown session properly, end it here
+        if self.interview_sessions.get(user_id) is interview_session:
+            self.end_session(user_id)
 
     def create_interview_session(self, user_id: str) -> InterviewSession:
         if user_id in self.interview_sessions:
@@ -247,8 +327,10 @@ class InterviewSessionManager:
         # we will always assume frontend would create a new interview session document with id
         interview_session_id = get_active_interview_id(user_id)
         self.interview_sessions[user_id] = InterviewSession(
-            user_id, interview_session_id, self.socketio, UserSettings(user_id)
+            user_id, interview_session_id, self.gateway, UserSettings(user_id), loop=self.loop,
+            on_activated=self.schedule_session_limit,
         )
+        self.restore_snapshot(self.interview_sessions[user_id])
 
         try:
             loops.first_time_copilot_event(user_id)
@@ -256,6 +338,21 @@ class InterviewSessionManager:
             logger.error(f"failed to send first time copilot event: {e}")
         return self.interview_sessions[user_id]
 
+    def restore_snapshot(self, interview_session: InterviewSession):
+        user_id = interview_session.user_id
+        try:
+            data = self.snapshots.take(user_id)
+            snapshot = decode_snapshot(data) if data else None
+            if snapshot is None:
+                return
+            if snapshot["interview_session_id"] != interview_session.interview_session_id:
+                logger.info(f"snapshot of another interview session ignored", user_id=user_id)
+                return
+            interview_session.restore(snapshot)
+        except Exception as e:
+            # a cold start from firestore is still correct, just slower
+            logger.error(f"failed to restore session snapshot: {e} \n {traceback.format_exc()}", user_id=user_id)
+
     def run_interview_session(self, interview_session: InterviewSession):
         logger.info(
             "Creating a new interview session in session manager...",
@@ -275,7 +372,8 @@ class InterviewSessionManager:
         # TODO: set_dg need to run first, later we need to figure out why
         interview_session.load_fs_data()
         interview_session.set_dg(dg)
-        interview_session.keep_asr_alive()  # only start to run ASR when audio is received
+        # DG buffers were created with the transcriber, keep the frames fed to them while it connects
+        interview_session.keep_asr_alive(init_queue=False)
         interview_session.run()
         interview_session.ready = True
 
@@ -285,36 +383,32 @@ class InterviewSessionManager:
         return self.interview_sessions[user_id]
 
     def check_any_clients(self, user_id: str) -> bool:
-        return (
-            len(self.user_to_clients[user_id]) > 0
-            if user_id in self.user_to_clients
-            else False
-        )
+        return self.clients.has_clients(user_id)
 
     def remove_client(self, client_id: str) -> str:
         """
         return user
         """
-        if client_id in self.client_to_user:
-            user = self.client_to_user[client_id]
-            del self.client_to_user[client_id]
-            if not self.check_any_clients(user) and user in self.interview_sessions:
-                if user not in self.interview_sessions:
-                    logger.debug(f"no interview session for user {user} when removing client {client_id}", user_id=user)
-                    return user
-                logger.info("user has no more clients, shutting down DG")
-                session = self.interview_sessions[user] if user in self.interview_sessions else None
-                if session is None:
-                    return user
-                if session.dg:
-                    session.dg.running = False
-                    session.dg.set_terminated(True)
-                    # This is a hacky way to stop the credit_ductor to keep killing the credit
-                    session.start_event.clear()
+        user, has_clients = self.clients.remove(client_id)
+        if user is None or has_clients:
             return user
+        session = self.interview_sessions.get(user)
+        if session is None:
+            logger.debug(f"no interview session for user {user} when removing client {client_id}", user_id=user)
+            if user not in self.pending_sessions:
+                # a session still being started keeps the claim, finish_interview_session releases it
+                self.session_registry.release(user)
+            return user
+        logger.info("user has no more clients, shutting down DG")
+        if session.dg:
+            session.dg.running = False
+            session.dg.set_terminated(True)
+            # stop the credit ticks until the next AI response
+            session.stop_credit_deductor()
+        return user
 
     def end_session_by_client(self, client_id: str):
-        user_id = self.client_to_user[client_id]
+        user_id = self.clients.user_of(client_id)
         self.end_session(user_id)
 
     def end_session(self, user_id: str):
@@ -358,7 +452,7 @@ class InterviewSessionManager:
         """
         # self.end_session(user_id)
         # dont need to kill the whole session anymore. too expensive
-        if user_id not in self.user_to_clients:
+        if not self.clients.has_clients(user_id):
             logger.info(
                 f"no active client for this user: {user_id}, no need to respawn DG...",
                 user_id=user_id,
@@ -367,33 +461,58 @@ class InterviewSessionManager:
         return False
 
     def get_interview_session_by_client(self, client_id: str) -> InterviewSession:
-        if client_id not in self.client_to_user:
+        user_id = self.clients.user_of(client_id)
+        if user_id is None:
             raise Exception(f"Client {client_id} does not have an interview session")
-        user_id = self.client_to_user[client_id]
         return self.get_interview_session(user_id)
 
     def get_interview_session_by_client_with_timeout(
             self, client_id: str, timeout: int = 3
     ) -> InterviewSession:
-        # TODO: this is a hacky way to wait for the interview session to be ready
-        # use get_interview_session_by_client and retry until timeout
-        start_time = time.time()
-        while True:
-            try:
-                return self.get_interview_session_by_client(client_id)
-            except Exception as e:
-                if time.time() - start_time > timeout:
-                    raise e
-                time.sleep(0.1)
+        """
+        Wait (without polling) for the session of the client to finish starting.
+        """
+        user_id = self.clients.user_of(client_id)
+        pending = self.pending_sessions.get(user_id) if user_id else None
+        if pending is not None:
+            return pending.future.result(timeout=timeout)
+        return self.get_interview_session_by_client(client_id)
 
-    def has_interview_session(self, client_id: str) -> bool:
-        if client_id not in self.client_to_user:
-            return False
-        user_id = self.client_to_user[client_id]
-        if user_id not in self.interview_sessions:
+    def session_ready_future(self, client_id: str) -> Optional[concurrent.futures.Future]:
+        """
+        Future resolving to the client's session, None if it is not being started.
+        asyncio handlers can await it with asyncio.wrap_future.
+        """
+        user_id = self.clients.user_of(client_id)
+        pending = self.pending_sessions.get(user_id) if user_id else None
+        return pending.future if pending else None
+
+    def feed_audio(self, user_id: str, frame) -> bool:
+        """
+        Route an audio frame to the user's session without blocking, frames arriving while the session is
+        starting are buffered and replayed once it is ready. Returns False if the user has no session.
+        """
+        pending = self.pending_sessions.get(user_id)
+        if pending is not None and pending.offer(frame):
+            return True
+        interview_session = self.interview_sessions.get(user_id)
+        if interview_session is None:
             return False
+        interview_session.feed_audio(frame)
         return True
 
+    def feed_audio_by_client(self, client_id: str, frame) -> bool:
+        user_id = self.clients.user_of(client_id)
+        if user_id is None:
+            return False
+        return self.feed_audio(user_id, frame)
+
+    def has_interview_session(self, client_id: str) -> bool:
+        user_id = self.clients.user_of(client_id)
+        if user_id is None:
+            return False
+        return user_id in self.interview_sessions
+
     def pause_resume_by_client(self, client_id: str, paused: bool):
         try:
             interview_session = self.get_interview_session_by_client(client_id)
@@ -401,6 +520,58 @@ class InterviewSessionManager:
         except Exception as e:
             logger.info(f"failed to pause/resume: {e}")
 
+    def drain(self, timeout: float = DRAIN_TIMEOUT):
+        """
+        Graceful shutdown: refuse new connections, snapshot every live session for the worker its users
+        reconnect to, then stop the sessions. Sessions are not archived, they continue elsewhere.
+        """
+        if self.draining:
+            return
+        self.draining = True
+        started = time.monotonic()
+        interview_sessions = list(self.interview_sessions.values())
+        logger.info(f"worker {WORKER_ID} draining {len(interview_sessions)} interview sessions")
+        for interview_session in interview_sessions:
+            user_id = interview_session.user_id
+            interview_session.ready = False
+            try:
+                self.snapshots.save(user_id, encode_snapshot(interview_session.snapshot()))
+            except Exception as e:
+                logger.error(f"failed to snapshot interview session: {e} \n {traceback.format_exc()}",
+                             user_id=user_id, interview_session_id=interview_session.interview_session_id)
+            # release first so the reconnect can claim the session on another worker
+            self.deadlines.cancel(user_id)
+            self.session_registry.release(user_id)
+            self.gateway.emit("worker_draining", {"worker_id": WORKER_ID}, room=get_interview_room(user_id))
+        threads = []
+        for interview_session in interview_sessions:
+            t = threading.Thread(target=interview_session.stop, args=(), daemon=True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join(timeout=max(timeout - (time.monotonic() - started), 0))
+        logger.info(f"worker {WORKER_ID} drained in {time.monotonic() - started:.1f}s, "
+                    f"{sum(t.is_alive() for t in threads)} sessions still stopping")
+
+    def install_drain_handler(self):
+        """
+        Drain on SIGTERM before handing over to the previous handler (gunicorn's graceful stop).
+        """
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            self.drain()
+            if callable(previous):
+                previous(signum, frame)
+            elif previous == signal.SIG_DFL:
+                raise SystemExit(0)
+
+        try:
+            signal.signal(signal.SIGTERM, on_sigterm)
+        except ValueError:
+            # not on the main thread, the server has to call drain itself
+            logger.info("SIGTERM drain handler not installed, not on the main thread")
+
     def finish_interview_session(self, user_id: str):
         if user_id not in self.interview_sessions:
             logger.info(f"User {user_id} does not have an interview session", user_id=user_id)
@@ -409,6 +580,9 @@ class InterviewSessionManager:
         # TODO
         interview_session_id = self.interview_sessions[user_id].interview_session_id
         del self.interview_sessions[user_id]
+        self.deadlines.cancel(user_id)
+        if not self.check_any_clients(user_id):
+            self.session_registry.release(user_id)
         logger.info(
             f"{user_id}'s interview session deleted and finished",
             user_id=user_id,
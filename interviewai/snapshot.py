@@ -0,0 +1,115 @@
+"""
+Session snapshots for graceful drains.
+
+On SIGTERM (or ASGI shutdown) a worker stops admitting sessions and writes a snapshot of every live session
+(transcripts, summary memory, cost accumulators, chain choice, ...) to a snapshot store. The worker that next
+gets the user restores the session from it instead of rebuilding it cold from firestore.
+
+SESSION_SNAPSHOT_URL=file:///var/lib/interviewai/snapshots   (a volume shared by the workers of a host)
+SESSION_SNAPSHOT_URL=redis://host:6379/0                      (shared by every pod)
+
+Unset, snapshots go to a tmp dir of the container: shared by its workers only and lost when the pod is replaced, so
+they don't survive a deploy. A warning is logged when that default is used.
+"""
+import json
+import os
+import tempfile
+import time
+import zlib
+from typing import Optional
+
+from interviewai import LoggerMixed
+from interviewai.cluster import WORKER_ID
+
+logger = LoggerMixed(__name__)
+
+DEFAULT_SNAPSHOT_URL = f"file://{os.path.join(tempfile.gettempdir(), 'interviewai-snapshots')}"
+SESSION_SNAPSHOT_URL = os.environ.get("SESSION_SNAPSHOT_URL", DEFAULT_SNAPSHOT_URL)
+SNAPSHOT_VERSION = 1
+SNAPSHOT_MAX_AGE = 600  # seconds, older snapshots are ignored and the session is rebuilt from firestore
+
+
+def encode_snapshot(snapshot: dict) -> bytes:
+    snapshot = dict(snapshot, version=SNAPSHOT_VERSION, worker_id=WORKER_ID, created_at=time.time())
+    return zlib.compress(json.dumps(snapshot, separators=(",", ":"), default=str).encode())
+
+
+def decode_snapshot(data: bytes) -> Optional[dict]:
+    snapshot = json.loads(zlib.decompress(data))
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    if time.time() - snapshot.get("created_at", 0) > SNAPSHOT_MAX_AGE:
+        return None
+    return snapshot
+
+
+class SnapshotStore:
+    def save(self, user_id: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    def take(self, user_id: str) -> Optional[bytes]:
+        """
+        Load and delete the snapshot of user_id, a snapshot is restored once at most.
+        """
+        raise NotImplementedError
+
+
+class FileSnapshotStore(SnapshotStore):
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, user_id: str) -> str:
+        return os.path.join(self.directory, f"{user_id}.snapshot")
+
+    def save(self, user_id: str, data: bytes) -> None:
+        # write then rename, a reader never sees half a snapshot
+        path = self._path(user_id)
+        with open(f"{path}.{WORKER_ID}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.{WORKER_ID}.tmp", path)
+
+    def take(self, user_id: str) -> Optional[bytes]:
+        path = self._path(user_id)
+        # rename first so two workers can't both restore it
+        taken = f"{path}.{WORKER_ID}.taken"
+        try:
+            os.replace(path, taken)
+        except FileNotFoundError:
+            return None
+        try:
+            with open(taken, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(taken)
+
+
+class RedisSnapshotStore(SnapshotStore):
+    def __init__(self, url: str):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"interviewai:session_snapshot:{user_id}"
+
+    def save(self, user_id: str, data: bytes) -> None:
+        self.redis.set(self._key(user_id), data, ex=SNAPSHOT_MAX_AGE)
+
+    def take(self, user_id: str) -> Optional[bytes]:
+        return self.redis.getdel(self._key(user_id))
+
+
+def get_snapshot_store() -> SnapshotStore:
+    if SESSION_SNAPSHOT_URL.startswith(("redis://", "rediss://")):
+        return RedisSnapshotStore(SESSION_SNAPSHOT_URL)
+    if SESSION_SNAPSHOT_URL == DEFAULT_SNAPSHOT_URL:
+        logger.warning(
+            f"session snapshots stored in {DEFAULT_SNAPSHOT_URL}, local to this container: they don't survive the pod "
+            f"being replaced, set SESSION_SNAPSHOT_URL to a shared volume or redis"
+        )
+    path = SESSION_SNAPSHOT_URL
+    if path.startswith("file://"):
+        path = path[len("file://"):]
+    return FileSnapshotStore(path)
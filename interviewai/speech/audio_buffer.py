@@ -0,0 +1,127 @@
+"""
+Bounded audio send buffer between the audio handlers and the Deepgram socket.
+
+Frames are kept in a ring of at most AUDIO_BUFFER_MAX_SECONDS of audio. When Deepgram is slow or reconnecting
+and the ring is full, either the oldest buffered audio (default, keeps transcription close to real time) or the
+incoming frame is dropped. Crossing the high watermark (and coming back under the low one) is reported through
+on_pressure, which the transcriber turns into an `audio_backpressure` event to the client.
+
+Not thread safe, use it from the event loop it's consumed on (see DGTranscriber.feed_audio).
+"""
+import asyncio
+import os
+from collections import deque
+from typing import Callable, Deque, Optional
+
+AUDIO_BUFFER_MAX_SECONDS = float(os.environ.get("AUDIO_BUFFER_MAX_SECONDS", 10))
+AUDIO_BUFFER_DROP_POLICY = os.environ.get("AUDIO_BUFFER_DROP_POLICY", "oldest")  # oldest | newest
+# buffered duration is derived from bytes, default is 16kHz 16bit stereo PCM
+AUDIO_BYTES_PER_SECOND = int(os.environ.get("AUDIO_BYTES_PER_SECOND", 16000 * 2 * 2))
+HIGH_WATERMARK = 0.8
+LOW_WATERMARK = 0.3
+
+DROP_OLDEST = "oldest"
+DROP_NEWEST = "newest"
+
+
+class AudioRingBuffer:
+    """
+    asyncio.Queue compatible (put_nowait / get / qsize) bounded by audio duration. None is the wakeup sentinel
+    and is never dropped.
+    """
+
+    def __init__(
+            self,
+            max_seconds: float = AUDIO_BUFFER_MAX_SECONDS,
+            drop_policy: str = AUDIO_BUFFER_DROP_POLICY,
+            bytes_per_second: int = AUDIO_BYTES_PER_SECOND,
+            on_pressure: Callable[[bool, int], None] = None,
+    ) -> None:
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"unknown drop policy {drop_policy}, use {DROP_OLDEST} or {DROP_NEWEST}")
+        self.drop_policy = drop_policy
+        self.bytes_per_second = bytes_per_second
+        self.max_bytes = int(max_seconds * bytes_per_second)
+        self.on_pressure = on_pressure
+        self.frames: Deque = deque()
+        self.size = 0  # buffered audio bytes
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.under_pressure = False
+        self.not_empty = asyncio.Event()
+
+    @property
+    def buffered_ms(self) -> int:
+        return self.size * 1000 // self.bytes_per_second
+
+    def qsize(self) -> int:
+        return len(self.frames)
+
+    def empty(self) -> bool:
+        return not self.frames
+
+    def _drop(self, size: int):
+        self.dropped_frames += 1
+        self.dropped_bytes += size
+
+    def put_nowait(self, frame) -> None:
+        if frame is None:
+            self.frames.append(None)
+            self.not_empty.set()
+            return
+        size = len(frame)
+        if self.size + size > self.max_bytes:
+            if self.drop_policy == DROP_NEWEST or size > self.max_bytes:
+                self._drop(size)
+                self._check_pressure()
+                return
+            sentinels = 0
+            while self.frames and self.size + size > self.max_bytes:
+                oldest = self.frames.popleft()
+                if oldest is None:
+                    # keep the sentinel, it has to wake up the consumer
+                    sentinels += 1
+                    continue
+                self.size -= len(oldest)
+                self._drop(len(oldest))
+            self.frames.extendleft([None] * sentinels)
+            if self.size + size > self.max_bytes:
+                # only sentinels left to evict, the ring doesn't grow past its cap
+                self._drop(size)
+                self._check_pressure()
+                return
+        self.frames.append(frame)
+        self.size += size
+        self.not_empty.set()
+        self._check_pressure()
+
+    async def get(self):
+        while not self.frames:
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        frame = self.frames.popleft()
+        if frame is not None:
+            self.size -= len(frame)
+            if self.under_pressure:
+                self._check_pressure()
+        return frame
+
+    def _check_pressure(self):
+        fill = self.size / self.max_bytes if self.max_bytes else 1
+        if not self.under_pressure and fill >= HIGH_WATERMARK:
+            self.under_pressure = True
+        elif self.under_pressure and fill <= LOW_WATERMARK:
+            self.under_pressure = False
+        else:
+            return
+        if self.on_pressure:
+            self.on_pressure(self.under_pressure, self.buffered_ms)
+
+    def stats(self) -> dict:
+        return {
+            "buffered_ms": self.buffered_ms,
+            "max_ms": self.max_bytes * 1000 // self.bytes_per_second,
+            "dropped_frames": self.dropped_frames,
+            "dropped_bytes": self.dropped_bytes,
+            "under_pressure": self.under_pressure,
+        }
@@ -0,0 +1,155 @@
+"""
+Dedicated binary websocket for PCM audio, separate from the socket.io control events.
+
+Protocol on ws(s)://<host>/audio:
+1. client sends the clerk session jwt as the first (text) message, server answers "ready"
+2. client sends binary messages, each holding one or more length prefixed frames:
+   [4 bytes big endian payload length][payload] [4 bytes length][payload] ...
+   a zero length frame is a keepalive.
+
+Frames are sliced out of the received message with memoryview and handed to the session's DG send buffer
+as-is: no engineio packet decoding, no event dispatch, no dict wrapping and no copies.
+"""
+import asyncio
+import struct
+import traceback
+from typing import Iterator, Optional
+
+from interviewai import LoggerMixed
+from interviewai.auth import verify_jwt
+
+logger = LoggerMixed(__name__)
+
+AUDIO_INGEST_PATH = "/audio"
+AUTH_TIMEOUT = 10  # seconds to send the jwt after connecting
+MAX_MESSAGE_SIZE = 1024 * 1024  # 1MB, roughly 10s of 16bit 48kHz stereo
+FRAME_HEADER = struct.Struct(">I")
+
+
+class FramingError(Exception):
+    pass
+
+
+def iter_frames(data) -> Iterator[memoryview]:
+    """
+    Split a binary message into its length prefixed frames without copying the payloads.
+    """
+    view = memoryview(data)
+    offset = 0
+    end = len(view)
+    while offset < end:
+        if end - offset < FRAME_HEADER.size:
+            raise FramingError(f"truncated frame header at offset {offset}")
+        (length,) = FRAME_HEADER.unpack_from(view, offset)
+        offset += FRAME_HEADER.size
+        if length > end - offset:
+            raise FramingError(f"frame length {length} exceeds message at offset {offset}")
+        if length:
+            yield view[offset:offset + length]
+        offset += length
+
+
+class AudioIngest:
+    """
+    One binary audio connection of a user, shared by the threading and asyncio servers.
+    """
+
+    def __init__(self, im, token: str):
+        self.im = im
+        self.user_id = verify_jwt(token)["sub"]
+        self.frames = 0
+        self.bytes = 0
+
+    def ingest(self, data) -> None:
+        if not data:
+            return
+        for frame in iter_frames(data):
+            # buffered while the session is starting, dropped silently if there is none (like chat_dual_channel)
+            if not self.im.feed_audio(self.user_id, frame):
+                return
+            self.frames += 1
+            self.bytes += len(frame)
+
+    def close(self):
+        logger.info(f"audio stream closed, frames: {self.frames}, bytes: {self.bytes}", user_id=self.user_id)
+
+
+def serve_threading(environ, im):
+    """
+    Flask (threading mode) handler, blocks the request thread for the lifetime of the websocket.
+    Returns the WSGI response flask should hand back once the socket is closed.
+    """
+    import simple_websocket
+    from flask import Response
+
+    ws = simple_websocket.Server(environ, max_message_size=MAX_MESSAGE_SIZE)
+    ingest: Optional[AudioIngest] = None
+    try:
+        token = ws.receive(timeout=AUTH_TIMEOUT)
+        ingest = AudioIngest(im, token)
+        ws.send("ready")
+        while True:
+            ingest.ingest(ws.receive())
+    except simple_websocket.ConnectionClosed:
+        pass
+    except Exception as e:
+        logger.error(f"audio stream error: {e} \n {traceback.format_exc()}")
+    finally:
+        if ingest:
+            ingest.close()
+        try:
+            ws.close()
+        except Exception:
+            pass
+
+    class WebSocketResponse(Response):
+        # the socket was hijacked by simple_websocket, make the server drop the connection instead of writing
+        def __call__(self, *args, **kwargs):
+            if ws.mode == "gunicorn":
+                raise StopIteration()
+            elif ws.mode == "werkzeug":
+                raise ConnectionError()
+            return []
+
+    return WebSocketResponse()
+
+
+class AudioIngestASGIApp:
+    """
+    asyncio server mode: serve the audio websocket in front of the socket.io ASGI app.
+    """
+
+    def __init__(self, app, im, path: str = AUDIO_INGEST_PATH):
+        self.app = app
+        self.im = im
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "websocket" and scope["path"] == self.path:
+            return await self.serve(receive, send)
+        return await self.app(scope, receive, send)
+
+    async def serve(self, receive, send):
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        await send({"type": "websocket.accept"})
+        ingest: Optional[AudioIngest] = None
+        try:
+            message = await asyncio.wait_for(receive(), timeout=AUTH_TIMEOUT)
+            if message["type"] == "websocket.disconnect":
+                return
+            ingest = AudioIngest(self.im, message.get("text"))
+            await send({"type": "websocket.send", "text": "ready"})
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                # DG queues live on this loop, frames go straight in
+                ingest.ingest(message.get("bytes"))
+        except Exception as e:
+            logger.error(f"audio stream error: {e} \n {traceback.format_exc()}")
+            await send({"type": "websocket.close", "code": 1011})
+        finally:
+            if ingest:
+                ingest.close()
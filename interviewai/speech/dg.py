@@ -13,23 +13,28 @@ from deepgram import (
     LiveTranscriptionEvents,
     LiveOptions
 )
-from typing import Callable, Dict
+from typing import Callable, Dict, Optional
 from interviewai.transcriber import Role, Transcript
 from interviewai.tools.util import get_interview_room
-from flask_socketio import SocketIO
+from interviewai.emit_gateway import EmitGateway
 from interviewai.user_manager.user_preference import UserSettings
+from interviewai.speech.audio_buffer import AudioRingBuffer
+from interviewai.speech.dg_pool import DeepgramWarmPool, WarmDGConnection
 from interviewai.speech.load_balancer import DeepgramLoadBalancer
 
 DgLoadBalancer = DeepgramLoadBalancer()
+DG_WARM_POOL = DeepgramWarmPool(get_key=DgLoadBalancer.get_next_key)
 
 
 class SentenceSplitter:
-    def __init__(self, logger: LoggerMixed, sio: SocketIO):
+    def __init__(self, logger: LoggerMixed, sio: EmitGateway):
         self.logger = logger
         self.sio = sio
         self.interviewer_temp_sentence = ""
         self.interviewee_temp_sentence = ""
         self.transcribe_queue = queue.Queue()
+        # speculative answers (opt-in): called with the interviewer sentence so far once it looks like a question
+        self.speculate: Optional[Callable[[str], None]] = None
 
     def add_transcript(self, msg, role):
         transcript = msg["channel"]["alternatives"][0]["transcript"]
@@ -118,7 +123,7 @@ class SentenceSplitter:
 
 
 class UltraInterimSentenceSplitter(SentenceSplitter):
-    def __init__(self, logger: LoggerMixed, sio: SocketIO):
+    def __init__(self, logger: LoggerMixed, sio: EmitGateway):
         super().__init__(logger, sio)
         self.interviewer_interim_temp_sentence = ""
         self.interviewee_interim_temp_sentence = ""
@@ -176,6 +181,15 @@ class UltraInterimSentenceSplitter(SentenceSplitter):
             self.interviewer_interim_temp_sentence = transcript
         self.emit_result(role, output)
 
+    def maybe_speculate(self, role):
+        """
+        The endpointing delay (UserSettings.dg_endpoint) is still to come before speech_final / UtteranceEnd,
+        a question can be answered from its is_final partials in the meantime.
+        """
+        if role == Role.INTERVIEWER and self.speculate is not None and looks_like_question(
+                self.interviewer_temp_sentence):
+            self.speculate(self.interviewer_temp_sentence.strip())
+
     def reset_temp_sentences(self, role):
         if role == Role.INTERVIEWER:
             self.interviewer_temp_sentence = ""
@@ -192,6 +206,7 @@ class UltraInterimSentenceSplitter(SentenceSplitter):
                 self.process_interim_transcript(role, transcript)
                 if msg['is_final'] == True:
                     self.add_transcript(msg, role)
+                    self.maybe_speculate(role)
             else:
                 # sentence finished
                 self.add_transcript(msg, role)
@@ -233,6 +248,25 @@ def merge_audio(data_mic, data_speaker):
     return merged_data
 
 
+QUESTION_WORDS = {
+    "what", "why", "how", "when", "where", "which", "who", "whom", "whose", "can", "could", "would", "will", "should",
+    "do", "does", "did", "is", "are", "have", "has", "tell", "describe", "explain", "walk",
+}
+SPECULATION_MIN_WORDS = 4
+
+
+def looks_like_question(sentence: str) -> bool:
+    """
+    Complete enough to start answering: ends with a question mark, or opens like a question and is long enough.
+    """
+    words = sentence.strip().split()
+    if len(words) < SPECULATION_MIN_WORDS:
+        return False
+    if sentence.rstrip().endswith("?"):
+        return True
+    return words[0].lower().strip(",.") in QUESTION_WORDS and sentence.rstrip().endswith((".", "?"))
+
+
 def detect_role(msg):
     if msg["type"] == "Results":
         audio_index = msg["channel_index"][0]
@@ -262,23 +296,22 @@ class DGTranscriber:
     def __init__(
             self,
             logger: LoggerMixed,
-            sio: SocketIO,
+            sio: EmitGateway,
             user_settings: UserSettings,
             is_dual_channel: bool = False,
             on_close_callback: Callable = None,
             user_id="",
             is_mock: bool = False,
     ) -> None:
-        self.dg_key = DgLoadBalancer.get_next_key()
         self.dg_client = None
         self.logger = logger
         self.user_id = user_id
         self.sio = sio
         self.is_dual_channel = is_dual_channel
         self.on_close_callback = on_close_callback
-        self.audio_queue_mic: asyncio.Queue
-        self.audio_queue_speaker: asyncio.Queue
-        self.dual_channel_queue: asyncio.Queue
+        self.audio_queue_mic: AudioRingBuffer
+        self.audio_queue_speaker: AudioRingBuffer
+        self.dual_channel_queue: AudioRingBuffer
         self.user_settings = user_settings
         self.sentence_splitter = UltraInterimSentenceSplitter(self.logger, self.sio)
         self.deepgram_socket = None
@@ -297,12 +330,44 @@ class DGTranscriber:
             "language": self.user_settings.dg_language,
             "utterance_end_ms": self.user_settings.utterance_end_ms,
         }
+        # a connected socket from the warm pool skips key selection and the handshake
+        self.warm_connection: WarmDGConnection = DG_WARM_POOL.acquire(self.options, self)
+        self.dg_key = self.warm_connection.dg_key if self.warm_connection else DgLoadBalancer.get_next_key()
         self.lock = threading.Lock()
+        self.loop: asyncio.AbstractEventLoop = None  # loop process_audio runs on
+        # serializes the frames fed before the loop is bound, and the binding (see feed_audio)
+        self.feed_lock = threading.Lock()
+        # buffers bind to the loop lazily, frames can be fed before DG is connected (see run_interview_session)
+        self.init_queues()
 
     def set_terminated(self, terminated=True):
         with self.lock:
             self.terminated = terminated
 
+    def feed_audio(self, frame, queue: AudioRingBuffer = None):
+        """
+        Put an audio frame into a DG send buffer, the dual channel one by default.
+        The buffers are not thread safe, frames coming from other threads are handed over via the DG loop. Until the
+        loop is bound (or once it's closed) they are put under feed_lock.
+        """
+        if queue is None:
+            queue = self.dual_channel_queue
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            with self.feed_lock:
+                loop = self.loop
+                if loop is None or loop.is_closed():
+                    queue.put_nowait(frame)
+                    return
+        try:
+            in_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            queue.put_nowait(frame)
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, frame)
+
     async def shutdown(self):
         if self.deepgram_socket:
             await self.deepgram_socket.finish()
@@ -328,6 +393,9 @@ class DGTranscriber:
             room=get_interview_room(self.logger.user_id),
         )
 
+    async def on_dg_error(self, *args, **kwargs):
+        self.logger.error(f"Deepgram error: {kwargs.get('error', args)}")
+
     async def on_dg_utterance_end(self, *args, **kwargs):
         self.logger.info(f"UTTERANCE END")
         self.logger.info(f"\n\n{kwargs}\n\n")
@@ -361,7 +429,7 @@ class DGTranscriber:
                 """
                 await asyncio.sleep(1)
         await self.shutdown()
-        self.logger.info("Deepgram Client Data Sender Terminated")
+        self.logger.info(f"Deepgram Client Data Sender Terminated, audio buffer: {self.audio_buffer_stats()}")
 
     async def get_transcript(self, *args, **kwargs):
         """
@@ -385,6 +453,14 @@ class DGTranscriber:
         Keep running until recieve terminate signal
         """
 
+        warm, self.warm_connection = self.warm_connection, None
+        if warm is not None:
+            if not warm.closed and asyncio.get_running_loop() is DG_WARM_POOL.loop:
+                self.deepgram_socket = warm.socket
+                self.logger.debug("Deepgram Client taken from warm pool")
+                await self.on_dg_open()
+                return
+            DG_WARM_POOL.discard(warm)
         try:
             await self.new_dg()
             await self.deepgram_socket.start(self.options)
@@ -405,27 +481,72 @@ class DGTranscriber:
         self.deepgram_socket.on(LiveTranscriptionEvents.Transcript, self.get_transcript)
         self.deepgram_socket.on(LiveTranscriptionEvents.UtteranceEnd, self.on_dg_utterance_end)
         self.deepgram_socket.on(LiveTranscriptionEvents.Close, self.on_dg_close)
-        self.deepgram_socket.on(
-            LiveTranscriptionEvents.Error,
-            lambda e: self.logger.error(f"Deepgram error: {e}"))
+        self.deepgram_socket.on(LiveTranscriptionEvents.Error, self.on_dg_error)
         self.deepgram_socket.on(
             LiveTranscriptionEvents.Unhandled,
             lambda e: self.logger.error(f"Deepgram unhandled: {e}"))
 
         self.logger.debug("Registered Deepgram Event Handler...")
 
+    def on_audio_pressure(self, under_pressure: bool, buffered_ms: int):
+        """
+        Audio buffer crossed its high (or back under its low) watermark, tell the client to slow down / resume.
+        """
+        self.logger.info(f"audio backpressure: {under_pressure}, buffered: {buffered_ms}ms")
+        self.sio.emit(
+            "audio_backpressure",
+            {"backpressure": under_pressure, "buffered_ms": buffered_ms},
+            room=get_interview_room(self.logger.user_id),
+        )
+
+    @property
+    def audio_buffered_ms(self) -> int:
+        queue = self.dual_channel_queue if self.is_dual_channel else self.audio_queue_mic
+        return queue.buffered_ms
+
+    def audio_buffer_stats(self) -> dict:
+        queue = self.dual_channel_queue if self.is_dual_channel else self.audio_queue_mic
+        return queue.stats()
+
+    def init_queues(self):
+        self.logger.info("Init new queue...")
+        self.audio_queue_mic = AudioRingBuffer(on_pressure=self.on_audio_pressure)
+        # not consumed until desktop audio is merged (see process_audio), bounded but never reported
+        self.audio_queue_speaker = AudioRingBuffer()
+        self.dual_channel_queue = AudioRingBuffer(on_pressure=self.on_audio_pressure)
+
     def run_dg(self, init: bool):
         """
         Main entry point.
         We will create async io loop context and run process2 with async queue created in async io loop context
         """
         if init:
-            self.logger.info("Init new queue...")
-            self.audio_queue_mic = asyncio.Queue()
-            self.audio_queue_speaker = asyncio.Queue()
-            self.dual_channel_queue = asyncio.Queue()
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
+            self.init_queues()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        with self.feed_lock:
+            # the frames put before are in, the next ones go through the loop
+            self.loop = loop
         self.loop.run_until_complete(self.process_audio())
         self.loop.close()
         self.logger.info("Deepgram Async loop closed")
+
+    def run_dg_on_loop(self, loop: asyncio.AbstractEventLoop, init: bool):
+        """
+        Entry point in asyncio server mode.
+        Instead of a dedicated thread with its own event loop, process_audio runs as a task on the server loop,
+        so audio handlers can put frames into the queues without crossing threads.
+        """
+
+        with self.feed_lock:
+            if init:
+                self.init_queues()
+            # bound before process_audio is scheduled: frames fed from other threads from now on are handed over via
+            # the loop, after _start
+            self.loop = loop
+
+        def _start():
+            task = loop.create_task(self.process_audio())
+            task.add_done_callback(lambda _: self.logger.info("Deepgram Async task finished"))
+
+        loop.call_soon_threadsafe(_start)
@@ -0,0 +1,193 @@
+"""
+Warm pool of Deepgram live connections.
+
+Picking a key (balance checks + firestore), building the client and the websocket handshake are done ahead of
+time in the background, for the option sets (model, language, endpointing, ...) sessions ask for most. A new
+DGTranscriber takes a connected socket at creation time and only falls back to connecting itself on a miss.
+
+Pooled sockets are bound to the event loop they were opened on, so DG of every session has to run on that loop:
+the server loop in asyncio mode, a dedicated DG loop thread in threading mode (see InterviewSessionManager.new).
+Off unless DG_WARM_POOL_SIZE > 0, idle connections are kept alive by the SDK keepalive and recycled after
+DG_WARM_MAX_IDLE seconds.
+"""
+import asyncio
+import os
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from deepgram import DeepgramClient, DeepgramClientOptions, LiveTranscriptionEvents
+
+from interviewai import LoggerMixed
+
+logger = LoggerMixed(__name__)
+
+DG_WARM_POOL_SIZE = int(os.environ.get("DG_WARM_POOL_SIZE", 0))  # warm connections per option set
+DG_WARM_POOL_KEYS = int(os.environ.get("DG_WARM_POOL_KEYS", 4))  # most requested option sets kept warm
+DG_WARM_MAX_IDLE = 300  # seconds before an unused connection is recycled
+DG_WARM_REFILL_INTERVAL = 5  # seconds
+
+OptionsKey = Tuple
+
+
+def options_key(options: dict) -> OptionsKey:
+    return tuple(sorted(options.items()))
+
+
+class WarmDGConnection:
+    """
+    A started Deepgram socket. Its events go to the DGTranscriber owning it, and are ignored while it's idle.
+    """
+
+    def __init__(self, key: OptionsKey, dg_key: str, socket) -> None:
+        self.key = key
+        self.dg_key = dg_key
+        self.socket = socket
+        self.created_at = time.monotonic()
+        self.owner = None
+        self.closed = False
+
+    def handler(self, name: str):
+        async def dispatch(*args, **kwargs):
+            if name == "on_dg_close":
+                self.closed = True
+            owner = self.owner
+            if owner is not None:
+                await getattr(owner, name)(*args, **kwargs)
+
+        return dispatch
+
+    def register(self):
+        self.socket.on(LiveTranscriptionEvents.Transcript, self.handler("get_transcript"))
+        self.socket.on(LiveTranscriptionEvents.UtteranceEnd, self.handler("on_dg_utterance_end"))
+        self.socket.on(LiveTranscriptionEvents.Close, self.handler("on_dg_close"))
+        self.socket.on(LiveTranscriptionEvents.Error, self.handler("on_dg_error"))
+
+
+class DeepgramWarmPool:
+    def __init__(
+            self,
+            get_key: Callable[[], str],
+            size: int = DG_WARM_POOL_SIZE,
+            max_option_sets: int = DG_WARM_POOL_KEYS,
+    ) -> None:
+        self.get_key = get_key
+        self.size = size
+        self.max_option_sets = max_option_sets
+        self.loop: asyncio.AbstractEventLoop = None
+        self.lock = threading.Lock()
+        self.idle: Dict[OptionsKey, Deque[WarmDGConnection]] = {}
+        self.demand = Counter()  # option set -> sessions asking for it
+        self.options: Dict[OptionsKey, dict] = {}
+        self.refill_event: asyncio.Event = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        if not self.enabled or self.loop is not None:
+            return
+        self.loop = loop
+        asyncio.run_coroutine_threadsafe(self.refill_forever(), loop)
+        logger.info(f"Deepgram warm pool started, {self.size} connections per option set")
+
+    def acquire(self, options: dict, owner) -> Optional[WarmDGConnection]:
+        """
+        Hand a connected socket for these options to owner, None on a miss (owner connects itself).
+        """
+        if not self.enabled or self.loop is None:
+            return None
+        key = options_key(options)
+        with self.lock:
+            self.demand[key] += 1
+            self.options[key] = dict(options)
+            idle = self.idle.get(key)
+            while idle:
+                connection = idle.popleft()
+                if not connection.closed:
+                    connection.owner = owner
+                    self.hits += 1
+                    break
+            else:
+                connection = None
+                self.misses += 1
+        # refill right away instead of waiting for the next interval
+        self.loop.call_soon_threadsafe(self._wake)
+        return connection
+
+    def discard(self, connection: WarmDGConnection):
+        """
+        Close an acquired connection that won't be used.
+        """
+        connection.owner = None
+        if not connection.closed:
+            asyncio.run_coroutine_threadsafe(connection.socket.finish(), self.loop)
+
+    def _wake(self):
+        if self.refill_event is not None:
+            self.refill_event.set()
+
+    async def open(self, key: OptionsKey) -> Optional[WarmDGConnection]:
+        # key selection does blocking balance checks and firestore writes, keep it off the loop
+        dg_key = await self.loop.run_in_executor(None, self.get_key)
+        config = DeepgramClientOptions(options={"keepalive": "true"})
+        socket = DeepgramClient(api_key=dg_key, config=config).listen.asynclive.v("1")
+        connection = WarmDGConnection(key, dg_key, socket)
+        connection.register()
+        if await socket.start(self.options[key]) is False:
+            return None
+        return connection
+
+    async def refill(self):
+        with self.lock:
+            keys = [key for key, _ in self.demand.most_common(self.max_option_sets)]
+            stale = []
+            for key, idle in self.idle.items():
+                fresh = deque()
+                for connection in idle:
+                    too_old = time.monotonic() - connection.created_at > DG_WARM_MAX_IDLE
+                    if connection.closed or too_old or key not in keys:
+                        stale.append(connection)
+                    else:
+                        fresh.append(connection)
+                self.idle[key] = fresh
+            missing = [key for key in keys for _ in range(self.size - len(self.idle.get(key, ())))]
+        for connection in stale:
+            if not connection.closed:
+                await connection.socket.finish()
+        results = await asyncio.gather(*[self.open(key) for key in missing], return_exceptions=True)
+        with self.lock:
+            for result in results:
+                if isinstance(result, WarmDGConnection):
+                    self.idle.setdefault(result.key, deque()).append(result)
+                elif isinstance(result, Exception):
+                    logger.error(f"failed to open warm Deepgram connection: {result}")
+
+    async def refill_forever(self):
+        self.refill_event = asyncio.Event()
+        while True:
+            try:
+                await self.refill()
+            except Exception as e:
+                logger.error(f"Deepgram warm pool refill failed: {e} \n {traceback.format_exc()}")
+            try:
+                await asyncio.wait_for(self.refill_event.wait(), timeout=DG_WARM_REFILL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.refill_event.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 3) if requests else 0,
+                "idle": sum(len(idle) for idle in self.idle.values()),
+                "option_sets": len(self.idle),
+            }
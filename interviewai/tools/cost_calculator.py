@@ -81,6 +81,11 @@ class CostCalculator:
         if chain_type not in self.session_costs[key]["chain_types"]:
             self.session_costs[key]["chain_types"].append(chain_type)
 
+    def restore_session_cost(self, user_id: str, session_id: str, session_info: dict):
+        """Carry the accumulated cost of a session over from another worker (drain snapshot)"""
+        self.session_costs[(user_id, session_id)] = session_info
+        self.store_timestamp(user_id, session_id)
+
     def get_session_info(self, user_id: str, session_id: str) -> dict:
         key = (user_id, session_id)
         session_info = self.session_costs.get(key, None)
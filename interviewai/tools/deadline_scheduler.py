@@ -0,0 +1,89 @@
+"""
+Min-heap of keyed deadlines, one thread sleeping until the earliest one.
+
+schedule/cancel are O(log N) (cancel is a lazy delete, the heap entry is skipped when it surfaces). Expired
+callbacks run on a small thread pool, so a slow callback never delays the next deadline.
+"""
+import heapq
+import itertools
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Tuple
+
+from interviewai import LoggerMixed
+
+logger = LoggerMixed(__name__)
+
+DEADLINE_WORKERS = 4
+
+
+class DeadlineScheduler:
+    def __init__(self, workers: int = DEADLINE_WORKERS):
+        self.heap: List[Tuple[float, int, Hashable]] = []  # (deadline epoch seconds, seq, key)
+        self.entries: Dict[Hashable, Tuple[int, float, Callable, tuple]] = {}  # key -> live (seq, deadline, ...)
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="deadline")
+
+    def start(self):
+        t = threading.Thread(target=self.run, args=(), daemon=True)
+        t.start()
+
+    def schedule(self, key: Hashable, deadline: float, callback: Callable, *args) -> None:
+        """
+        Call callback(*args) at deadline (epoch seconds), replacing any deadline already set for key.
+        """
+        with self.condition:
+            seq = next(self.seq)
+            self.entries[key] = (seq, deadline, callback, args)
+            heapq.heappush(self.heap, (deadline, seq, key))
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self._compact()
+            if self.heap[0][1] == seq:
+                # new earliest deadline
+                self.condition.notify()
+
+    def cancel(self, key: Hashable) -> None:
+        with self.condition:
+            self.entries.pop(key, None)
+
+    def deadline(self, key: Hashable) -> float:
+        entry = self.entries.get(key)
+        return entry[1] if entry else None
+
+    def _live(self, item: Tuple[float, int, Hashable]) -> bool:
+        entry = self.entries.get(item[2])
+        return entry is not None and entry[0] == item[1]
+
+    def _compact(self):
+        # drop cancelled / replaced entries so the heap stays O(live deadlines)
+        self.heap = [item for item in self.heap if self._live(item)]
+        heapq.heapify(self.heap)
+
+    def _fire(self, key: Hashable, callback: Callable, args: tuple):
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error(f"deadline callback for {key} failed: {e} \n {traceback.format_exc()}")
+
+    def run(self):
+        with self.condition:
+            while True:
+                while self.heap and not self._live(self.heap[0]):
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                deadline, _, key = self.heap[0]
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    self.condition.wait(timeout=remaining)
+                    continue
+                heapq.heappop(self.heap)
+                _, _, callback, args = self.entries.pop(key)
+                self.executor.submit(self._fire, key, callback, args)
+
+    def __len__(self) -> int:
+        return len(self.entries)
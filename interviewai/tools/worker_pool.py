@@ -0,0 +1,379 @@
+"""
+Shared worker pool running the background work of every interview session.
+
+Sessions used to start ~6 dedicated threads each (transcriber, responders, history, credit deductor, DG loop) plus a
+thread per prune / firestore load. Their work is now submitted here as tasks:
+
+* tasks are grouped in lanes, a lane of a session (e.g. its "history") runs one task at a time, in order
+* sessions with runnable tasks are served round-robin, one busy session can't starve the others
+* submit_after runs a task later (response interval, credit ticks) without holding a worker
+* stats has live pending / running counts and completed counts and time per category (= lane name)
+
+Thread count is SESSION_WORKERS (scales with the cores), not with the number of sessions.
+
+Answers (respond, coach, speculate, prune lanes) wait on the LLM for up to LLM_TOTAL_DEADLINE, they run on
+LLM_WORKER_POOL instead: a burst of slow answers can't take every worker and hold back the short tasks (transcripts,
+chat history, credit ticks, firestore loads) of the other sessions.
+"""
+import os
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Callable, Deque, Dict, Hashable, Iterable, Set, Tuple
+
+from interviewai import LoggerMixed
+from interviewai.tools.deadline_scheduler import DeadlineScheduler
+
+logger = LoggerMixed(__name__)
+
+# tasks block on LLM / firestore calls, a few workers per core
+SESSION_WORKERS = int(os.environ.get("SESSION_WORKERS", (os.cpu_count() or 1) * 4))
+# tasks mostly wait for the LLM stream (on the LLM_STREAM_RUNNER loop), bounds the answers in flight
+LLM_WORKERS = int(os.environ.get("LLM_WORKERS", 64))
+
+
+class Lane:
+    def __init__(self, session: Hashable, name: str) -> None:
+        self.session = session
+        self.name = name
+        self.tasks: Deque[Tuple[Callable, tuple]] = deque()
+        self.running = False
+
+
+class SessionWork:
+    def __init__(self) -> None:
+        self.lanes: Dict[str, Lane] = {}
+        self.ready: Deque[Lane] = deque()  # lanes with tasks and not running
+        self.queued = False  # in the round-robin of the pool
+        self.running = 0
+
+
+class PoolEvent:
+    """
+    threading.Event look-alike for triggers: set() runs callback as a task of the session's lane instead of waking a
+    thread waiting on it. Setting it again while it's set is a no-op, the callback clears it when it starts.
+    on_set runs on the setting thread before the task is submitted, e.g. to cancel the lane's running task.
+    """
+
+    def __init__(
+            self, pool: "WorkerPool", session: Hashable, lane: str, callback: Callable, on_set: Callable = None,
+    ) -> None:
+        self.pool = pool
+        self.session = session
+        self.lane = lane
+        self.callback = callback
+        self.on_set = on_set
+        self.flag = False
+        self.lock = threading.Lock()
+
+    def set(self):
+        with self.lock:
+            if self.flag:
+                return
+            self.flag = True
+        if self.on_set is not None:
+            self.on_set()
+        self.pool.submit(self.session, self.lane, self.callback)
+
+    def clear(self):
+        with self.lock:
+            self.flag = False
+
+    def is_set(self) -> bool:
+        return self.flag
+
+
+class SessionTaskQueue:
+    """
+    queue.Queue look-alike for producers: put(item) runs handler(item) as a task of the session's lane.
+    """
+
+    def __init__(self, pool: "WorkerPool", session: Hashable, lane: str, handler: Callable) -> None:
+        self.pool = pool
+        self.session = session
+        self.lane = lane
+        self.handler = handler
+
+    def put(self, item, block: bool = True, timeout: float = None):
+        self.pool.submit(self.session, self.lane, self.handler, item)
+
+    def qsize(self) -> int:
+        return self.pool.pending(self.session, self.lane)
+
+
+class WorkerPool:
+    def __init__(self, workers: int = SESSION_WORKERS, name: str = "session") -> None:
+        self.workers = workers
+        self.name = name
+        lock = threading.Lock()
+        self.condition = threading.Condition(lock)  # workers wait on it for tasks
+        self.idle = threading.Condition(lock)  # wait_idle callers wait on it
+        self.sessions: Dict[Hashable, SessionWork] = {}
+        self.round_robin: Deque[Hashable] = deque()
+        self.timers = DeadlineScheduler(workers=1)
+        self.timer_keys: Dict[Hashable, Set[Tuple]] = {}  # session -> keys of its delayed tasks
+        self.pending_by_category = Counter()
+        self.running_by_category = Counter()
+        self.completed_by_category = Counter()
+        self.seconds_by_category = Counter()
+        self.local = threading.local()
+        self.started = False
+
+    def start(self):
+        with self.condition:
+            if self.started:
+                return
+            self.started = True
+        self.timers.start()
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work, args=(), daemon=True, name=f"{self.name}-worker-{i}")
+            t.start()
+        logger.info(f"{self.name} worker pool started with {self.workers} workers")
+
+    def submit(self, session: Hashable, lane: str, fn: Callable, *args):
+        if not self.started:
+            self.start()
+        with self.condition:
+            work = self.sessions.setdefault(session, SessionWork())
+            queue = work.lanes.get(lane)
+            if queue is None:
+                queue = work.lanes[lane] = Lane(session, lane)
+            queue.tasks.append((fn, args))
+            self.pending_by_category[lane] += 1
+            if not queue.running and len(queue.tasks) == 1:
+                work.ready.append(queue)
+                self._enqueue(session, work)
+                self.condition.notify()
+
+    def submit_after(self, delay: float, session: Hashable, lane: str, fn: Callable, *args):
+        """
+        Submit fn after delay seconds, replacing the delayed task already set for this lane of the session.
+        """
+        key = (session, lane)
+        with self.condition:
+            self.timer_keys.setdefault(session, set()).add(key)
+        self.timers.schedule(key, time.time() + delay, self._submit_delayed, key, fn, args)
+
+    def _submit_delayed(self, key: Tuple, fn: Callable, args: tuple):
+        session, lane = key
+        with self.condition:
+            keys = self.timer_keys.get(session)
+            if keys is None or key not in keys:
+                return
+            keys.discard(key)
+        self.submit(session, lane, fn, *args)
+
+    def _enqueue(self, session: Hashable, work: SessionWork):
+        if not work.queued and work.ready:
+            work.queued = True
+            self.round_robin.append(session)
+
+    def pending(self, session: Hashable, lane: str) -> int:
+        with self.condition:
+            work = self.sessions.get(session)
+            queue = work.lanes.get(lane) if work else None
+            return len(queue.tasks) if queue else 0
+
+    def cancel(self, session: Hashable, keep: Iterable[str] = ()):
+        """
+        Drop the pending and delayed tasks of a session, except those of the lanes in keep.
+        Running tasks finish, see wait_idle.
+        """
+        keep = set(keep)
+        with self.condition:
+            for key in self.timer_keys.pop(session, ()):
+                if key[1] in keep:
+                    self.timer_keys.setdefault(session, set()).add(key)
+                else:
+                    self.timers.cancel(key)
+            work = self.sessions.get(session)
+            if work is None:
+                return
+            for lane in work.lanes.values():
+                if lane.name not in keep:
+                    self.pending_by_category[lane.name] -= len(lane.tasks)
+                    lane.tasks.clear()
+            work.ready = deque(lane for lane in work.ready if lane.tasks)
+            self._forget_if_idle(session, work)
+            self.idle.notify_all()
+
+    def wait_idle(self, session: Hashable, timeout: float = None) -> bool:
+        """
+        Wait until the session has no pending or running task (besides the calling one, when called from a task).
+        """
+        own = 1 if getattr(self.local, "session", None) == session else 0
+
+        def idle():
+            work = self.sessions.get(session)
+            if work is None:
+                return True
+            return work.running <= own and not any(lane.tasks for lane in work.lanes.values())
+
+        with self.idle:
+            return self.idle.wait_for(idle, timeout=timeout)
+
+    def _forget_if_idle(self, session: Hashable, work: SessionWork):
+        if work.running == 0 and not work.queued and not any(lane.tasks for lane in work.lanes.values()):
+            del self.sessions[session]
+
+    def _next(self) -> Lane:
+        # caller holds the condition
+        while True:
+            while not self.round_robin:
+                self.condition.wait()
+            session = self.round_robin.popleft()
+            work = self.sessions.get(session)
+            if work is None:
+                continue
+            work.queued = False
+            if not work.ready:
+                self._forget_if_idle(session, work)
+                continue
+            lane = work.ready.popleft()
+            lane.running = True
+            work.running += 1
+            # back of the line, the other sessions go first
+            self._enqueue(session, work)
+            return lane
+
+    def work(self):
+        while True:
+            with self.condition:
+                lane = self._next()
+                fn, args = lane.tasks.popleft()
+                self.pending_by_category[lane.name] -= 1
+                self.running_by_category[lane.name] += 1
+            self.local.session = lane.session
+            started = time.monotonic()
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"session task {lane.name} failed: {e} \n {traceback.format_exc()}")
+            finally:
+                self.local.session = None
+            with self.condition:
+                self.running_by_category[lane.name] -= 1
+                self.completed_by_category[lane.name] += 1
+                self.seconds_by_category[lane.name] += time.monotonic() - started
+                lane.running = False
+                work = self.sessions[lane.session]
+                work.running -= 1
+                if lane.tasks:
+                    work.ready.append(lane)
+                    self._enqueue(lane.session, work)
+                    self.condition.notify()
+                self._forget_if_idle(lane.session, work)
+                self.idle.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "workers": self.workers,
+                "sessions": len(self.sessions),
+                "pending": {name: n for name, n in self.pending_by_category.items() if n},
+                "running": {name: n for name, n in self.running_by_category.items() if n},
+                "completed": dict(self.completed_by_category),
+                "seconds": {name: round(s, 3) for name, s in self.seconds_by_category.items()},
+            }
+
+
+SESSION_WORKER_POOL = WorkerPool()
+LLM_WORKER_POOL = WorkerPool(LLM_WORKERS, name="llm")
+
+
+if __name__ == "__main__":
+    # idle CPU and dispatch latency of the session work of 100 sessions, before (a thread per loop, polling) and on the
+    # pool: each session has the producers InterviewSession sets up (transcriber and history queues, responder events)
+    # and a credit tick every second
+    import queue
+
+    SESSIONS = 100
+    DURATION = 5  # seconds
+
+    def polling_queue(q: queue.Queue, stop: threading.Event, reset_backoff: bool):
+        # old TranscribeAssembler / chat_history_generator loops, the latter reset its backoff every iteration
+        empty_count = 0
+        while not stop.is_set():
+            if reset_backoff:
+                empty_count = 0
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                empty_count += 1
+                time.sleep(min(1.0, empty_count * 0.01))
+
+    def polling_event(event: threading.Event, stop: threading.Event):
+        # old responder / coach responder loops
+        while not stop.is_set():
+            if event.is_set():
+                event.clear()
+            else:
+                time.sleep(0.1)
+
+    def polling_idle_cpu() -> float:
+        stop = threading.Event()
+        threads = []
+        for _ in range(SESSIONS):
+            threads += [
+                threading.Thread(target=polling_queue, args=(queue.Queue(), stop, False), daemon=True),  # transcriber
+                threading.Thread(target=polling_queue, args=(queue.Queue(), stop, True), daemon=True),  # chat history
+                threading.Thread(target=polling_event, args=(threading.Event(), stop), daemon=True),  # responder
+                threading.Thread(target=polling_event, args=(threading.Event(), stop), daemon=True),  # coach
+            ]
+        for t in threads:
+            t.start()
+        time.sleep(1)  # let the backoffs settle
+        start = time.process_time()
+        time.sleep(DURATION)
+        cpu = time.process_time() - start
+        stop.set()
+        for t in threads:
+            t.join()
+        return cpu / DURATION * 100
+
+    before = polling_idle_cpu()
+
+    pool = WorkerPool()
+    latencies = []
+    lock = threading.Lock()
+
+    def handle(submitted_at: float):
+        with lock:
+            latencies.append(time.monotonic() - submitted_at)
+
+    def tick(session: int):
+        pool.submit_after(1, session, "credit", tick, session)
+
+    sessions = []
+    for session in range(SESSIONS):
+        transcripts = SessionTaskQueue(pool, session, "transcribe", handle)
+        history = SessionTaskQueue(pool, session, "history", handle)
+        responder = PoolEvent(pool, session, "respond", lambda: None)
+        coach = PoolEvent(pool, session, "coach_respond", lambda: None)
+        sessions.append((transcripts, history, responder, coach))
+        tick(session)
+    pool.start()
+    time.sleep(1)
+    start = time.process_time()
+    time.sleep(DURATION)
+    after = (time.process_time() - start) / DURATION * 100
+    # a transcript and a history entry per session at once, then a second of spread out ones
+    for transcripts, history, responder, coach in sessions:
+        transcripts.put(time.monotonic())
+        history.put(time.monotonic())
+    for i in range(SESSIONS * 10):
+        transcripts, history, _, _ = sessions[i % SESSIONS]
+        transcripts.put(time.monotonic())
+        time.sleep(1 / (SESSIONS * 10))
+    for session in range(SESSIONS):
+        pool.wait_idle(session, timeout=5)
+    latencies.sort()
+    print(
+        f"idle CPU of {SESSIONS} sessions: polling threads {before:.1f}% of a core, "
+        f"pool ({pool.workers} workers) {after:.1f}% of a core"
+    )
+    print(
+        f"pool dispatch latency p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+        f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms over {len(latencies)} tasks"
+    )
@@ -1,19 +1,20 @@
 import datetime
 import queue
 import threading
-import time
 import string
 from enum import Enum
 from heapq import merge
-from typing import Dict, List, Optional
+from collections import deque
+from typing import Deque, Dict, List, Optional
 
 from pydantic import BaseModel
 import uuid
 from interviewai import LoggerMixed
 from langchain.memory import ConversationSummaryBufferMemory
 from langchain_openai import ChatOpenAI
+from interviewai.chains.llm_pool import LLM_CLIENT_POOL
 from interviewai.prompt.prompt import SUMMARY_PROMPT_001
-from langchain.schema import ChatMessage, get_buffer_string
+from langchain.schema import BaseMessage, ChatMessage, get_buffer_string
 from interviewai.config.config import get_config
 from interviewai.user_manager.user_preference import UserSettings, ASIAN_LANGUAGES
 from interviewai.tools.data_structure import *
@@ -43,14 +44,87 @@ class TranscribeAssembler:
         self.saved_memory = ""
         self.token_limit = 16000
         self.memory = ConversationSummaryBufferMemory(
-            llm=ChatOpenAI(model_name=ModelType.OPENAI_GPT_35_TURBO.value),
+            llm=ChatOpenAI(model_name=ModelType.OPENAI_GPT_35_TURBO.value, http_client=LLM_CLIENT_POOL.acquire()),
             max_token_limit=self.token_limit,
             prompt=SUMMARY_PROMPT_001,
         )
+        # token count of each message of memory.chat_memory.messages (same order) and their running total,
+        # so trimming never re-tokenizes the whole buffer
+        self.message_tokens: Deque[int] = deque()
+        self.buffer_tokens = 0
+        self.base_tokens: Optional[int] = None  # get_num_tokens_from_messages([]), the reply priming
+        self.memory_lock = threading.RLock()
 
     def save_conversation(self, role, transcript):
         Chat_message = ChatMessage(role=role.value, content=transcript)
-        self.memory.chat_memory.add_message(Chat_message)
+        self.add_message(Chat_message)
+
+    def count_tokens(self, message: BaseMessage) -> int:
+        # tokens a message adds to get_num_tokens_from_messages of the buffer
+        llm = self.memory.llm
+        if self.base_tokens is None:
+            self.base_tokens = llm.get_num_tokens_from_messages([])
+        return llm.get_num_tokens_from_messages([message]) - self.base_tokens
+
+    def _sync_token_counts(self):
+        # messages added / removed without going through add_message (e.g. by langchain), recount once
+        messages = self.memory.chat_memory.messages
+        if len(self.message_tokens) != len(messages):
+            self.message_tokens = deque(self.count_tokens(message) for message in messages)
+            self.buffer_tokens = sum(self.message_tokens)
+
+    def add_message(self, message: BaseMessage):
+        """
+        Add a message to the memory buffer, tokenized once here.
+        """
+        tokens = self.count_tokens(message)
+        with self.memory_lock:
+            self._sync_token_counts()
+            self.memory.chat_memory.add_message(message)
+            self.message_tokens.append(tokens)
+            self.buffer_tokens += tokens
+
+    @property
+    def memory_tokens(self) -> int:
+        """
+        Same as memory.llm.get_num_tokens_from_messages(memory.chat_memory.messages), from the cached counts.
+        """
+        with self.memory_lock:
+            self._sync_token_counts()
+            return (self.base_tokens or 0) + self.buffer_tokens
+
+    def trim_memory(self, limit: int) -> List[BaseMessage]:
+        """
+        Drop the oldest messages until the buffer fits in limit tokens, O(dropped messages). Returns them.
+        """
+        with self.memory_lock:
+            self._sync_token_counts()
+            messages = self.memory.chat_memory.messages
+            k = 0
+            while k < len(messages) and (self.base_tokens or 0) + self.buffer_tokens > limit:
+                self.buffer_tokens -= self.message_tokens.popleft()
+                k += 1
+            dropped = messages[:k]
+            del messages[:k]
+            return dropped
+
+    def prune_memory(self):
+        """
+        ConversationSummaryBufferMemory.prune on the cached counts: the messages over max_token_limit are
+        summarized into moving_summary_buffer.
+        """
+        pruned = self.trim_memory(self.memory.max_token_limit)
+        if pruned:
+            # this call utilize `chain.predict` which might be unstable and slow
+            self.memory.moving_summary_buffer = self.memory.predict_new_summary(
+                pruned, self.memory.moving_summary_buffer
+            )
+
+    def clear_memory(self):
+        with self.memory_lock:
+            self.memory.clear()
+            self.message_tokens.clear()
+            self.buffer_tokens = 0
 
     def get_summary(self):
         summary_buffer = self.memory.moving_summary_buffer
@@ -84,44 +158,32 @@ class TranscribeAssembler:
         else:
             return False
 
-    def process_streamed_transcripts(
-            self, transcript_queue: queue.Queue, stop_event: threading.Event
-    ):
+    def process_transcript(self, transcript: Transcript):
         """
-        We will have a transribing service to constantly add transcripts to the queue.
-        """
-        empty_count = 0  # Keep track of how often the queue is empty
-        while not stop_event.is_set():
-            try:
-                transcript: Transcript = transcript_queue.get_nowait()
-                transcript_id = uuid.uuid4().hex
-                transcript.request_id = transcript_id
-                if transcript.role == Role.INTERVIEWEE:
-                    self.transcript_data[Role.INTERVIEWEE].insert(0, transcript)
-                    self.save_conversation(transcript.role, transcript.transcript)
-                if transcript.role == Role.INTERVIEWER:
-                    self.transcript_data[Role.INTERVIEWER].insert(0, transcript)
-                    self.save_conversation(transcript.role, transcript.transcript)
-                # Put the transcript into the chat history queue so frontend can overwrite the streaming tokens
-                self.chat_history_queue.put(transcript)
-                if (transcript.role == Role.INTERVIEWER and not self.paused and self.check_transcript_len(
-                        transcript.transcript)):  # Only trigger response per interviewer's transcript.
-                    self.respond_interviewer_changed_event.set()  # trigger event to let other threads know that the transcript has changed.
-
-                elif (transcript.role == Role.INTERVIEWEE and not self.paused and self.check_transcript_len(
-                        transcript.transcript)):  # Only trigger response per interviewee's transcript.
-                    self.respond_interviewee_changed_event.set()  # trigger event to let other threads know that the transcript has changed.   
-                else:
-                    self.logger.debug(
-                        f"changed_event ignored, reason: transcript role: {transcript.role}, paused: {self.paused}, transcript len: {self.check_transcript_len(transcript.transcript)}. Transcript: {transcript.transcript}"
-                    )
-            except queue.Empty:
-                empty_count += 1  # Increment the count when the queue is empty
-                sleep_time = min(
-                    1.0, empty_count * 0.01
-                )  # Increase the sleep time up to a maximum of 1 second
-                time.sleep(sleep_time)
-        self.logger.info("TranscribeAssembler thread ended...")
+        We will have a transribing service to constantly add transcripts to the transcribe queue.
+        Runs for each of them on the session's "transcribe" lane of the worker pool (see InterviewSession).
+        """
+        transcript_id = uuid.uuid4().hex
+        transcript.request_id = transcript_id
+        if transcript.role == Role.INTERVIEWEE:
+            self.transcript_data[Role.INTERVIEWEE].insert(0, transcript)
+            self.save_conversation(transcript.role, transcript.transcript)
+        if transcript.role == Role.INTERVIEWER:
+            self.transcript_data[Role.INTERVIEWER].insert(0, transcript)
+            self.save_conversation(transcript.role, transcript.transcript)
+        # Put the transcript into the chat history queue so frontend can overwrite the streaming tokens
+        self.chat_history_queue.put(transcript)
+        if (transcript.role == Role.INTERVIEWER and not self.paused and self.check_transcript_len(
+                transcript.transcript)):  # Only trigger response per interviewer's transcript.
+            self.respond_interviewer_changed_event.set()  # trigger event to let other threads know that the transcript has changed.
+
+        elif (transcript.role == Role.INTERVIEWEE and not self.paused and self.check_transcript_len(
+                transcript.transcript)):  # Only trigger response per interviewee's transcript.
+            self.respond_interviewee_changed_event.set()  # trigger event to let other threads know that the transcript has changed.   
+        else:
+            self.logger.debug(
+                f"changed_event ignored, reason: transcript role: {transcript.role}, paused: {self.paused}, transcript len: {self.check_transcript_len(transcript.transcript)}. Transcript: {transcript.transcript}"
+            )
 
     def get_last(self) -> Transcript:
         """
@@ -181,13 +243,3 @@ class TranscribeAssembler:
     def clear_transcript_data(self):
         self.transcript_data[Role.INTERVIEWEE].clear()
         self.transcript_data[Role.INTERVIEWER].clear()
-
-    def load_queue(self):
-        # for testing purpose
-        # put all items in queue into self.transcript_data
-        while not self.chat_history_queue.empty():
-            transcript: Transcript = self.chat_history_queue.get()
-            if transcript.role == Role.INTERVIEWEE:
-                self.transcript_data[Role.INTERVIEWEE].insert(0, transcript)
-            if transcript.role == Role.INTERVIEWER:
-                self.transcript_data[Role.INTERVIEWER].insert(0, transcript)
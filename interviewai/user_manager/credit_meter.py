@@ -0,0 +1,198 @@
+"""
+Process-wide credit metering of the running interview sessions.
+
+Every billable session used to have a thread waking up each minute to deduct its credits with ~4 firestore round
+trips. The meter keeps the sessions in a heap by next due time, one thread wakes up at the earliest one and charges
+all sessions due within CREDIT_BATCH_WINDOW of it in a single transaction (one read of their payment documents,
+one commit). Each session is charged on its own minute boundaries: a due time moves by CREDIT_INTERVAL after a
+charge, not to "now + interval".
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional, Tuple
+
+from firebase_admin import firestore
+
+from interviewai.firebase import get_fs_client, get_user_payment
+from interviewai.user_manager.credits_manager import COST_MAP, LOW_CREDIT_THRESHOLD, UserPaymentStatus, loops
+from interviewai.user_manager.mail import LoopsEventName
+
+CREDIT_INTERVAL = 60  # seconds between two charges of a session
+CREDIT_BATCH_WINDOW = 1.0  # seconds, sessions due this close to the earliest one are charged with it
+CREDIT_RETRY_DELAY = 5  # seconds, after a failed commit
+FIRESTORE_TRANSACTION_LIMIT = 500  # documents per transaction
+
+
+class MeteredSession:
+    def __init__(self, interview_session, due: float, seq: int) -> None:
+        self.interview_session = interview_session
+        self.due = due
+        self.seq = seq
+
+    @property
+    def key(self) -> str:
+        return self.interview_session.interview_session_id
+
+
+@firestore.transactional
+def charge_in_transaction(
+        transaction, metered: List[MeteredSession]
+) -> Dict[str, Tuple[bool, int, Optional[int]]]:
+    """
+    Deduct the cost of one interval from every session's user, returns session id -> (charged, cost, balance).
+    Same rules as CreditsManager.deduct_credit: ADMIN users are not charged, a short balance is not charged.
+    """
+    fs = get_fs_client()
+    refs = [get_user_payment(m.interview_session.user_id) for m in metered]
+    snapshots = {snapshot.reference.path: snapshot for snapshot in fs.get_all(refs, transaction=transaction)}
+    results = {}
+    for m, ref in zip(metered, refs):
+        snapshot = snapshots.get(ref.path)
+        data = snapshot.to_dict() if snapshot is not None and snapshot.exists else {}
+        cost = COST_MAP.get(m.interview_session.interview_type)
+        balance = data.get("balance", 0)
+        if cost is None:
+            results[m.key] = (False, 0, balance)
+        elif data.get("payment_status") == UserPaymentStatus.ADMIN.value:
+            # ADMIN user would get unlimited access
+            results[m.key] = (True, cost, None)
+        elif balance < cost:
+            results[m.key] = (False, cost, balance)
+        else:
+            transaction.update(ref, {"balance": balance - cost})
+            results[m.key] = (True, cost, balance)
+    return results
+
+
+class CreditMeter:
+    def __init__(self, interval: float = CREDIT_INTERVAL, window: float = CREDIT_BATCH_WINDOW) -> None:
+        self.interval = interval
+        self.window = window
+        self.sessions: Dict[str, MeteredSession] = {}  # interview_session_id -> live entry
+        self.heap: List[Tuple[float, int, str]] = []  # (due, seq, interview_session_id), lazy deletion
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+        self.started = False
+        self.ticks = 0
+        self.charges = 0
+        self.out_of_credit = 0
+
+    def start(self):
+        with self.condition:
+            if self.started:
+                return
+            self.started = True
+        t = threading.Thread(target=self.run, args=(), daemon=True)
+        t.start()
+
+    def add(self, interview_session):
+        """
+        Start charging a session, first charge one interval from now.
+        """
+        if not self.started:
+            self.start()
+        with self.condition:
+            self._schedule(MeteredSession(interview_session, time.time() + self.interval, next(self.seq)))
+
+    def remove(self, interview_session_id: str):
+        with self.condition:
+            self.sessions.pop(interview_session_id, None)
+
+    def __contains__(self, interview_session_id: str) -> bool:
+        return interview_session_id in self.sessions
+
+    def _schedule(self, m: MeteredSession):
+        # caller holds the condition
+        self.sessions[m.key] = m
+        heapq.heappush(self.heap, (m.due, m.seq, m.key))
+        if self.heap[0][1] == m.seq:
+            self.condition.notify()
+
+    def _live(self, item: Tuple[float, int, str]) -> bool:
+        m = self.sessions.get(item[2])
+        return m is not None and m.seq == item[1]
+
+    def _take_due(self) -> List[MeteredSession]:
+        # caller holds the condition, blocks until at least one session is due
+        while True:
+            while self.heap and not self._live(self.heap[0]):
+                heapq.heappop(self.heap)
+            if not self.heap:
+                self.condition.wait()
+                continue
+            remaining = self.heap[0][0] - time.time()
+            if remaining > 0:
+                self.condition.wait(timeout=remaining)
+                continue
+            break
+        cutoff = self.heap[0][0] + self.window
+        due = []
+        while self.heap and self.heap[0][0] <= cutoff and len(due) < FIRESTORE_TRANSACTION_LIMIT:
+            item = heapq.heappop(self.heap)
+            if self._live(item):
+                due.append(self.sessions[item[2]])
+        return due
+
+    def run(self):
+        while True:
+            with self.condition:
+                due = self._take_due()
+            try:
+                results = charge_in_transaction(get_fs_client().transaction(), due)
+            except Exception as e:
+                logging.error(f"credit metering of {len(due)} sessions failed: {e} \n {traceback.format_exc()}")
+                with self.condition:
+                    for m in due:
+                        if self.sessions.get(m.key) is m:
+                            # same due minute, charged on the retry
+                            heapq.heappush(self.heap, (time.time() + CREDIT_RETRY_DELAY, m.seq, m.key))
+                continue
+            self.ticks += 1
+            for m in due:
+                self.settle(m, *results[m.key])
+
+    def settle(self, m: MeteredSession, charged: bool, cost: int, balance: Optional[int]):
+        interview_session = m.interview_session
+        with self.condition:
+            live = self.sessions.get(m.key) is m  # not removed while the transaction ran
+            if live and charged:
+                m.due += self.interval
+                m.seq = next(self.seq)
+                self._schedule(m)
+            elif live:
+                self.sessions.pop(m.key, None)
+        if not charged:
+            if not live:
+                return
+            self.out_of_credit += 1
+            logging.info(f"{interview_session.user_id} Insufficient credits")
+            interview_session.on_out_of_credit()
+            return
+        self.charges += 1
+        interview_session.on_credit_charged(cost)
+        if balance is not None and balance <= LOW_CREDIT_THRESHOLD:
+            interview_session.pool.submit(m.key, "credit", self.send_low_credit_email, interview_session.user_id)
+
+    @staticmethod
+    def send_low_credit_email(user_id: str):
+        try:
+            response = loops.send_event(user_id, LoopsEventName.LOW_CREDIT.value)
+            logging.info(f"Send Low Credit email to {user_id}. Status: {response}")
+        except Exception as e:
+            logging.error(f"Failed to send low credit email: {e}")
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "sessions": len(self.sessions),
+                "ticks": self.ticks,
+                "charges": self.charges,
+                "out_of_credit": self.out_of_credit,
+            }
+
+
+CREDIT_METER = CreditMeter()
@@ -145,6 +145,15 @@ class UserSettings:
         """
         return self.dg_endpoint + 1000
 
+    @property
+    def speculative_answers(self):
+        """
+        Start answering an interviewer question on its interim transcript, committed when the final one matches.
+        Opt-in, fall back default:
+        False
+        """
+        return bool(self.preferences.get("speculativeAnswers", False))
+
     @property
     def system_responder_chain(self):
         """